@@ -0,0 +1,333 @@
+#!/usr/bin/env python
+"""Load and latency benchmarks for dumptruck_web.
+
+Builds a box home of synthetic boxes, then sends sql and meta requests
+to it at a fixed concurrency through one of the entry points (TARGETS):
+the CGI script run once per request, the WSGI application, or a
+dumptruck_server on a localhost port.  Throughput, latency percentiles, peak RSS and bytes
+out are written as JSON, so that runs on different commits can be
+compared with --compare.
+
+    python dumptruck_bench.py --target wsgi --output before.json
+    python dumptruck_bench.py --target wsgi --compare before.json
+"""
+
+import argparse
+import collections
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib
+
+import dumptruck_web
+import dumptruck_server
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+
+# How each box names its database, taken in turn: the box.json and
+# scraperwiki.json files from fixtures/, and no file at all.
+LAYOUTS = [
+    ('box.json', 'sw.json.dumptruck.db', 'dumptruck.db'),
+    ('scraperwiki.json', 'sw.json.scraperwiki.sqlite', 'scraperwiki.sqlite'),
+    (None, None, 'scraperwiki.sqlite'),
+]
+
+# Types of the columns of the synthetic tables, taken in turn.
+COLUMN_TYPES = ['INTEGER', 'TEXT', 'REAL']
+
+# Rows returned by each sql request.
+LIMIT = 100
+
+PERCENTILES = [('p50', 0.50), ('p95', 0.95), ('p99', 0.99)]
+
+def _value(rng, kind, i):
+    if kind == 'INTEGER':
+        return rng.randint(-2 ** 31, 2 ** 31)
+    if kind == 'REAL':
+        return rng.random() * 1000
+    return u'%d %s' % (i, u''.join(rng.choice(u'abcdefghij') for _ in range(rng.randint(0, 20))))
+
+def make_boxhome(path, boxes=4, tables=2, columns=4, rows=1000, seed=0):
+    """Fill the directory *path* with *boxes* boxes, each with a database
+    of *tables* tables of *columns* columns and *rows* rows.  Return
+    the names of the boxes.  The same *seed* gives the same databases.
+    """
+    rng = random.Random(seed)
+    names = []
+    for i in range(boxes):
+        name = 'box%d' % i
+        names.append(name)
+        boxdir = os.path.join(path, name)
+        os.makedirs(boxdir)
+        config, fixture, database = LAYOUTS[i % len(LAYOUTS)]
+        if config is not None:
+            shutil.copy(os.path.join(FIXTURES, fixture), os.path.join(boxdir, config))
+        db = sqlite3.connect(os.path.join(boxdir, database))
+        for t in range(tables):
+            kinds = [COLUMN_TYPES[c % len(COLUMN_TYPES)] for c in range(columns)]
+            db.execute('CREATE TABLE t%d (%s)' % (t,
+                ', '.join('c%d %s' % (c, kind) for c, kind in enumerate(kinds))))
+            db.executemany('INSERT INTO t%d VALUES (%s)' % (t, ', '.join('?' * columns)),
+                ([_value(rng, kind, r) for kind in kinds] for r in range(rows)))
+            db.execute('CREATE INDEX t%d_c0 ON t%d (c0)' % (t, t))
+        db.commit()
+        db.close()
+    return names
+
+def query_strings(method, names, tables=2, rows=1000, seed=0):
+    """Generate the query strings of an endless run of requests for
+    *method*, spread at random over the boxes *names*.
+    """
+    rng = random.Random(seed)
+    while True:
+        params = [('method', method), ('box', rng.choice(names))]
+        if method == 'sql':
+            params.append(('q', 'SELECT * FROM t%d WHERE rowid > %d LIMIT %d' % (
+                rng.randrange(tables), rng.randrange(max(rows - LIMIT, 1)), LIMIT)))
+        yield urllib.urlencode(params)
+
+def _self_peak_rss_kb():
+    # ru_maxrss is in kilobytes, and only ever grows.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+class CGITarget(object):
+    """Runs dumptruck_web.py as a CGI script, in a new process for each
+    request, so that every request pays for starting Python and opening
+    the database, as under a web server.  *boxhome* has to be named
+    home, as the script finds it from CO_STORAGE_DIR.
+    """
+    peak_rss_of = 'largest CGI process'
+
+    def __init__(self, boxhome):
+        if os.path.basename(boxhome) != 'home':
+            raise ValueError('the CGI script needs a box home named home: %r' % boxhome)
+        self.environ = dict(os.environ, REQUEST_METHOD='GET',
+            CO_STORAGE_DIR=os.path.dirname(os.path.abspath(boxhome)))
+        self.environ.pop('HTTP_ACCEPT_ENCODING', None)
+        self.script = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dumptruck_web.py')
+
+    def request(self, query_string):
+        process = subprocess.Popen([sys.executable, self.script], stdout=subprocess.PIPE,
+            env=dict(self.environ, QUERY_STRING=query_string))
+        output = process.communicate()[0]
+        head, _, body = output.partition('\n\n')
+        return int(head.split('\n')[1].split()[1]), len(body)
+
+    def peak_rss_kb(self):
+        return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+
+    def close(self):
+        pass
+
+class WSGITarget(object):
+    """Calls the WSGI application."""
+    peak_rss_of = 'benchmark process'
+    peak_rss_kb = staticmethod(_self_peak_rss_kb)
+
+    def __init__(self, boxhome):
+        self.boxhome = boxhome
+
+    def request(self, query_string):
+        environ = {'REQUEST_METHOD': 'GET', 'QUERY_STRING': query_string,
+            'dumptruck_web.boxhome': self.boxhome}
+        started = []
+        def start_response(status, headers):
+            started.append(status)
+        size = sum(len(chunk) for chunk in dumptruck_web.application(environ, start_response))
+        return int(started[0].split()[0]), size
+
+    def close(self):
+        pass
+
+class ServerTarget(object):
+    """Sends requests to a dumptruck_server listening on localhost."""
+    # The server runs in the benchmark process.
+    peak_rss_of = 'benchmark process'
+    peak_rss_kb = staticmethod(_self_peak_rss_kb)
+
+    def __init__(self, boxhome, threads=dumptruck_server.THREADS,
+            box_threads=dumptruck_server.BOX_THREADS, box_queue=dumptruck_server.BOX_QUEUE):
+        executor = dumptruck_server.Executor(threads, box_threads, box_queue)
+        self.server = dumptruck_server.Server(('127.0.0.1', 0), boxhome=boxhome, executor=executor)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+
+    def request(self, query_string):
+        sock = socket.create_connection(self.server.address)
+        try:
+            sock.sendall('GET /?%s HTTP/1.0\r\n\r\n' % query_string)
+            chunks = []
+            while True:
+                chunk = sock.recv(65536)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        finally:
+            sock.close()
+        head, _, body = ''.join(chunks).partition('\r\n\r\n')
+        return int(head.split()[1]), len(body)
+
+    def close(self):
+        self.server.shutdown()
+        self.thread.join()
+
+TARGETS = collections.OrderedDict([
+    ('cgi', CGITarget),
+    ('wsgi', WSGITarget),
+    ('server', ServerTarget),
+])
+
+def _percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else None
+
+def run(target, query_strings, requests, concurrency):
+    """Send *requests* requests from the iterator *query_strings* to
+    *target*, from *concurrency* threads each waiting for its answer
+    before sending the next.  Return a dict of the results.
+    """
+    lock = threading.Lock()
+    latencies = []
+    statuses = collections.Counter()
+    sent = [0, 0]   # requests, bytes
+
+    def client():
+        while True:
+            with lock:
+                if sent[0] >= requests:
+                    return
+                sent[0] += 1
+                query_string = next(query_strings)
+            started = time.time()
+            try:
+                code, size = target.request(query_string)
+            except Exception as e:
+                code, size = type(e).__name__, 0
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+                statuses[str(code)] += 1
+                sent[1] += size
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    started = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    seconds = time.time() - started
+
+    latencies.sort()
+    latency = collections.OrderedDict(
+        (name, _percentile(latencies, fraction) * 1000) for name, fraction in PERCENTILES)
+    latency['max'] = latencies[-1] * 1000
+    latency['mean'] = sum(latencies) / len(latencies) * 1000
+    return collections.OrderedDict([
+        ('requests', len(latencies)),
+        ('concurrency', concurrency),
+        ('seconds', seconds),
+        ('throughput', len(latencies) / seconds),
+        ('latency_ms', latency),
+        ('status', dict(statuses)),
+        ('bytes_out', sent[1]),
+        # The peak so far, not just for this run: with an in-process
+        # target it includes the clients, and earlier methods' runs.
+        ('peak_rss_kb', target.peak_rss_kb()),
+        ('peak_rss_of', target.peak_rss_of),
+    ])
+
+def _commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)), stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def benchmark(target='wsgi', methods=('sql', 'meta'), boxes=4, tables=2, columns=4, rows=1000,
+        requests=1000, concurrency=8, seed=0, boxhome=None):
+    """Build a box home (in a temporary directory unless *boxhome* is
+    given), run *requests* requests of each of *methods* against the
+    TARGETS entry point *target*, and return the report.
+    """
+    temporary = boxhome is None
+    if temporary:
+        boxhome = os.path.join(tempfile.mkdtemp(prefix='dumptruck_bench'), 'home')
+    try:
+        names = make_boxhome(boxhome, boxes, tables, columns, rows, seed)
+        results = collections.OrderedDict()
+        client = TARGETS[target](boxhome)
+        try:
+            for method in methods:
+                results[method] = run(client,
+                    query_strings(method, names, tables, rows, seed), requests, concurrency)
+        finally:
+            client.close()
+    finally:
+        if temporary:
+            shutil.rmtree(os.path.dirname(boxhome))
+        dumptruck_web.CONNECTIONS.clear()
+    return collections.OrderedDict([
+        ('commit', _commit()),
+        ('time', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+        ('python', platform.python_version()),
+        ('sqlite', sqlite3.sqlite_version),
+        ('config', collections.OrderedDict([('target', target), ('boxes', boxes),
+            ('tables', tables), ('columns', columns), ('rows', rows),
+            ('requests', requests), ('concurrency', concurrency), ('seed', seed)])),
+        ('results', results),
+    ])
+
+def compare(before, after):
+    """Return lines comparing the throughput and latency of two reports."""
+    lines = []
+    for method, new in after['results'].items():
+        old = before['results'].get(method)
+        if old is None:
+            continue
+        lines.append('%s: throughput %.1f -> %.1f/s (%+.1f%%), p99 %.2f -> %.2fms (%+.1f%%)' % (
+            method, old['throughput'], new['throughput'],
+            (new['throughput'] / old['throughput'] - 1) * 100,
+            old['latency_ms']['p99'], new['latency_ms']['p99'],
+            (new['latency_ms']['p99'] / old['latency_ms']['p99'] - 1) * 100))
+    return lines
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--target', choices=list(TARGETS), default='wsgi')
+    parser.add_argument('--method', action='append', choices=['sql', 'meta'],
+        help='may be given more than once; sql and meta by default')
+    parser.add_argument('--boxes', type=int, default=4)
+    parser.add_argument('--tables', type=int, default=2)
+    parser.add_argument('--columns', type=int, default=4)
+    parser.add_argument('--rows', type=int, default=1000)
+    parser.add_argument('--requests', type=int, default=1000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='file to write the JSON report to, else stdout')
+    parser.add_argument('--compare', help='earlier JSON report to compare with')
+    args = parser.parse_args(argv)
+
+    report = benchmark(args.target, args.method or ['sql', 'meta'], args.boxes, args.tables,
+        args.columns, args.rows, args.requests, args.concurrency, args.seed)
+    text = json.dumps(report, indent=2) + '\n'
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(text)
+    else:
+        sys.stdout.write(text)
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(json.load(f), report):
+                sys.stderr.write(line + '\n')
+
+if __name__ == '__main__':
+    main()
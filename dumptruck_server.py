@@ -0,0 +1,505 @@
+#!/usr/bin/env python
+"""A standalone HTTP server for dumptruck_web.application.
+
+Instead of a process per request, one process handles every client
+connection in a single asyncore event loop, and hands the blocking
+SQLite work to a small pool of worker threads (see Executor).  A client
+that is slow to send its request, or to read its response, only costs
+a socket and some buffer space, not a thread.  Rows are sent as they
+are read from the database.
+
+    python dumptruck_server.py --port 8080
+"""
+
+import argparse
+import asyncore
+import cgi
+import collections
+import cStringIO
+import errno
+import json
+import math
+import os
+import socket
+import sys
+import threading
+import time
+import traceback
+import urllib
+import urlparse
+
+import dumptruck_web
+
+# Worker threads running queries.
+THREADS = int(os.environ.get('DUMPTRUCK_WEB_THREADS', 32))
+# Most worker threads one box may use at once.
+BOX_THREADS = int(os.environ.get('DUMPTRUCK_WEB_BOX_THREADS', 4))
+# Most requests for one box that may wait for a thread.
+BOX_QUEUE = int(os.environ.get('DUMPTRUCK_WEB_BOX_QUEUE', 64))
+# Most idle boxes whose queue metrics are kept.
+BOX_METRICS = dumptruck_web.BOX_METRICS
+# Bytes of a response that may wait to be sent to a slow client before
+# its worker thread stops reading rows.
+SEND_BUFFER = int(os.environ.get('DUMPTRUCK_WEB_SEND_BUFFER', 1024 * 1024))
+# Largest request, headers and body, that is accepted.
+MAX_REQUEST = 1024 * 1024
+
+class Full(Exception):
+    """A box's queue is full.  *retry_after* is a guess at how many
+    seconds it will take to have room.
+    """
+    def __init__(self, box, retry_after):
+        super(Full, self).__init__('Queue for box %r is full' % box)
+        self.box = box
+        self.retry_after = retry_after
+
+class BoxQueue(object):
+    """The jobs waiting to run for one box, and its metrics."""
+    def __init__(self):
+        self.jobs = collections.deque()
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.wait = dumptruck_web.Histogram()
+        self.run_seconds = 0.0
+        self.finished = 0
+
+    def mean_run(self):
+        return self.run_seconds / self.finished if self.finished else 0.0
+
+    def as_dict(self):
+        return {'queued': len(self.jobs), 'running': self.running,
+            'admitted': self.admitted, 'rejected': self.rejected,
+            'wait': self.wait.as_dict(), 'mean_run_ms': self.mean_run() * 1000}
+
+class Executor(object):
+    """A fixed pool of *threads* worker threads running jobs for boxes.
+
+    Each box has its own queue of at most *max_queue* jobs, and the
+    boxes with jobs waiting take turns, so a box that is sent many
+    requests only delays its own.  At most *per_box* of a box's jobs
+    run at once.  A job for a box whose queue is full is rejected with
+    Full straight away, rather than waiting for a long time.
+
+    A box's queue is only kept while it has jobs waiting or running;
+    the metrics of the *max_metrics* boxes most recently sent jobs are
+    kept after that.
+    """
+    def __init__(self, threads=THREADS, per_box=BOX_THREADS, max_queue=BOX_QUEUE,
+            max_metrics=BOX_METRICS):
+        self.threads = threads
+        self.per_box = per_box
+        self.max_queue = max_queue
+        self.max_metrics = max_metrics
+        self._lock = threading.Condition()
+        # box -> BoxQueue, for the boxes with jobs waiting or running.
+        self._queues = {}
+        # The boxes with a job that may run now, in the order they get a
+        # turn.
+        self._ready = collections.OrderedDict()
+        # box -> BoxQueue, for the boxes most recently sent jobs, oldest
+        # first.
+        self._recent = collections.OrderedDict()
+        self._stopping = False
+        self._threads = [threading.Thread(target=self._work) for i in range(threads)]
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+
+    def submit(self, box, function):
+        """Call *function* from a worker thread, as a job for *box*.
+        Raises Full if too many of *box*'s jobs are waiting.
+        """
+        with self._lock:
+            queue = self._queues.get(box) or self._recent.pop(box, None) or BoxQueue()
+            self._recent[box] = queue
+            while len(self._recent) > self.max_metrics:
+                self._recent.popitem(last=False)
+            if len(queue.jobs) >= self.max_queue:
+                queue.rejected += 1
+                dumptruck_web.count('rejected')
+                # Each of the box's threads has to get through its share
+                # of the queue.
+                raise Full(box, max(1, int(math.ceil(
+                    queue.mean_run() * len(queue.jobs) / self.per_box))))
+            queue.jobs.append((time.time(), function))
+            self._queues[box] = queue
+            if queue.running < self.per_box:
+                self._ready[box] = True
+            self._lock.notify_all()
+
+    def _take(self):
+        """Remove and return the next job, as (box, queue, submitted,
+        function), or None if there are none that may run now.  Call
+        with the lock held.
+        """
+        if not self._ready:
+            return None
+        box = self._ready.popitem(last=False)[0]
+        queue = self._queues[box]
+        submitted, function = queue.jobs.popleft()
+        queue.running += 1
+        queue.admitted += 1
+        queue.wait.add(time.time() - submitted)
+        if queue.jobs and queue.running < self.per_box:
+            # To the back of the line.
+            self._ready[box] = True
+        return box, queue, function
+
+    def _work(self):
+        while True:
+            with self._lock:
+                job = self._take()
+                while job is None:
+                    if self._stopping:
+                        return
+                    self._lock.wait()
+                    job = self._take()
+            box, queue, function = job
+            started = time.time()
+            try:
+                function()
+            except Exception:
+                traceback.print_exc()
+            finally:
+                with self._lock:
+                    queue.running -= 1
+                    queue.finished += 1
+                    queue.run_seconds += time.time() - started
+                    if queue.jobs:
+                        self._ready.setdefault(box, True)
+                    elif not queue.running:
+                        del self._queues[box]
+                    self._lock.notify_all()
+
+    def metrics(self):
+        """Queue depth, wait times and rejections for each box that has
+        jobs waiting or running, or was recently sent one.
+        """
+        with self._lock:
+            queues = dict(self._recent)
+            queues.update(self._queues)
+            return dict((box, queue.as_dict()) for box, queue in queues.items())
+
+    def shutdown(self):
+        """Stop the threads once the jobs already submitted are done."""
+        with self._lock:
+            self._stopping = True
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+class Trigger(asyncore.dispatcher):
+    """Lets other threads wake the event loop, which then runs any
+    functions they passed to *call*.
+    """
+    def __init__(self, map):
+        self._reader, self._writer = socket.socketpair()
+        self._writer.setblocking(False)
+        asyncore.dispatcher.__init__(self, self._reader, map=map)
+        self._lock = threading.Lock()
+        self._calls = []
+
+    def wake(self):
+        try:
+            self._writer.send('x')
+        except socket.error, e:
+            # The loop is already due to wake up, or has been shut down.
+            if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EBADF):
+                raise
+
+    def call(self, function):
+        """Run *function* in the event loop's thread."""
+        with self._lock:
+            self._calls.append(function)
+        self.wake()
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.recv(4096)
+        except socket.error:
+            pass
+        with self._lock:
+            calls, self._calls = self._calls, []
+        for function in calls:
+            function()
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self._writer.close()
+
+class Connection(asyncore.dispatcher):
+    """One client connection, which makes one request.
+
+    The request is read in the event loop, the response is made by the
+    WSGI application in a worker thread, and passed back to the event
+    loop to send through *write*.
+    """
+    def __init__(self, sock, server):
+        asyncore.dispatcher.__init__(self, sock, map=server.map)
+        self.server = server
+        self.request = ''
+        self.reading = True
+        self.lock = threading.Condition()
+        # Strings waiting to be sent, and their total length.
+        self.outgoing = collections.deque()
+        self.buffered = 0
+        # Set when the whole response has been written.
+        self.finished = False
+        self.disconnected = False
+
+    # Event loop side.
+
+    def readable(self):
+        return self.reading
+
+    def handle_read(self):
+        data = self.recv(65536)
+        if not data:
+            return
+        self.request += data
+        header_end = self.request.find('\r\n\r\n')
+        if header_end < 0:
+            if len(self.request) > MAX_REQUEST:
+                self._reject('413 Request Entity Too Large')
+            return
+        try:
+            environ = self._environ(self.request[:header_end])
+        except ValueError:
+            self._reject('400 Bad Request')
+            return
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        if length > MAX_REQUEST:
+            self._reject('413 Request Entity Too Large')
+            return
+        body = self.request[header_end + 4:]
+        if len(body) < length:
+            return
+        self.reading = False
+        environ['wsgi.input'] = cStringIO.StringIO(body[:length])
+        form = cgi.FieldStorage(fp=cStringIO.StringIO(body[:length]), environ=environ)
+        if form.list is not None and form.getfirst('method') == 'wait':
+            wait = dumptruck_web.wait_condition(self.server.boxhome, form)
+            if wait is not None:
+                # Wait for the database to change without a thread,
+                # then run the request without it waiting again.
+                dbname, identity, timeout = wait
+                environ['dumptruck_web.wait'] = False
+                dumptruck_web.WATCHER.watch(dbname, identity, timeout,
+                    lambda: self.server.trigger.call(lambda: self._submit(environ)))
+                return
+        self._submit(environ)
+
+    def _submit(self, environ):
+        """Queue the request to be answered by a worker thread."""
+        if self.disconnected:
+            return
+        try:
+            self.server.executor.submit(request_box(environ), lambda: self.respond(environ))
+        except Full as e:
+            self._reject('503 Service Unavailable', json.dumps('Error: too many requests for box %s'
+                % e.box), [('Retry-After', str(e.retry_after))])
+
+    def _environ(self, head):
+        """The WSGI environ for the request whose request line and
+        headers are *head*.  Raises ValueError if it is malformed.
+        """
+        lines = head.split('\r\n')
+        method, target, protocol = lines[0].split(' ')
+        path, _, query = target.partition('?')
+        environ = {
+            'REQUEST_METHOD': method,
+            'SCRIPT_NAME': '',
+            'PATH_INFO': urllib.unquote(path),
+            'QUERY_STRING': query,
+            'SERVER_PROTOCOL': protocol,
+            'SERVER_NAME': self.server.address[0],
+            'SERVER_PORT': str(self.server.address[1]),
+            'REMOTE_ADDR': self.addr[0] if isinstance(self.addr, tuple) else '',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+            'dumptruck_web.boxhome': self.server.boxhome,
+        }
+        for line in lines[1:]:
+            name, value = line.split(':', 1)
+            name = name.strip().upper().replace('-', '_')
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value.strip()
+            else:
+                environ['HTTP_' + name] = value.strip()
+        int(environ.get('CONTENT_LENGTH') or 0)
+        return environ
+
+    def _reject(self, status, body='', headers=()):
+        """Respond with *status* without running the application."""
+        self.reading = False
+        lines = ['HTTP/1.1 ' + status, 'Content-Type: ' + dumptruck_web.CONTENT_TYPE,
+            'Content-Length: %d' % len(body)]
+        lines.extend('%s: %s' % header for header in headers)
+        self.outgoing.append('\r\n'.join(lines + ['Connection: close', '', body]))
+        self.finished = True
+
+    def writable(self):
+        return bool(self.outgoing) or self.finished
+
+    def handle_write(self):
+        with self.lock:
+            data = self.outgoing[0] if self.outgoing else None
+        if data is None:
+            if self.finished:
+                self.close()
+            return
+        sent = self.send(data)
+        with self.lock:
+            if sent:
+                if sent == len(data):
+                    self.outgoing.popleft()
+                else:
+                    self.outgoing[0] = data[sent:]
+                self.buffered -= sent
+                self.lock.notify_all()
+
+    def handle_close(self):
+        self.close()
+
+    def close(self):
+        # Stop the worker thread waiting to write, if it is.
+        with self.lock:
+            self.disconnected = True
+            self.lock.notify_all()
+        asyncore.dispatcher.close(self)
+
+    def handle_error(self):
+        traceback.print_exc()
+        self.handle_close()
+
+    # Worker thread side.
+
+    def write(self, data):
+        """Queue *data* to be sent, first waiting while more than
+        SEND_BUFFER bytes are already waiting.
+        """
+        with self.lock:
+            while self.buffered > self.server.send_buffer and not self.disconnected:
+                self.lock.wait()
+            if self.disconnected:
+                return
+            self.outgoing.append(data)
+            self.buffered += len(data)
+        self.server.trigger.wake()
+
+    def respond(self, environ):
+        """Run the WSGI application and send its response."""
+        # The status line and headers, which are sent with the first
+        # part of the body, in case working that out fails.
+        head = []
+        sent = False
+        def start_response(status, headers, exc_info=None):
+            lines = ['HTTP/1.1 ' + status] + ['%s: %s' % header for header in headers]
+            head[:] = ['\r\n'.join(lines + ['Connection: close', '', ''])]
+        body = None
+        try:
+            body = dumptruck_web.application(environ, start_response)
+            for chunk in body:
+                if not chunk:
+                    continue
+                if not sent:
+                    chunk, sent = head.pop() + chunk, True
+                self.write(chunk)
+                if self.disconnected:
+                    break
+            if not sent:
+                self.write(head.pop())
+        except Exception:
+            traceback.print_exc()
+            # Otherwise the client sees the response cut off.
+            if not sent:
+                self.write('HTTP/1.1 500 Internal Server Error\r\n'
+                    'Content-Length: 0\r\nConnection: close\r\n\r\n')
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self.finished = True
+            self.server.trigger.wake()
+
+def request_box(environ):
+    """The box= parameter of the request *environ*, if any, which is
+    what Executor limits concurrency by.
+    """
+    query = environ.get('QUERY_STRING', '')
+    if environ.get('CONTENT_TYPE', '').startswith('application/x-www-form-urlencoded'):
+        query += '&' + environ['wsgi.input'].getvalue()
+    boxes = urlparse.parse_qs(query).get('box')
+    return boxes[0] if boxes else None
+
+class Server(asyncore.dispatcher):
+    """Listens on *address* and serves dumptruck_web.application for
+    the boxes in *boxhome*, running it with *executor*.
+    """
+    def __init__(self, address, boxhome=dumptruck_web.BOXHOME, executor=None,
+            send_buffer=SEND_BUFFER):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+        self.boxhome = boxhome
+        self.executor = executor or Executor()
+        self.send_buffer = send_buffer
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+        self.address = self.socket.getsockname()
+        self.trigger = Trigger(self.map)
+        dumptruck_web.STATS.sources['queues'] = self.executor.metrics
+
+    def writable(self):
+        return False
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            Connection(pair[0], self)
+
+    def serve_forever(self):
+        """Run the event loop until *shutdown* is called."""
+        # poll, unlike select, isn't limited to 1024 connections.
+        asyncore.loop(timeout=30, use_poll=True, map=self.map)
+
+    def shutdown(self):
+        """Stop the event loop, from any thread, and the executor."""
+        def close_all():
+            for dispatcher in self.map.values():
+                dispatcher.close()
+        self.trigger.call(close_all)
+        self.executor.shutdown()
+        if dumptruck_web.STATS.sources.get('queues') == self.executor.metrics:
+            del dumptruck_web.STATS.sources['queues']
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--boxhome', default=dumptruck_web.BOXHOME)
+    parser.add_argument('--threads', type=int, default=THREADS)
+    parser.add_argument('--box-threads', type=int, default=BOX_THREADS)
+    parser.add_argument('--box-queue', type=int, default=BOX_QUEUE)
+    parser.add_argument('--warmup-box', action='append',
+        help='box to warm up at start; may be given more than once')
+    parser.add_argument('--warmup-seconds', type=float, default=dumptruck_web.WARMUP_SECONDS)
+    args = parser.parse_args(argv)
+    server = Server((args.host, args.port), boxhome=args.boxhome,
+        executor=Executor(args.threads, args.box_threads, args.box_queue))
+    # Requests are answered while warming up, but method=ready says 503.
+    dumptruck_web.WARMUP = dumptruck_web.Warmup(args.boxhome,
+        boxes=args.warmup_box, seconds=args.warmup_seconds)
+    dumptruck_web.WARMUP.start()
+    server.serve_forever()
+
+if __name__ == '__main__':
+    main()
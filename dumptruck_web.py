@@ -1,9 +1,33 @@
 #!/usr/bin/env python
 
+import base64
+import bisect
 import cgi
+import collections
+import contextlib
+import cStringIO
+import csv
+import ctypes
+import ctypes.util
+import fcntl
+import fnmatch
+import functools
+import hashlib
+import itertools
 import json
+import math
 import os
+import random
+import re
+import select
 import sqlite3
+import sys
+import thread
+import threading
+import time
+import traceback
+import urllib
+import zlib
 
 import dumptruck
 
@@ -11,26 +35,323 @@ import dumptruck
 # as a 'Status:' header.  See http://www.fastcgi.com/docs/faq.html#httpstatus
 # Template used by headers_for_status function
 HEADERS = '''HTTP/1.1 %(status)s
-Status: %(status)s
-Content-Type: application/json; charset=utf-8'''
+Status: %(status)s'''
+
+CONTENT_TYPE = 'application/json; charset=utf-8'
 
 LONG_STATUS = {
     200: '200 OK',
+    206: '206 Partial Content',
     301: '301 Moved permanently',
     302: '302 Found',
     303: '303 See Other',
+    304: '304 Not Modified',
     400: '400 Bad Request',
     401: '401 Unauthorized',
     403: '403 Forbidden',
     404: '404 Not Found',
     500: '500 ',
+    503: '503 Service Unavailable',
 }
 
 if 'CO_STORAGE_DIR' not in os.environ:
     os.environ['CO_STORAGE_DIR'] = ''
 
-def headers_for_status(code):
-    return HEADERS % dict(status=LONG_STATUS[code])
+BOXHOME = os.path.join('/', '%s/home' % os.environ['CO_STORAGE_DIR'])
+
+def headers_for_status(code, headers=None):
+    """The status lines followed by *headers*, a list of (name, value)
+    pairs, as CGI header text.  By default the only extra header is
+    the JSON Content-Type.
+    """
+    if headers is None:
+        headers = [('Content-Type', CONTENT_TYPE)]
+    lines = [HEADERS % dict(status=LONG_STATUS[code])]
+    lines.extend('%s: %s' % header for header in headers)
+    return '\n'.join(lines)
+
+class Response(object):
+    """An HTTP status code, headers and body, which can be written
+    out either as CGI output or from the WSGI application.
+
+    *body* is a string or an iterable of strings.
+    """
+    def __init__(self, code, body, headers=None):
+        self.code = code
+        if isinstance(body, basestring):
+            body = [body]
+        self.body = body
+        if headers is None:
+            headers = [('Content-Type', CONTENT_TYPE)]
+        self.headers = headers
+
+    def cgi(self):
+        """Return the complete CGI output as one string."""
+        return headers_for_status(self.code, self.headers) + '\n\n' + ''.join(self.body)
+
+    def wsgi(self, start_response):
+        """Start the WSGI response and return the body iterable."""
+        start_response(LONG_STATUS[self.code], list(self.headers))
+        return self.body
+
+# Bodies shorter than this many bytes are not worth compressing.
+COMPRESS_THRESHOLD = int(os.environ.get('DUMPTRUCK_WEB_COMPRESS_THRESHOLD', 1024))
+
+# Content-Encoding -> zlib window bits.
+ENCODINGS = collections.OrderedDict([
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+])
+
+def negotiate_encoding(accept_encoding):
+    """Return the best of ENCODINGS allowed by an Accept-Encoding
+    header value, or None if the body should be sent as it is.
+    """
+    if not accept_encoding:
+        return None
+    qualities = {}
+    for part in accept_encoding.split(','):
+        params = part.strip().split(';')
+        name = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qualities[name] = q
+    best, best_q = None, 0.0
+    for name in ENCODINGS:
+        q = qualities.get(name, qualities.get('*', 0.0))
+        if q > best_q:
+            best, best_q = name, q
+    return best
+
+def _compress_chunks(chunks, wbits):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def compress_response(response, accept_encoding, threshold=COMPRESS_THRESHOLD):
+    """Return *response* compressed with the encoding negotiated from
+    *accept_encoding*, the request's Accept-Encoding header.
+
+    The body is compressed incrementally as it is iterated, so this
+    works for streamed bodies.  Only enough of the body is read ahead
+    to decide whether it is at least *threshold* bytes long; shorter
+    bodies are sent uncompressed.
+    """
+    encoding = negotiate_encoding(accept_encoding)
+    if encoding is None:
+        return response
+
+    chunks = iter(response.body)
+    head = []
+    size = 0
+    for chunk in chunks:
+        head.append(chunk)
+        size += len(chunk)
+        if size >= threshold:
+            break
+
+    headers = list(response.headers) + [('Vary', 'Accept-Encoding')]
+    if size < threshold:
+        return Response(response.code, head, headers)
+    headers.append(('Content-Encoding', encoding))
+    # A strong ETag must differ between encodings of the same entity.
+    headers = [(name, value[:-1] + '-' + encoding + '"' if name == 'ETag' else value)
+        for name, value in headers]
+    body = _compress_chunks(itertools.chain(head, chunks), ENCODINGS[encoding])
+    return Response(response.code, body, headers)
+
+def make_etag(*parts):
+    """Return a strong entity tag for a response that is entirely
+    determined by *parts*.
+    """
+    return '"%s"' % hashlib.sha1(repr(parts)).hexdigest()
+
+def etag_matches(etag, if_none_match):
+    """Whether *etag*, or the ETag of a compressed version of the same
+    response, is listed in an If-None-Match header value.
+    """
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    base = etag.strip('"')
+    tags = set([base] + [base + '-' + encoding for encoding in ENCODINGS])
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag.startswith('W/'):
+            tag = tag[2:]
+        if tag.strip('"') in tags:
+            return True
+    return False
+
+def cache_headers(etag):
+    """Headers letting clients cache a response, on condition that they
+    check with us (using If-None-Match) before using it again.
+    """
+    return [('ETag', etag), ('Cache-Control', 'no-cache')]
+
+def conditional(response, etag):
+    """Add the cache headers to a successful *response*."""
+    if response.code == 200:
+        response.headers = list(response.headers) + cache_headers(etag)
+    return response
+
+def not_modified(etag, environ):
+    """Return a 304 Response if the request's If-None-Match matches
+    *etag*, otherwise None.
+    """
+    if etag_matches(etag, environ.get('HTTP_IF_NONE_MATCH')):
+        return Response(304, '', cache_headers(etag))
+    return None
+
+_counters_lock = threading.Lock()
+COUNTERS = collections.Counter()
+
+def count(name, n=1):
+    """Add *n* to the process-wide counter *name*."""
+    with _counters_lock:
+        COUNTERS[name] += n
+
+class Timer(object):
+    """Times the phases of handling one request to *method*.  The
+    method calls *resolved* once it knows the box.
+    """
+    def __init__(self, method=None):
+        self.method = method
+        self.box = None
+        # Set by the sql method, for the slow query log.
+        self.sql = None
+        self.rows = None
+        self.started = time.time()
+        self.phases = collections.OrderedDict()
+
+    def resolved(self, box, dbname):
+        """Note that the request is for *box*, whose database is
+        *dbname*.  Boxes with no database aren't recorded, so that
+        requests for made-up boxes don't each get a histogram.
+        """
+        if os.path.isfile(dbname):
+            self.box = box
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0) + time.time() - started
+
+    def header(self):
+        """The phases so far as a Server-Timing header value."""
+        return ', '.join('%s;dur=%.3f' % (name, seconds * 1000)
+            for name, seconds in self.phases.items())
+
+class Histogram(object):
+    """Counts of durations falling in each of BUCKETS."""
+
+    # Upper bounds of the buckets, in milliseconds.
+    BUCKETS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.total = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BUCKETS, seconds * 1000)] += 1
+        self.total += seconds
+
+    def as_dict(self):
+        buckets = collections.OrderedDict(
+            ('le_%d' % bound, n) for bound, n in zip(self.BUCKETS, self.counts))
+        buckets['inf'] = self.counts[-1]
+        return {'count': sum(self.counts), 'ms_total': self.total * 1000,
+            'buckets': buckets}
+
+# Most boxes whose latency histograms are kept.
+BOX_METRICS = int(os.environ.get('DUMPTRUCK_WEB_BOX_METRICS', 1024))
+
+class Stats(object):
+    """Latency histograms for the requests this process has handled:
+    overall per box and per method, and for each phase of each method.
+    Only the *max_boxes* boxes most recently sent requests have their
+    histograms kept.
+
+    *sources* maps names to functions giving more statistics to report
+    under those names, such as a server's queues.
+    """
+    def __init__(self, max_boxes=BOX_METRICS):
+        self.max_boxes = max_boxes
+        self._lock = threading.Lock()
+        self.sources = {}
+        self.histograms = {
+            # Least recently used first.
+            'box': collections.OrderedDict(),
+            'method': collections.defaultdict(Histogram),
+            'phase': collections.defaultdict(Histogram),
+        }
+
+    def record(self, timer, code, size):
+        """Record a finished request, which sent *size* bytes of body."""
+        elapsed = time.time() - timer.started
+        with self._lock:
+            if timer.method is not None:
+                self.histograms['method'][timer.method].add(elapsed)
+                for phase, seconds in timer.phases.items():
+                    self.histograms['phase'][timer.method + '.' + phase].add(seconds)
+            if timer.box is not None:
+                boxes = self.histograms['box']
+                histogram = boxes.pop(timer.box, None) or Histogram()
+                boxes[timer.box] = histogram
+                histogram.add(elapsed)
+                while len(boxes) > self.max_boxes:
+                    boxes.popitem(last=False)
+        with _counters_lock:
+            COUNTERS['requests'] += 1
+            COUNTERS['status.%d' % code] += 1
+            COUNTERS['bytes'] += size
+
+    def as_dict(self):
+        with self._lock:
+            latency = dict((kind, dict((name, h.as_dict()) for name, h in histograms.items()))
+                for kind, histograms in self.histograms.items())
+        with _counters_lock:
+            counters = dict(COUNTERS)
+        result = {'counters': counters, 'latency': latency}
+        for name, source in self.sources.items():
+            result[name] = source()
+        return result
+
+STATS = Stats()
+
+def _recorded(body, timer, code):
+    size = 0
+    try:
+        for chunk in body:
+            size += len(chunk)
+            yield chunk
+    finally:
+        STATS.record(timer, code, size)
+        SLOWLOG.record(timer, code, size)
+
+def finish(response, environ, timer):
+    """Prepare *response* to be sent: add the Server-Timing header,
+    compress it as the client allows, and record it in STATS once the
+    body has been sent.
+    """
+    if timer.phases:
+        response.headers = list(response.headers) + [('Server-Timing', timer.header())]
+    response = compress_response(response, environ.get('HTTP_ACCEPT_ENCODING'))
+    response.body = _recorded(response.body, timer, response.code)
+    return response
 
 class QueryError(Exception):
     """Exception during query processing."""
@@ -41,34 +362,39 @@ class QueryError(Exception):
         self.code = code
         super(QueryError, self).__init__(msg, **k)
 
+# What _authorizer_readonly allows, worked out once rather than on each
+# of the many calls SQLite makes while preparing a statement.
+# codes: http://www.sqlite.org/c3ref/c_alter_table.html
+_READONLY_ACTIONS = frozenset([
+    sqlite3.SQLITE_SELECT,
+    sqlite3.SQLITE_READ,
+    sqlite3.SQLITE_DETACH,
+    # 31=SQLITE_FUNCTION missing from library.
+    31,
+])
+_READONLY_PRAGMAS = frozenset([
+    "table_info",
+    "index_list",
+    "index_info",
+    "page_size",
+    "synchronous",
+])
+# These may be read but not set.
+_READ_ONLY_PRAGMAS = frozenset(["schema_version", "data_version"])
+
 def _authorizer_readonly(action_code, tname, cname, sql_location, trigger):
     """SQLite callback that we use to prohibit any SQL commands that could change a
     database; effectively making it readonly.
 
     Copied from scraperwiki.com sources.
     """
-
-    readonlyops = [
-        sqlite3.SQLITE_SELECT,
-        sqlite3.SQLITE_READ,
-        sqlite3.SQLITE_DETACH,
-
-        # 31=SQLITE_FUNCTION missing from library.
-        # codes: http://www.sqlite.org/c3ref/c_alter_table.html
-        31,
-    ]
-    if action_code in readonlyops:
+    if action_code in _READONLY_ACTIONS:
         return sqlite3.SQLITE_OK
 
     if action_code == sqlite3.SQLITE_PRAGMA:
-        tnames_ok = {
-            "table_info",
-            "index_list",
-            "index_info",
-            "page_size",
-            "synchronous"
-        }
-        if tname in tnames_ok:
+        if tname in _READONLY_PRAGMAS:
+            return sqlite3.SQLITE_OK
+        if tname in _READ_ONLY_PRAGMAS and cname is None:
             return sqlite3.SQLITE_OK
 
     # SQLite FTS (full text search) requires this permission even when reading,
@@ -86,13 +412,88 @@ class NotOK(Exception):
         self.code = code
         self.body = body
 
+def _uri_filenames():
+    """Whether SQLite takes file: URIs as filenames.  Python 2's sqlite3
+    has no uri= argument, so this needs SQLite built with
+    SQLITE_USE_URI, as Debian's and most others are.
+    """
+    connection = sqlite3.connect(':memory:')
+    try:
+        return (u'USE_URI',) in connection.execute('PRAGMA compile_options').fetchall()
+    finally:
+        connection.close()
+
+URI_FILENAMES = _uri_filenames()
+
+def _pragma_setting(name, default):
+    value = os.environ.get('DUMPTRUCK_WEB_' + name.upper(), default)
+    if name == 'temp_store':
+        if value.lower() not in ('default', 'file', 'memory', '0', '1', '2'):
+            raise ValueError('DUMPTRUCK_WEB_TEMP_STORE should be default, file or memory')
+        return value.lower()
+    return int(value)
+
+# PRAGMAs set on every connection before the authorizer, which would
+# deny them, is installed.  Memory mapping lets big scans read pages
+# without a read() call for each one.
+PRAGMAS = collections.OrderedDict([
+    ('mmap_size', _pragma_setting('mmap_size', 256 * 1024 * 1024)),
+    ('cache_size', _pragma_setting('cache_size', -8192)),
+    ('temp_store', _pragma_setting('temp_store', 'default')),
+])
+
+def frozen(dbname):
+    """Whether the database *dbname* is frozen: its owner has said that
+    nobody will write to it again, by creating *dbname*-frozen, and it
+    has no rollback journal or write-ahead log.  Frozen databases are
+    opened with immutable=1, so SQLite doesn't lock them or check them
+    for changes.
+
+    The file's mode isn't enough to go on: a writer that opened it
+    before chmod a-w can still write to it, and SQLite won't roll back
+    a hot journal in a database opened with immutable=1.
+    """
+    if not os.path.isfile(dbname + '-frozen') or os.path.exists(dbname + '-journal'):
+        return False
+    wal = file_identity(dbname + '-wal')
+    return wal is None or wal[2] == 0
+
+def database_uri(dbname, immutable=False):
+    """A file: URI opening *dbname* read-only, or just *dbname* if
+    SQLite doesn't take URIs.
+    """
+    if not URI_FILENAMES:
+        return dbname
+    path = os.path.abspath(dbname)
+    if isinstance(path, unicode):
+        path = path.encode('utf-8')
+    uri = 'file:%s?mode=ro' % urllib.quote(path)
+    if immutable:
+        uri += '&immutable=1'
+    return uri
+
 def open_dumptruck(dbname):
     """Returns read-only dumptruck object, or raises an Exception.
+
+    The database is opened read-only with database_uri, tuned with
+    PRAGMAS, and then only allowed to read by _authorizer_readonly,
+    through its StatementCache's authorizer.
+    Queries should be run through its *statements*, a StatementCache.
     """
     if os.path.isfile(dbname):
         # Check for the database file
         try:
-            dt = dumptruck.DumpTruck(dbname, adapt_and_convert=False)
+            uri = database_uri(dbname, immutable=frozen(dbname))
+            dt = dumptruck.DumpTruck(uri, adapt_and_convert=False)
+            if STATEMENT_CACHE_SIZE != SQLITE3_CACHED_STATEMENTS:
+                # DumpTruck can't be asked for another size.
+                dt.connection.close()
+                dt.connection = sqlite3.connect(uri, detect_types=sqlite3.PARSE_DECLTYPES,
+                    timeout=5, cached_statements=STATEMENT_CACHE_SIZE)
+                dt.cursor = dt.connection.cursor()
+            dt.statements = StatementCache(STATEMENT_CACHE_SIZE)
+            for name, value in PRAGMAS.items():
+                dt.statements.unauthorized('PRAGMA %s = %s' % (name, value), dt.connection)
         except sqlite3.OperationalError, e:
             error = e.message
             if e.message == 'unable to open database file':
@@ -112,39 +513,715 @@ def open_dumptruck(dbname):
         code = 404
         raise NotOK(code, msg)
 
-    dt.connection.set_authorizer(_authorizer_readonly)
+    dt.connection.set_authorizer(dt.statements.authorizer)
     return dt
 
-def execute_query(sql, dbname):
+# How many prepared statements sqlite3 keeps for each connection by
+# default, and how many we ask it to keep.
+SQLITE3_CACHED_STATEMENTS = 100
+STATEMENT_CACHE_SIZE = int(os.environ.get('DUMPTRUCK_WEB_STATEMENT_CACHE_SIZE',
+    SQLITE3_CACHED_STATEMENTS))
+
+class StatementCache(object):
+    """Counts for one connection how often a query is found in the cache
+    of prepared statements sqlite3 keeps for it, keyed by SQL text, and
+    remembers queries that were not authorized.
+
+    sqlite3 doesn't say what is in its cache, so the *size* most
+    recently run texts stand in for it.  A query known to be denied is
+    refused without being prepared again.
+
+    *authorizer* should be the connection's authorizer.  It is never
+    changed, since SQLite throws away every prepared statement when it
+    is; instead it lets anything through while *unauthorized* runs a
+    statement.  Queries with the same text are refused, as sqlite3 would
+    otherwise reuse that statement for them.
+    """
+    def __init__(self, size=STATEMENT_CACHE_SIZE):
+        self.size = size
+        self.trusted = False
+        self.hits = 0
+        self.misses = 0
+        self.refused = 0
+        self._recent = collections.OrderedDict()
+        self._denied = collections.OrderedDict()
+        self._reserved = set()
+
+    def execute(self, cursor, sql, params=()):
+        """Run *sql* on *cursor*, raising sqlite3.DatabaseError("not
+        authorized") straight away if it is known to be denied.
+        """
+        if sql in self._reserved or sql in self._denied:
+            self.refused += 1
+            count('statements.refused')
+            raise sqlite3.DatabaseError('not authorized')
+        if self._recent.pop(sql, None) is None:
+            self.misses += 1
+            count('statements.miss')
+        else:
+            self.hits += 1
+            count('statements.hit')
+        try:
+            result = cursor.execute(sql, params)
+        except sqlite3.DatabaseError, e:
+            if e.message == 'not authorized':
+                self._denied[sql] = True
+                while len(self._denied) > self.size:
+                    self._denied.popitem(last=False)
+            raise
+        self._recent[sql] = True
+        while len(self._recent) > self.size:
+            self._recent.popitem(last=False)
+        return result
+
+    def authorizer(self, *args):
+        if self.trusted:
+            return sqlite3.SQLITE_OK
+        return _authorizer_readonly(*args)
+
+    def unauthorized(self, sql, connection):
+        """Run *sql* on *connection* whatever _authorizer_readonly
+        allows, and never let a query use it.
+        """
+        self._reserved.add(sql)
+        self.trusted = True
+        try:
+            return connection.execute(sql)
+        finally:
+            self.trusted = False
+
+    def as_dict(self):
+        return {'size': self.size, 'cached': len(self._recent), 'denied': len(self._denied),
+            'hits': self.hits, 'misses': self.misses, 'refused': self.refused}
+
+def file_identity(dbname):
+    """Return a tuple that changes whenever the file *dbname* is
+    replaced, written to or has its permissions changed; None if there
+    is no such file.
+    """
+    try:
+        st = os.stat(dbname)
+    except OSError:
+        return None
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime, st.st_ctime)
+
+def _close(dt):
+    """Close *dt*.  If it belongs to another thread sqlite3 won't let us,
+    and it is left to be closed when it is garbage collected.
+    """
+    try:
+        dt.close()
+    except sqlite3.ProgrammingError:
+        pass
+
+def database_identity(dbname):
+    """Like file_identity, but also covers the database's write-ahead
+    log, which changes without the database file itself changing.
+    """
+    return file_identity(dbname), file_identity(dbname + '-wal')
+
+class ConnectionPool(object):
+    """A bounded LRU cache of the read-only dumptruck objects made by
+    open_dumptruck, keyed by database path.
+
+    A long-lived worker (see *application*) uses this to avoid opening
+    the database on every request.  Each thread may have up to *maxsize*
+    handles, so a server's worker threads don't push each other's
+    handles out.  Handles are dropped when they have
+    been idle for more than *idle_timeout* seconds, or when the
+    database file's identity (inode, size, mtime, ctime) has changed
+    since they were opened.
+
+    sqlite3 connections may only be used in the thread that made them,
+    so each thread gets its own handles.
+    """
+    def __init__(self, maxsize=16, idle_timeout=300):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        # (thread, dbname) -> (identity, last_used, dt), least recently
+        # used first.
+        self._entries = collections.OrderedDict()
+
+    def get(self, dbname):
+        """Return a read-only dumptruck for *dbname*, reusing a pooled
+        one if it is still valid.  Raises NotOK like open_dumptruck.
+        """
+        identity = file_identity(dbname)
+        key = (thread.get_ident(), dbname)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            old_identity, last_used, dt = entry
+            if (identity is not None and old_identity == identity and
+                    now - last_used <= self.idle_timeout):
+                with self._lock:
+                    self._entries[key] = (identity, now, dt)
+                # In case a streamed query was abandoned with its
+                # Budget still in force.
+                dt.connection.set_progress_handler(None, 0)
+                return dt
+            _close(dt)
+
+        dt = open_dumptruck(dbname)
+        with self._lock:
+            self._entries[key] = (identity, now, dt)
+            stale = self._evict(now, key[0])
+        for old in stale:
+            _close(old)
+        return dt
+
+    def _evict(self, now, thread_id):
+        """Remove idle entries and the thread *thread_id*'s entries
+        beyond *maxsize*, returning the dumptruck objects that should be
+        closed.  Call with the lock held.
+        """
+        stale = []
+        for key, (identity, last_used, dt) in self._entries.items():
+            if now - last_used > self.idle_timeout:
+                del self._entries[key]
+                stale.append(dt)
+        mine = [key for key in self._entries if key[0] == thread_id]
+        for key in mine[:max(len(mine) - self.maxsize, 0)]:
+            stale.append(self._entries.pop(key)[2])
+        return stale
+
+    def clear(self):
+        """Drop every pooled handle."""
+        with self._lock:
+            entries = self._entries.values()
+            self._entries.clear()
+        for identity, last_used, dt in entries:
+            _close(dt)
+
+    def statements(self):
+        """The StatementCache counters of each pooled handle."""
+        with self._lock:
+            entries = self._entries.items()
+        return [dict(dt.statements.as_dict(), database=dbname, thread=thread_id)
+            for (thread_id, dbname), (identity, last_used, dt) in entries]
+
+    def __len__(self):
+        return len(self._entries)
+
+CONNECTIONS = ConnectionPool(
+    maxsize=int(os.environ.get('DUMPTRUCK_WEB_POOL_SIZE', 16)),
+    idle_timeout=float(os.environ.get('DUMPTRUCK_WEB_POOL_IDLE', 300)))
+STATS.sources['statements'] = CONNECTIONS.statements
+
+def error_for_exception(e, meter=None):
+    """Return the HTTP status code and error message for an exception
+    raised while executing a query, whose Meter is *meter*.
+    """
+    if meter is not None and meter.exceeded:
+        return 503, u'Query interrupted: ' + meter.exceeded
+    if isinstance(e, sqlite3.OperationalError):
+        return 400, u'SQL error: ' + e.message
+    if isinstance(e, sqlite3.DatabaseError):
+        if e.message == u"not authorized":
+            # Writes are not authorized.
+            return 403, u'Database error: ' + e.message
+        return 500, u'Database error: ' + e.message
+    return 500, u'Error: ' + e.message
+
+# The progress handler that enforces a Budget is called after this many
+# SQLite virtual machine instructions.
+PROGRESS_INTERVAL = 1000
+
+class Budget(object):
+    """Limits on the work one query may do: *seconds* of wall-clock
+    time and *steps* SQLite virtual machine instructions.  0 means
+    no limit.
+    """
+    def __init__(self, seconds=0, steps=0):
+        self.seconds = seconds
+        self.steps = steps
+
+    def start(self, connection):
+        """Enforce this budget on *connection* from now until the next
+        call, returning the Meter that does so.
+        """
+        meter = Meter(self)
+        if self.seconds or self.steps:
+            connection.set_progress_handler(meter, PROGRESS_INTERVAL)
+        else:
+            connection.set_progress_handler(None, 0)
+        return meter
+
+class Meter(object):
+    """SQLite progress handler that interrupts a query once it has
+    used up its Budget.  *exceeded* then says which limit it hit.
+
+    Time is only counted while the meter is running, so that a streamed
+    query isn't charged for the time the client takes to read each
+    batch; see *pause*.
+    """
+    def __init__(self, budget):
+        self.budget = budget
+        # When the meter was last started, or None while it is paused.
+        self.started = time.time()
+        self.spent = 0.0
+        self.steps = 0
+        self.exceeded = None
+
+    def pause(self):
+        """Stop counting time until *resume* is called."""
+        if self.started is not None:
+            self.spent += time.time() - self.started
+            self.started = None
+
+    def resume(self):
+        if self.started is None:
+            self.started = time.time()
+
+    def seconds(self):
+        """The time counted so far."""
+        if self.started is None:
+            return self.spent
+        return self.spent + time.time() - self.started
+
+    def __call__(self):
+        self.steps += PROGRESS_INTERVAL
+        budget = self.budget
+        if budget.steps and self.steps > budget.steps:
+            self.exceeded = u'more than %d steps' % budget.steps
+        elif budget.seconds and self.seconds() > budget.seconds:
+            self.exceeded = u'more than %g seconds' % budget.seconds
+        else:
+            return 0
+        count('interrupted')
+        return 1
+
+def load_budgets(path):
+    """Read per-box budgets from the JSON file *path*, which looks like
+    {"box": {"seconds": 60, "steps": 100000000}}.
+    """
+    if not path:
+        return {}
+    with open(path) as f:
+        budgets = json.load(f)
+    return dict((box, Budget(**limits)) for box, limits in budgets.items())
+
+DEFAULT_BUDGET = Budget(
+    seconds=float(os.environ.get('DUMPTRUCK_WEB_TIME_LIMIT', 30)),
+    steps=int(os.environ.get('DUMPTRUCK_WEB_STEP_LIMIT', 0)))
+BUDGETS = load_budgets(os.environ.get('DUMPTRUCK_WEB_BUDGETS'))
+
+def budget_for(box):
+    """The Budget for queries on *box*."""
+    return BUDGETS.get(box, DEFAULT_BUDGET)
+
+def execute_query(sql, dbname, budget=None, timer=None):
     """
     Given an SQL query and a SQLite database name, return an HTTP status code
     and the response from the database.
+
+    The query is interrupted if it goes over *budget* (by default
+    DEFAULT_BUDGET), giving a 503 status code.  Opening the database and
+    running the query are timed as phases of *timer*.
     """
+    timer = timer or Timer()
+    code, rows = stream_query(sql, dbname, budget=budget, timer=timer)
+    if not isinstance(rows, Rows):
+        return code, rows
     try:
-        dt = open_dumptruck(dbname)
+        with timer.phase('query'):
+            return 200, rows.dicts()
+    except Exception, e:
+        return error_for_exception(e, rows.meter)
+
+def _transaction_control(dt, sql):
+    """Run *sql*, a BEGIN or ROLLBACK, on *dt*, whose read-only
+    authorizer would otherwise deny it.  Queries themselves still
+    can't start or end transactions.
+    """
+    dt.statements.unauthorized(sql, dt.connection)
+
+@contextlib.contextmanager
+def read_transaction(dt):
+    """Run the block in one read transaction on *dt*, so that all the
+    queries in it see the same snapshot of the database.
+    """
+    connection = dt.connection
+    isolation_level = connection.isolation_level
+    # Otherwise sqlite3 commits before any statement that doesn't start
+    # with SELECT, such as WITH or PRAGMA, ending the transaction.
+    connection.isolation_level = None
+    _transaction_control(dt, 'BEGIN')
+    try:
+        yield
+    finally:
+        _transaction_control(dt, 'ROLLBACK')
+        connection.isolation_level = isolation_level
+
+def execute_batch(queries, dt, budget=None):
+    """Run each of *queries* on the dumptruck object *dt* in one read
+    transaction, returning a list of (status code, data) pairs like
+    execute_query's.
+
+    *budget* (by default DEFAULT_BUDGET) covers the whole batch; once it
+    is used up the remaining queries aren't run and get a 503 status
+    code too.
+    """
+    results = []
+    with read_transaction(dt):
+        meter = (budget or DEFAULT_BUDGET).start(dt.connection)
+        try:
+            for sql in queries:
+                if meter.exceeded:
+                    results.append((503, u'Query interrupted: ' + meter.exceeded))
+                    continue
+                try:
+                    # Not dt.execute, which would commit, ending the
+                    # transaction.
+                    cursor = dt.connection.cursor()
+                    try:
+                        dt.statements.execute(cursor, sql)
+                        rows = cursor.fetchall()
+                        data = None
+                        if cursor.description is not None:
+                            columns = [d[0].decode('utf-8') for d in cursor.description]
+                            data = [collections.OrderedDict(zip(columns, row)) for row in rows]
+                    finally:
+                        cursor.close()
+                    results.append((200, data))
+                except Exception, e:
+                    results.append(error_for_exception(e, meter))
+        finally:
+            dt.connection.set_progress_handler(None, 0)
+    return results
+
+# Number of rows fetched from SQLite at a time when streaming.
+BATCH_SIZE = 500
+
+class Rows(object):
+    """The result of a query, fetched from its cursor in batches.
+
+    *columns* is the list of column names, or None if the statement
+    returns no rows at all.  The first batch is fetched when the object
+    is made, so that errors from the start of the query are raised
+    there, while the status code can still be changed.  Iterating gives
+    lists of row tuples.  *meter* is the Meter enforcing the query's
+    budget, if any; it is paused between batches.
+    """
+    def __init__(self, cursor, batch_size=BATCH_SIZE, timer=None, meter=None):
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.timer = timer
+        self.meter = meter
+        self.count = 0
+        if cursor.description is None:
+            self.columns = None
+        else:
+            self.columns = [d[0].decode('utf-8') for d in cursor.description]
+        self._first = cursor.fetchmany(batch_size)
+        if meter is not None:
+            meter.pause()
+
+    def __iter__(self):
+        batch, self._first = self._first, None
+        try:
+            while batch:
+                self.count += len(batch)
+                yield batch
+                # The budget only covers the time spent reading rows,
+                # not the time the client takes to read each batch.
+                if self.meter is not None:
+                    self.meter.resume()
+                batch = self.cursor.fetchmany(self.batch_size)
+                if self.meter is not None:
+                    self.meter.pause()
+        finally:
+            self.close()
+            count('rows', self.count)
+            if self.timer is not None:
+                self.timer.rows = self.count
+
+    def dicts(self):
+        """All the rows as a list of dicts, the way DumpTruck.execute
+        gives them, or None if the statement returns no rows.
+        """
+        if self.columns is None:
+            list(self)
+            return None
+        columns = self.columns
+        return [collections.OrderedDict(zip(columns, row)) for batch in self for row in batch]
+
+    def close(self):
+        """Stop fetching rows, without iterating."""
+        self.cursor.close()
+        self.cursor.connection.set_progress_handler(None, 0)
+
+def stream_query(sql, dbname, budget=None, timer=None, batch_size=BATCH_SIZE, params=()):
+    """Like execute_query, but on success the data is a Rows object
+    rather than a list of dicts, so the result never has to be held in
+    memory all at once.  The budget covers fetching all the rows; the
+    query phase of *timer* only covers fetching the first batch.
+    *params* are bound to the query's placeholders.
+    """
+    timer = timer or Timer()
+    try:
+        with timer.phase('open'):
+            dt = CONNECTIONS.get(dbname)
     except NotOK as e:
         return e.code, e.body
 
+    meter = (budget or DEFAULT_BUDGET).start(dt.connection)
+    cursor = dt.connection.cursor()
     try:
-        data = dt.execute(sql)
-        code = 200
-    except sqlite3.OperationalError, e:
-        data = u'SQL error: ' + e.message
-        code = 400
-    except sqlite3.DatabaseError, e:
-        data = u'Database error: ' + e.message
-        if e.message == u"not authorized":
-            # Writes are not authorized.
-            code = 403
-        else:
-            code = 500
+        with timer.phase('query'):
+            dt.statements.execute(cursor, sql, params)
+            rows = Rows(cursor, batch_size, timer, meter)
     except Exception, e:
-        data = u'Error: ' + e.message
-        code = 500
+        cursor.close()
+        dt.connection.set_progress_handler(None, 0)
+        return error_for_exception(e, meter)
+
+    return 200, rows
+
+# How json.dumps encodes the types of value SQLite gives, or None for
+# types which need the general encoder (floats, because of NaN and
+# infinity, and blobs, which are an error).
+_JSON_VALUE = {
+    type(None): lambda value: 'null',
+    int: int.__repr__,
+    long: long.__str__,
+    unicode: json.encoder.encode_basestring_ascii,
+    str: json.encoder.encode_basestring_ascii,
+}
+
+def row_encoder(columns):
+    """Return a function that encodes a row tuple as the same JSON that
+    json.dumps(collections.OrderedDict(zip(*columns*, row))) gives,
+    without making a dict for every row.
+    """
+    # Like a dict, a repeated column takes the first one's place and
+    # the last one's value.
+    positions = collections.OrderedDict()
+    for i, column in enumerate(columns):
+        positions[column] = i
+    template = '{%s}' % ', '.join(
+        json.dumps(column).replace('%', '%%') + ': %s' for column in positions)
+    indexes = positions.values()
+    if indexes == range(len(columns)):
+        indexes = None
+    encode = json.JSONEncoder().encode
+    encoder_for = _JSON_VALUE.get
+    def encode_row(row):
+        if indexes is not None:
+            row = [row[i] for i in indexes]
+        return template % tuple([(encoder_for(type(value)) or encode)(value) for value in row])
+    return encode_row
+
+def json_chunks(rows):
+    """Encode *rows* as the same JSON that execute_query's result
+    gives, as a series of strings ending with a newline.
+
+    An error part way through the rows is raised from the generator;
+    the status has gone by then, so the server should drop the
+    connection and the client sees truncated JSON.
+    """
+    if rows.columns is None:
+        yield 'null\n'
+        return
+    encode_row = row_encoder(rows.columns)
+    separator = '['
+    for batch in rows:
+        yield separator + ', '.join([encode_row(row) for row in batch])
+        separator = ', '
+    if separator == '[':
+        yield '[]\n'
+    else:
+        yield ']\n'
+
+def columns_chunks(rows):
+    """Encode *rows* as {"columns": [...], "rows": [[...], ...]}, so
+    that the column names are only sent once.
+    """
+    yield '{"columns": %s, "rows": [' % json.dumps(rows.columns or [])
+    separator = ''
+    for batch in rows:
+        yield separator + ', '.join(json.dumps(row) for row in batch)
+        separator = ', '
+    yield ']}\n'
+
+def ndjson_chunks(rows):
+    """Encode *rows* as newline delimited JSON, one object per row."""
+    if rows.columns is None:
+        return
+    encode_row = row_encoder(rows.columns)
+    for batch in rows:
+        yield ''.join([encode_row(row) + '\n' for row in batch])
+
+def _csv_value(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return value
+
+def csv_chunks(rows):
+    """Encode *rows* as RFC 4180 CSV with a header line."""
+    if rows.columns is None:
+        return
+    buf = cStringIO.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow([_csv_value(column) for column in rows.columns])
+    for batch in rows:
+        for row in batch:
+            writer.writerow([_csv_value(value) for value in row])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+# format= parameter -> (Content-Type, encoder for a Rows object)
+FORMATS = {
+    'json': (CONTENT_TYPE, json_chunks),
+    'columns': (CONTENT_TYPE, columns_chunks),
+    'ndjson': ('application/x-ndjson; charset=utf-8', ndjson_chunks),
+    'csv': ('text/csv; charset=utf-8; header=present', csv_chunks),
+}
 
-    return code, data
+# Largest page_size= the sql method accepts.
+MAX_PAGE_SIZE = int(os.environ.get('DUMPTRUCK_WEB_MAX_PAGE_SIZE', 10000))
 
-def sql(boxhome=os.path.join('/', '%s/home' % os.environ['CO_STORAGE_DIR'])):
+class Page(object):
+    """Keyset pagination of the query *sql*: a page of up to *size*
+    rows ordered by the result columns *keys*, coming after the row
+    whose keys had the values *after*, or the first page if that is
+    None.  A key starting with - is in descending order.  The last key
+    should be unique, or rows with the same keys may be skipped.
+
+    Each page is found by seeking past *after*, rather than by
+    skipping rows with OFFSET, so later pages are as quick to get as
+    the first one when SQLite can use an index (or the rowid) for the
+    keys.
+    """
+    def __init__(self, sql, size, keys=('rowid',), after=None):
+        self.sql = sql
+        self.size = size
+        self.keys = list(keys)
+        self.after = after
+
+    @classmethod
+    def from_form(cls, sql, form):
+        """The Page asked for by the page_size=, order_by= and next=
+        parameters in *form*, or None if there is no page_size=.
+        """
+        sizes = form.getlist('page_size')
+        if not sizes:
+            if form.getlist('next') or form.getlist('order_by'):
+                raise QueryError('Error: next= and order_by= need a page_size= parameter',
+                    code=400)
+            return None
+        try:
+            if len(sizes) != 1:
+                raise ValueError
+            size = int(sizes[0])
+            if not 0 < size <= MAX_PAGE_SIZE:
+                raise ValueError
+        except ValueError:
+            raise QueryError('Error: page_size should be a number from 1 to %d' % MAX_PAGE_SIZE,
+                code=400)
+        keys = form.getlist('order_by') or ['rowid']
+        if not all(key.lstrip('-') for key in keys):
+            raise QueryError('Error: order_by= should name a column', code=400)
+        page = cls(sql, size, keys)
+        tokens = form.getlist('next')
+        if len(tokens) > 1:
+            raise QueryError('Error: at most one next= parameter should be specified', code=400)
+        if tokens:
+            page.after = page.decode(tokens[0])
+        return page
+
+    def _digest(self):
+        """Ties cursors to this query and these keys."""
+        return hashlib.sha1(json.dumps([normalize_sql(self.sql), self.keys])).hexdigest()[:16]
+
+    def encode(self, values):
+        """The opaque next= cursor for the page after a row whose keys
+        have *values*.
+        """
+        if not all(value is None or isinstance(value, (int, long, float, unicode))
+                for value in values):
+            raise QueryError('Error: order_by= columns should be numbers or text', code=400)
+        return base64.urlsafe_b64encode(json.dumps([self._digest(), values]))
+
+    def decode(self, token):
+        """The key values in the next= cursor *token*.  Only cursors made
+        by encode for the same query and keys are accepted, and the
+        values are only ever bound as parameters.
+        """
+        try:
+            digest, values = json.loads(base64.urlsafe_b64decode(str(token)))
+        except (TypeError, ValueError):
+            raise QueryError('Error: invalid next= cursor', code=400)
+        if digest != self._digest() or not isinstance(values, list) or \
+                len(values) != len(self.keys) or \
+                not all(value is None or isinstance(value, (int, long, float, unicode))
+                    for value in values):
+            raise QueryError('Error: invalid next= cursor', code=400)
+        return values
+
+    def _after(self, key, value):
+        """SQL and parameters for *key* coming after *value*."""
+        column = _quote_identifier(key.lstrip('-'))
+        if key.startswith('-'):
+            # NULLs come last in descending order.
+            if value is None:
+                return '0', []
+            return '(%s < ? OR %s IS NULL)' % (column, column), [value]
+        if value is None:
+            return '%s IS NOT NULL' % column, []
+        return '%s > ?' % column, [value]
+
+    def _same(self, key, value):
+        column = _quote_identifier(key.lstrip('-'))
+        if value is None:
+            return '%s IS NULL' % column, []
+        return '%s = ?' % column, [value]
+
+    def query(self):
+        """The SQL and parameters that get this page, with one extra row
+        to tell whether there is another page.
+        """
+        sql = self.sql.strip().rstrip(';')
+        where, params = '', []
+        if self.after is not None:
+            alternatives = []
+            for i, key in enumerate(self.keys):
+                conditions = [self._same(k, v) for k, v in zip(self.keys[:i], self.after[:i])]
+                conditions.append(self._after(key, self.after[i]))
+                alternatives.append('(%s)' % ' AND '.join(c for c, p in conditions))
+                for c, p in conditions:
+                    params.extend(p)
+            where = ' WHERE ' + ' OR '.join(alternatives)
+        order = ', '.join(_quote_identifier(key.lstrip('-')) +
+            (' DESC' if key.startswith('-') else '') for key in self.keys)
+        # On their own lines, in case *sql* ends with a comment.
+        return 'SELECT * FROM (\n%s\n)%s ORDER BY %s LIMIT %d' % (
+            sql, where, order, self.size + 1), params
+
+    def next_cursor(self, rows):
+        """Take the extra row off the first batch of the Rows *rows* and
+        return the cursor for the next page, or None if this is the
+        last one.  *rows* should be fetched in batches of more than
+        *size*.
+        """
+        batch = rows._first
+        if len(batch) <= self.size:
+            return None
+        del batch[self.size:]
+        names = [column.lower() for column in rows.columns]
+        try:
+            indexes = [names.index(key.lstrip('-').lower()) for key in self.keys]
+        except ValueError:
+            raise QueryError('Error: the order_by= columns should be in the result', code=400)
+        return self.encode([batch[-1][i] for i in indexes])
+
+def sql(boxhome=BOXHOME, form=None):
     """
     Implements a CGI interface for SQL queries to boxes.
 
@@ -152,66 +1229,476 @@ def sql(boxhome=os.path.join('/', '%s/home' % os.environ['CO_STORAGE_DIR'])):
 
         q=SELECT+foo+FROM+bar&boxname=screwdriver
 
-    Currently, *q* and *boxname* are the only parameters.
+    *q* and *boxname* are required.  *format* is optional and
+    one of the keys of FORMATS; it defaults to json, a list of objects.
+    With *page_size* the result is paged (see Page), and the cursor
+    for the next page is sent as a Next-Cursor header.
     """
+    timer = Timer('sql')
+    response = sql_response(boxhome, form, timer=timer)
+    return finish(response, os.environ, timer).cgi()
 
+def sql_response(boxhome=BOXHOME, form=None, stream=False, environ=None, timer=None):
+    """The Response for an SQL query; see *sql*.  *form* is a
+    cgi.FieldStorage, read from the environment if not given.
+    *environ* holds the request's CGI variables, by default os.environ.
+    The phases of handling the request are timed with *timer*.
+
+    Rows are read with stream_query and encoded straight from their
+    tuples.  With *stream*, the body is a generator that reads them
+    from the database as it is iterated; otherwise the whole body is
+    encoded before returning.
+    """
+    if environ is None:
+        environ = os.environ
+    if form is None:
+        form = cgi.FieldStorage()
+    timer = timer or Timer()
     try:
-        sql,box = parse_query_string()
-        dbname = get_database_name(boxhome, box)
-        code,body = execute_query(sql, dbname)
+        with timer.phase('resolve'):
+            sql,box,format = parse_query_string(form)
+            page = Page.from_form(sql, form)
+            timer.sql = sql
+            dbname = get_database_name(boxhome, box)
+            timer.resolved(box, dbname)
     except QueryError as e:
-        code = e.code
-        body = e.message
-    body = json.dumps(body)
+        return Response(e.code, json.dumps(e.message) + '\n')
+
+    # Taken before running the query, so that a write while it runs
+    # makes the ETag and any cache entry invalid rather than stale.
+    identity = database_identity(dbname)
+    normalized = normalize_sql(sql)
+    paging = page and (page.size, page.keys, page.after)
+    etag = make_etag('sql', identity, normalized, format, paging)
+    response = not_modified(etag, environ)
+    if response is not None:
+        return response
+
+    if RESULT_CACHE.enabled:
+        key = (dbname, normalized, format, json.dumps(paging))
+        response = RESULT_CACHE.get(key, identity)
+        if response is not None:
+            return conditional(response, etag)
+
+    budget = budget_for(box)
+    if page is not None:
+        paged_sql, params = page.query()
+        code,body = stream_query(paged_sql, dbname, budget=budget, timer=timer,
+            batch_size=page.size + 1, params=params)
+    else:
+        code,body = stream_query(sql, dbname, budget=budget, timer=timer)
+    if isinstance(body, Rows):
+        content_type, encoder = FORMATS[format]
+        headers = [('Content-Type', content_type)]
+        if page is not None:
+            try:
+                cursor = page.next_cursor(body)
+            except QueryError as e:
+                body.close()
+                return Response(e.code, json.dumps(e.message) + '\n')
+            if cursor is not None:
+                headers.append(('Next-Cursor', cursor))
+        chunks = encoder(body)
+        if not stream:
+            # Encode the whole result now, so that an error part way
+            # through it still gets a status code.
+            try:
+                with timer.phase('encode'):
+                    chunks = ''.join(chunks)
+            except Exception, e:
+                code, error = error_for_exception(e, body.meter)
+                return Response(code, json.dumps(error) + '\n')
+        response = Response(code, chunks, headers)
+    else:
+        with timer.phase('encode'):
+            response = Response(code, json.dumps(body) + '\n')
+
+    if RESULT_CACHE.enabled and code == 200:
+        response.body = RESULT_CACHE.collect(key, identity, response.headers, response.body)
+    return conditional(response, etag)
+
+class ResultCache(object):
+    """Serialized sql response bodies, keyed by (database path,
+    normalized SQL, format).
+
+    An entry is only used while the database's identity (see
+    database_identity) is the same as when the query was run.  Entries
+    are evicted least recently used first to keep the total size under
+    *max_bytes*; bodies bigger than *max_entry_bytes* are never cached.
+    With *max_bytes* of 0 the cache is disabled.
+    """
+    def __init__(self, max_bytes=0, max_entry_bytes=1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = min(max_entry_bytes, max_bytes)
+        self.size = 0
+        self._lock = threading.Lock()
+        # key -> (identity, headers, body), least recently used first.
+        self._entries = collections.OrderedDict()
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def get(self, key, identity):
+        """Return a Response for *key* if there is a valid entry."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[0] != identity:
+                self.size -= len(entry[2])
+                return None
+            self._entries[key] = entry
+        return Response(200, entry[2], list(entry[1]))
+
+    def put(self, key, identity, headers, body):
+        if len(body) > self.max_entry_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.size -= len(old[2])
+            self._entries[key] = (identity, headers, body)
+            self.size += len(body)
+            while self.size > self.max_bytes:
+                old_key, old = self._entries.popitem(last=False)
+                self.size -= len(old[2])
+
+    def collect(self, key, identity, headers, body):
+        """Return a generator over the chunks of *body* which stores it
+        in the cache once it has all been sent, unless it turns out to
+        be too big.
+        """
+        chunks = []
+        size = 0
+        for chunk in body:
+            yield chunk
+            if chunks is not None:
+                size += len(chunk)
+                if size > self.max_entry_bytes:
+                    chunks = None
+                else:
+                    chunks.append(chunk)
+        if chunks is not None:
+            self.put(key, identity, list(headers), ''.join(chunks))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.size = 0
 
-    headers = headers_for_status(code)
-    return headers + '\n\n' + body + '\n'
+RESULT_CACHE = ResultCache(
+    max_bytes=int(os.environ.get('DUMPTRUCK_WEB_RESULT_CACHE_BYTES', 0)),
+    max_entry_bytes=int(os.environ.get('DUMPTRUCK_WEB_RESULT_CACHE_ENTRY_BYTES', 1024 * 1024)))
 
-def meta(boxhome=os.path.join('/', '%s/home' % os.environ['CO_STORAGE_DIR'])):
+def meta(boxhome=BOXHOME, form=None):
     """Implements a CGI interface for the meta information
     about SQL(ite) databases.
+
+    With more than one *box*, or a *box_glob* matching the names of
+    boxes, the answer is an object with the meta information of each
+    box under its name; see meta_response.
     """
-    form = cgi.FieldStorage()
-    boxs = form.getlist('box')
-    if len(boxs) != 1:
-        raise QueryError('Error: exactly one box= parameter should be specified', code=400)
-    box = boxs[0]
-    dbname = get_database_name(boxhome, box)
+    timer = Timer('meta')
+    response = meta_response(boxhome, form, timer=timer)
+    return finish(response, os.environ, timer).cgi()
+
+# Most boxes one meta request may ask about.
+MAX_META_BOXES = int(os.environ.get('DUMPTRUCK_WEB_MAX_META_BOXES', 1000))
+# Threads reading the meta information of boxes, shared by every
+# request in the process.
+META_THREADS = int(os.environ.get('DUMPTRUCK_WEB_META_THREADS', 8))
 
+NO_DATABASE = json.dumps({"databaseType": "none",
+    "table": {},
+    "grid": {}
+    })
+
+def database_meta(dbname, pooled=True):
+    """Return the status code and JSON meta information for *dbname*.
+    *pooled* is as for MetaCache.get.
+    """
     try:
-        dt = open_dumptruck(dbname)
-        res = {}
-        res['databaseType'] = 'sqlite3'
-        res['table'] = {}
-        res['grid'] = {}
-        for name, type in dt.tablesAndViews():
-            d = { "type": type }
-            d['columnNames'] = list(dt.column_names(name))
-            res['table'][name] = d
-        if '_grids' in res['table']:
-            code, grids = execute_query('SELECT * FROM _grids', dbname)
-            for grid in grids:
-                res['grid'][grid['checksum']] = grid
-        body = json.dumps(res)
-        code = 200
+        return 200, META_CACHE.get(dbname, pooled)
     except NotOK as e:
         if e.code == 404:
             # database not found is not an error for the meta endpoint
-            code = 200
-            body = json.dumps({"databaseType": "none",
-                "table": {},
-                "grid": {}
-                })
+            return 200, NO_DATABASE
+        return e.code, json.dumps(e.body)
+
+def glob_boxes(boxhome, pattern):
+    """Return the names of the boxes in *boxhome* matching the shell
+    style *pattern*, sorted.
+    """
+    if '/' in pattern:
+        raise QueryError('Error: box_glob= should not contain "/"', code=400)
+    try:
+        names = os.listdir(boxhome)
+    except OSError:
+        names = []
+    return sorted(name for name in fnmatch.filter(names, pattern)
+        if os.path.isdir(os.path.join(boxhome, name)))
+
+class ThreadPool(object):
+    """*threads* threads, shared by everything that submits jobs to
+    them, so that however many requests there are at once, no more
+    than *threads* jobs run.  The threads are started as they are
+    first needed, so that a worker process forked after this is made
+    gets its own.
+    """
+    def __init__(self, threads):
+        self.threads = threads
+        self._lock = threading.Condition()
+        self._jobs = collections.deque()
+        self._workers = []
+
+    def submit(self, function):
+        """Call *function* from one of the threads, once those submitted
+        before it have started.
+        """
+        with self._lock:
+            self._jobs.append(function)
+            if len(self._workers) < self.threads:
+                worker = threading.Thread(target=self._work, name='pool')
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
+            self._lock.notify()
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._jobs:
+                    self._lock.wait()
+                function = self._jobs.popleft()
+            try:
+                function()
+            except Exception:
+                traceback.print_exc()
+
+META_POOL = ThreadPool(META_THREADS)
+
+def imap_bounded(function, items, pool):
+    """Like itertools.imap, but calls *function* on *items* in the
+    threads of the ThreadPool *pool*, so the results may be worked out
+    ahead of being asked for.  At most pool.threads of *items* are
+    submitted at once, and each is only submitted once one before it is
+    done, so that the jobs of many calls take turns.  If the iterator is
+    closed early nothing more is submitted.  An exception raised by
+    *function* is raised again when its result is reached.
+    """
+    items = list(items)
+    results = {}
+    ready = threading.Condition()
+    pending = iter(enumerate(items))
+    stopped = []
+
+    def submit_next():
+        with ready:
+            if stopped:
+                return
+            try:
+                i, item = next(pending)
+            except StopIteration:
+                return
+        pool.submit(lambda: run(i, item))
+
+    def run(i, item):
+        try:
+            result = True, function(item)
+        except Exception:
+            result = False, sys.exc_info()
+        with ready:
+            results[i] = result
+            ready.notify_all()
+        submit_next()
+
+    for _ in range(min(pool.threads, len(items))):
+        submit_next()
+    try:
+        for i in range(len(items)):
+            with ready:
+                while i not in results:
+                    ready.wait()
+                ok, result = results.pop(i)
+            if not ok:
+                raise result[0], result[1], result[2]
+            yield result
+    finally:
+        with ready:
+            stopped.append(True)
+
+def meta_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the meta information; see *meta*.
+
+    For many boxes, each box's database is read by one of the META_POOL
+    threads, and the object is streamed in the order the boxes were
+    given (or sorted by name for *box_glob*).  A box that can't be read
+    gets {"status": code, "error": message} instead of its meta
+    information, and the request as a whole still succeeds.
+    """
+    if environ is None:
+        environ = os.environ
+    timer = timer or Timer()
+    if form is None:
+        form = cgi.FieldStorage()
+    boxs = form.getlist('box')
+    globs = form.getlist('box_glob')
+    if len(globs) > 1 or (globs and boxs):
+        raise QueryError('Error: give either box= parameters or one box_glob= parameter', code=400)
+    if not boxs and not globs:
+        raise QueryError('Error: exactly one box= parameter should be specified', code=400)
+    if len(boxs) == 1:
+        return single_meta_response(boxhome, boxs[0], environ, timer)
+
+    with timer.phase('resolve'):
+        if globs:
+            boxs = glob_boxes(boxhome, globs[0])
         else:
-            code = e.code
-            body = e.body
+            boxs = list(collections.OrderedDict.fromkeys(boxs))
+        if len(boxs) > MAX_META_BOXES:
+            raise QueryError('Error: at most %d boxes may be given' % MAX_META_BOXES, code=400)
+        resolved = []
+        for box in boxs:
+            try:
+                resolved.append((box, get_database_name(boxhome, box), None))
+            except QueryError as e:
+                resolved.append((box, None, (e.code, json.dumps(e.message))))
 
-    headers = headers_for_status(code)
-    return headers + '\n\n' + body + '\n'
+    etag = make_etag('meta', [(box, dbname and database_identity(dbname), error)
+        for box, dbname, error in resolved])
+    response = not_modified(etag, environ)
+    if response is not None:
+        return response
 
-def parse_query_string():
-    """Return sql,box as a pair.  Extracted from the CGI parameters."""
-    form = cgi.FieldStorage()
+    def box_meta(item):
+        box, dbname, error = item
+        if error is None:
+            try:
+                # Many boxes would push the sql method's connections out
+                # of CONNECTIONS, so these aren't pooled.
+                error = database_meta(dbname, pooled=False)
+            except Exception as e:
+                error = 500, json.dumps(u'Error: %s' % e)
+        code, body = error
+        if code != 200:
+            body = '{"status": %d, "error": %s}' % (code, body)
+        return '%s: %s' % (json.dumps(box), body)
+
+    def chunks():
+        yield '{'
+        with timer.phase('meta'):
+            for i, chunk in enumerate(imap_bounded(box_meta, resolved, META_POOL)):
+                yield (',\n' if i else '\n') + chunk
+        yield '\n}\n'
+
+    return conditional(Response(200, chunks()), etag)
+
+def single_meta_response(boxhome, box, environ, timer):
+    """The Response for the meta information of one box."""
+    with timer.phase('resolve'):
+        dbname = get_database_name(boxhome, box)
+        timer.resolved(box, dbname)
+
+    etag = make_etag('meta', database_identity(dbname))
+    response = not_modified(etag, environ)
+    if response is not None:
+        return response
+
+    with timer.phase('meta'):
+        code, body = database_meta(dbname)
+    return conditional(Response(code, body + '\n'), etag)
+
+def build_meta(dt, dbname):
+    """Return the meta information for the database *dbname*, open as
+    *dt*, as a dict.
+    """
+    res = {}
+    res['databaseType'] = 'sqlite3'
+    res['table'] = {}
+    res['grid'] = {}
+    for name, type in dt.tablesAndViews():
+        d = { "type": type }
+        d['columnNames'] = list(dt.column_names(name))
+        res['table'][name] = d
+    if '_grids' in res['table']:
+        # Read through *dt* rather than execute_query, which would use
+        # CONNECTIONS.
+        cursor = dt.connection.cursor()
+        meter = DEFAULT_BUDGET.start(dt.connection)
+        cursor.execute('SELECT * FROM _grids')
+        for grid in Rows(cursor, meter=meter).dicts():
+            res['grid'][grid['checksum']] = grid
+    return res
+
+def schema_version(dt):
+    """Return something that changes whenever the meta information for
+    *dt* might: the schema version and a digest of the _grids table.
+    """
+    version = dt.execute('PRAGMA schema_version')[0]['schema_version']
+    try:
+        grids = dt.execute('SELECT * FROM _grids')
+    except sqlite3.OperationalError:
+        grids = None
+    return version, hashlib.sha1(json.dumps(grids)).hexdigest()
+
+class MetaCache(object):
+    """The serialized meta information for recently used databases.
+
+    An entry is used without running any SQL at all while the database
+    file's identity (see database_identity) is unchanged.  When it has
+    changed, the entry is still used if schema_version gives the same
+    answer for the same file, so writing rows doesn't make us read
+    sqlite_master and every table's table_info again.
+    """
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # dbname -> (identity, version, body), least recently used first.
+        self._entries = collections.OrderedDict()
+
+    def get(self, dbname, pooled=True):
+        """Return the meta information for *dbname* as JSON.  Raises
+        NotOK if the database can't be opened.  The connection used,
+        if one is needed, comes from CONNECTIONS if *pooled*, and is
+        otherwise closed again.
+        """
+        identity = database_identity(dbname)
+        with self._lock:
+            entry = self._entries.pop(dbname, None)
+            if entry is not None and entry[0] == identity:
+                self._entries[dbname] = entry
+                return entry[2]
+
+        dt = CONNECTIONS.get(dbname) if pooled else open_dumptruck(dbname)
+        try:
+            # A different file may happen to have the same schema_version.
+            version = identity[0] and identity[0][:2], schema_version(dt)
+            if entry is not None and entry[1] == version:
+                body = entry[2]
+            else:
+                body = json.dumps(build_meta(dt, dbname))
+        finally:
+            if not pooled:
+                _close(dt)
+        with self._lock:
+            self._entries[dbname] = (identity, version, body)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return body
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+META_CACHE = MetaCache(int(os.environ.get('DUMPTRUCK_WEB_META_CACHE_SIZE', 256)))
+
+def parse_query_string(form=None):
+    """Return sql,box,format as a triple.  Extracted from the CGI
+    parameters, or from *form* if given.
+    """
+    if form is None:
+        form = cgi.FieldStorage()
     qs = form.getlist('q')
     boxs = form.getlist('box')
     if len(qs) != 1:
@@ -219,9 +1706,171 @@ def parse_query_string():
     if len(boxs) != 1:
         raise QueryError('Error: exactly one box= parameter should be specified', code=400)
 
+    formats = form.getlist('format')
+    if len(formats) > 1:
+        raise QueryError('Error: at most one format= parameter should be specified', code=400)
+    format = formats[0] if formats else 'json'
+    if format not in FORMATS:
+        raise QueryError('Error: format should be one of ' +
+            ', '.join(sorted(FORMATS)), code=400)
+
     sql = qs[0]
     box = boxs[0]
-    return sql, box
+    return sql, box, format
+
+_SQL_TOKENS = re.compile(r"""
+    '(?:[^']|'')*'     # string literal
+  | "(?:[^"]|"")*"     # quoted identifiers
+  | `(?:[^`]|``)*`
+  | \[[^\]]*\]
+  | --[^\n]*\n?       # comments, whose line breaks matter
+  | /\*.*?(?:\*/|$)
+  | \s+               # whitespace
+  | [^'"`\[\s/-]+     # anything else
+  | .
+""", re.VERBOSE | re.DOTALL)
+
+def normalize_sql(sql):
+    """Return *sql* with runs of whitespace outside quotes and comments
+    collapsed to a single space, and leading and trailing whitespace
+    removed, so that trivially different spellings of a query are the
+    same.
+    """
+    tokens = _SQL_TOKENS.findall(sql.strip())
+    return ''.join(' ' if token.isspace() else token for token in tokens)
+
+_NUMBER = re.compile(r'\b(?:0x[0-9a-f]+|\d+(?:\.\d+)?(?:e[-+]?\d+)?)\b')
+_LIST = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+
+def fingerprint(sql):
+    """Return the shape of the query *sql*: normalized as by
+    normalize_sql, lower case, and with string and number literals
+    replaced by ?, and lists of them by a single (?).
+    """
+    parts = []
+    for token in _SQL_TOKENS.findall(sql.strip()):
+        if token.isspace():
+            parts.append(' ')
+        elif token[0] == "'":
+            parts.append('?')
+        elif token[0] in '"`[':
+            parts.append(token)
+        else:
+            parts.append(_NUMBER.sub('?', token.lower()))
+    return _LIST.sub('(?)', ''.join(parts))
+
+def _percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+class SlowLog(object):
+    """Records sql requests that take longer than *threshold* seconds
+    in the SQLite database *path*, shared by all worker processes.
+    Only the fraction *sample* of them is recorded.  Records older than
+    *retention* seconds are deleted now and then.  With no *path*
+    nothing is recorded.
+    """
+    def __init__(self, path=None, threshold=1.0, sample=1.0, retention=7 * 86400):
+        self.path = path
+        self.threshold = threshold
+        self.sample = sample
+        self.retention = retention
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        connection.execute("""CREATE TABLE IF NOT EXISTS slow_query (
+            at REAL, box TEXT, fingerprint TEXT, sql TEXT,
+            ms REAL, rows INTEGER, bytes INTEGER, status INTEGER)""")
+        connection.execute("CREATE INDEX IF NOT EXISTS slow_query_at ON slow_query (at)")
+        return connection
+
+    def record(self, timer, code, size):
+        """Record the request timed by *timer* if it was slow.
+
+        This runs once the response has been sent, or its status line
+        fixed, so a log that can't be written to is only counted as
+        slow.failed and reported on stderr.
+        """
+        if not self.path or timer.sql is None or not isinstance(timer.sql, basestring):
+            return
+        now = time.time()
+        elapsed = now - timer.started
+        if elapsed < self.threshold or random.random() >= self.sample:
+            return
+        count('slow')
+        try:
+            connection = self._connect()
+            try:
+                with connection:
+                    connection.execute("INSERT INTO slow_query VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                        (now, timer.box, fingerprint(timer.sql), timer.sql,
+                         elapsed * 1000, timer.rows, size, code))
+                    if random.random() < 0.01:
+                        connection.execute("DELETE FROM slow_query WHERE at < ?",
+                            (now - self.retention,))
+            finally:
+                connection.close()
+        except sqlite3.Error:
+            count('slow.failed')
+            traceback.print_exc()
+
+    def report(self, box=None, since=86400, limit=20):
+        """Return the *limit* query fingerprints that took the most
+        time in total over the last *since* seconds, for *box* or for
+        every box.
+        """
+        if not self.path:
+            return []
+        sql = "SELECT fingerprint, box, sql, ms, rows, bytes FROM slow_query WHERE at >= ?"
+        params = [time.time() - since]
+        if box is not None:
+            sql += " AND box = ?"
+            params.append(box)
+        sql += " ORDER BY at"
+        connection = self._connect()
+        try:
+            records = connection.execute(sql, params).fetchall()
+        finally:
+            connection.close()
+
+        groups = collections.defaultdict(list)
+        for record in records:
+            groups[record[0]].append(record)
+        report = []
+        for fp, group in groups.items():
+            ms = [record[3] for record in group]
+            report.append(collections.OrderedDict([
+                ('fingerprint', fp),
+                ('calls', len(group)),
+                ('total_ms', sum(ms)),
+                ('p95_ms', _percentile(ms, 0.95)),
+                ('max_ms', max(ms)),
+                ('rows', sum(record[4] or 0 for record in group)),
+                ('bytes', sum(record[5] or 0 for record in group)),
+                ('boxes', sorted(set(record[1] for record in group))),
+                ('example', group[-1][2]),
+            ]))
+        report.sort(key=lambda entry: entry['total_ms'], reverse=True)
+        return report[:limit]
+
+    def hot_boxes(self, since=86400, limit=20):
+        """Return the *limit* boxes whose recorded queries took the most
+        time in total over the last *since* seconds, most first.
+        """
+        if not self.path:
+            return []
+        connection = self._connect()
+        try:
+            return [box for box, in connection.execute(
+                "SELECT box FROM slow_query WHERE at >= ? AND box IS NOT NULL "
+                "GROUP BY box ORDER BY sum(ms) DESC LIMIT ?", (time.time() - since, limit))]
+        finally:
+            connection.close()
+
+SLOWLOG = SlowLog(
+    path=os.environ.get('DUMPTRUCK_WEB_SLOWLOG'),
+    threshold=float(os.environ.get('DUMPTRUCK_WEB_SLOWLOG_SECONDS', 1)),
+    sample=float(os.environ.get('DUMPTRUCK_WEB_SLOWLOG_SAMPLE', 1)))
 
 def get_database_name(boxhome, box, default='scraperwiki.sqlite'):
     """
@@ -229,7 +1878,13 @@ def get_database_name(boxhome, box, default='scraperwiki.sqlite'):
 
     This is normally specified by the "database" field in ~/box.json;
     if that file doesn't exist, use *default*.
+
+    The answer is remembered in BOX_CACHE, see BoxCache.
     """
+    return BOX_CACHE.get(boxhome, box, default)
+
+def read_database_name(boxhome, box, default='scraperwiki.sqlite'):
+    """Work out the answer for get_database_name, without any caching."""
 
     path = os.path.join(boxhome, box, 'box.json')
     if not os.path.exists(path):
@@ -257,17 +1912,1165 @@ def get_database_name(boxhome, box, default='scraperwiki.sqlite'):
 
     return dbname
 
+def _stat_identity(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_ino, st.st_size, st.st_mtime)
+
+class BoxCache(object):
+    """Remembers which database file each box uses, so that
+    get_database_name doesn't have to read and parse box.json on every
+    request.
+
+    An entry is checked with as few stats as possible: the config file
+    that was read, and the box directory when the answer depends on a
+    file not existing (creating a file changes the directory's mtime).
+    So a box using box.json costs one stat, and a box using the default
+    database costs one stat of its directory.
+    """
+    def __init__(self, maxsize=1024):
+        self.maxsize = maxsize
+        self._lock = threading.Lock()
+        # (boxhome, box, default) -> (checks, dbname), least recently
+        # used first.  checks is a list of (path, _stat_identity(path)).
+        self._entries = collections.OrderedDict()
+
+    def get(self, boxhome, box, default):
+        key = (boxhome, box, default)
+        with self._lock:
+            entry = self._entries.pop(key, None)
+        if entry is not None:
+            checks, dbname = entry
+            if all(_stat_identity(path) == identity for path, identity in checks):
+                with self._lock:
+                    self._entries[key] = entry
+                return dbname
+
+        # Stat before reading, so that a change while we read makes the
+        # entry invalid rather than stale.
+        boxdir = os.path.join(boxhome, box)
+        box_json = os.path.join(boxdir, 'box.json')
+        identity = _stat_identity(box_json)
+        if identity is not None:
+            checks = [(box_json, identity)]
+        else:
+            sw_json = os.path.join(boxdir, 'scraperwiki.json')
+            checks = [(boxdir, _stat_identity(boxdir))]
+            identity = _stat_identity(sw_json)
+            if identity is not None:
+                checks.append((sw_json, identity))
+
+        # Errors are not cached.
+        dbname = read_database_name(boxhome, box, default)
+        with self._lock:
+            self._entries[key] = (checks, dbname)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return dbname
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+BOX_CACHE = BoxCache(int(os.environ.get('DUMPTRUCK_WEB_BOX_CACHE_SIZE', 1024)))
+
+def stats_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the stats method: this process's latency
+    histograms and counters, from STATS.
+    """
+    return Response(200, json.dumps(STATS.as_dict()) + '\n')
+
+_IDENT = r'(?:[a-z_][\w$]*|"(?:[^"]|"")*"|\[[^\]]*\]|`(?:[^`]|``)*`)'
+_PLAN_SCAN = re.compile(r'^SCAN (?:TABLE )?(\S+)(?: AS (\S+))?', re.I)
+_TABLE_REFERENCE = re.compile(r'(?:\bfrom|\bjoin|,)\s*(%s)(?:\s+(?:as\s+)?(%s))?' % (_IDENT, _IDENT))
+_PREDICATE = re.compile(r'(?:(%s)\.)?(%s)\s*(==|=|<=|>=|<|>|\bin\b|\bis\b|\bbetween\b|\blike\b|\bglob\b)\s*(\(?\??)'
+    % (_IDENT, _IDENT))
+_JOINED_COLUMN = re.compile(r'==?\s*(?:(%s)\.)?(%s)' % (_IDENT, _IDENT))
+_AUTOMATIC_INDEX = re.compile(r'^SEARCH (?:TABLE )?(\S+)(?: AS (\S+))? USING AUTOMATIC (?:COVERING )?INDEX \((.*)\)', re.I)
+_NOT_ALIASES = set('''where join on using left right full inner outer cross natural
+    group order limit union except intersect window having'''.split())
+_EQUALITY = set(['=', '==', 'in', 'is'])
+
+def _unquote(identifier):
+    if identifier[:1] in ('"', '`', '['):
+        return identifier[1:-1]
+    return identifier
+
+def _quote_identifier(name):
+    return '"%s"' % name.replace('"', '""')
+
+def index_columns(sql, table, alias, columns):
+    """Guess which *columns* of *table* (called *alias* in *sql*) an
+    index should be on, from how they are compared in *sql*.  Returns
+    the columns and how many of them are compared for equality.
+
+    Columns compared with literals come first, equality before one
+    range.  Only if there are none are columns used to join other
+    tables suggested, as the table may be the outer loop of the join.
+    """
+    names = set([table.lower(), alias.lower()])
+    by_lower = dict((column.lower(), column) for column in columns)
+    fp = fingerprint(sql)
+    matches = [(qualifier, column, op, rhs.endswith('?'))
+        for qualifier, column, op, rhs in _PREDICATE.findall(fp)]
+    matches += [(qualifier, column, '=', False)
+        for qualifier, column in _JOINED_COLUMN.findall(fp)]
+    equality, ranges, joins = [], [], []
+    for qualifier, column, op, literal in matches:
+        if qualifier and _unquote(qualifier).lower() not in names:
+            continue
+        column = by_lower.get(_unquote(column).lower())
+        if column is None or column in equality + ranges + joins:
+            continue
+        if not literal:
+            if op.strip() in _EQUALITY:
+                joins.append(column)
+        elif op.strip() in _EQUALITY:
+            equality.append(column)
+        else:
+            ranges.append(column)
+    if equality or ranges:
+        return equality + ranges[:1], len(equality)
+    return joins, len(joins)
+
+def _table_rows(dt, table, stat1):
+    """Estimate the number of rows in *table*: from sqlite_stat1 if the
+    database has been analyzed, otherwise from the largest rowid, which
+    doesn't need a scan.
+    """
+    if table in stat1:
+        return int(stat1[table].split()[0])
+    try:
+        rows = dt.execute(u'SELECT max(rowid) AS n FROM %s' % _quote_identifier(table))
+    except sqlite3.OperationalError:
+        # WITHOUT ROWID table.
+        rows = dt.execute(u'SELECT count(*) AS n FROM %s' % _quote_identifier(table))
+    return rows[0]['n'] or 0
+
+def _distinct_values(dt, table, column, sample=1000):
+    """The number of distinct values of *column* in the first *sample*
+    rows of *table*.
+    """
+    return dt.execute(u'SELECT count(DISTINCT c) AS d FROM (SELECT %s AS c FROM %s LIMIT %d)'
+        % (_quote_identifier(column), _quote_identifier(table), sample))[0]['d']
+
+def advise_query(dt, sql, tables):
+    """Run EXPLAIN QUERY PLAN for *sql* on *dt* and return a dict of
+    its plan and, for each full table scan, a suggested index with an
+    estimate of how many rows the query would read using it.
+
+    *tables* maps lower case table names to table names.
+    """
+    details = [row['detail'] for row in dt.execute(u'EXPLAIN QUERY PLAN ' + sql) or []]
+    try:
+        stat1 = dict((row['tbl'], row['stat']) for row in
+            dt.execute(u'SELECT tbl, stat FROM sqlite_stat1 WHERE idx IS NULL'))
+    except sqlite3.OperationalError:
+        # The database has never been analyzed.
+        stat1 = {}
+
+    # Newer SQLite names scans by the table's alias.
+    aliases = {}
+    for name, alias in _TABLE_REFERENCE.findall(fingerprint(sql)):
+        table = tables.get(_unquote(name).lower())
+        if table is None:
+            continue
+        aliases[table.lower()] = table
+        if alias and alias not in _NOT_ALIASES:
+            aliases[_unquote(alias).lower()] = table
+
+    scans = []
+    for detail in details:
+        # SQLite building a temporary index for each run of the query
+        # is as good as a scan, and tells us which columns to index.
+        match = _AUTOMATIC_INDEX.match(detail) or _PLAN_SCAN.match(detail)
+        if not match or (match.re is _PLAN_SCAN and ' USING ' in detail.upper()):
+            # Not a scan, or a scan of an index.
+            continue
+        alias = match.group(2) or match.group(1)
+        table = aliases.get(alias.lower()) or tables.get(match.group(1).lower())
+        if table is None:
+            # A subquery or constant row.
+            continue
+        rows = _table_rows(dt, table, stat1)
+        scan = collections.OrderedDict([('detail', detail), ('table', table), ('rows', rows)])
+        if match.re is _AUTOMATIC_INDEX:
+            terms = [term.strip() for term in match.group(3).split(' AND ')]
+            columns = [term.rstrip('=<>?') for term in terms]
+            n_equality = len([term for term in terms if term.endswith('=?')])
+        else:
+            columns, n_equality = index_columns(sql, table, alias,
+                list(dt.column_names(table)))
+        if columns:
+            if n_equality:
+                selectivity = 1.0 / max(_distinct_values(dt, table, columns[0]), 1)
+            else:
+                # Only a range; SQLite itself guesses a quarter of the rows.
+                selectivity = 0.25
+            estimated = max(1, int(rows * selectivity))
+            scan['columns'] = columns
+            scan['suggestion'] = u'CREATE INDEX %s ON %s (%s)' % (
+                _quote_identifier('_'.join(['idx', table] + columns)),
+                _quote_identifier(table),
+                ', '.join(_quote_identifier(column) for column in columns))
+            scan['estimated_rows'] = estimated
+            scan['estimated_speedup'] = round(
+                rows / (estimated + math.log(max(rows, 2), 2)), 1)
+        scans.append(scan)
+    return collections.OrderedDict([('sql', sql), ('plan', details), ('scans', scans)])
+
+def advise_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the advise method, which looks for full table
+    scans in the query plans of the queries given as q= parameters, or
+    else of the box's queries in the slow query log, and suggests
+    indexes for them.  It uses the same read-only connection as the
+    sql method.
+    """
+    if form is None:
+        form = cgi.FieldStorage()
+    boxs = form.getlist('box')
+    if len(boxs) != 1:
+        raise QueryError('Error: exactly one box= parameter should be specified', code=400)
+    box = boxs[0]
+    dbname = get_database_name(boxhome, box)
+    queries = form.getlist('q')
+    if not queries:
+        queries = [entry['example'] for entry in SLOWLOG.report(box=box)]
+
+    try:
+        dt = CONNECTIONS.get(dbname)
+    except NotOK as e:
+        return Response(e.code, json.dumps(e.body) + '\n')
+    meter = budget_for(box).start(dt.connection)
+    try:
+        tables = dict((name.lower(), name) for name, type in dt.tablesAndViews()
+            if type == 'table')
+        advice = []
+        for sql in queries:
+            try:
+                advice.append(advise_query(dt, sql, tables))
+            except Exception, e:
+                code, error = error_for_exception(e, meter)
+                advice.append(collections.OrderedDict([('sql', sql), ('error', error)]))
+    finally:
+        dt.connection.set_progress_handler(None, 0)
+    return Response(200, json.dumps(advice) + '\n')
+
+# Most queries the batch method runs in one request.
+MAX_BATCH = int(os.environ.get('DUMPTRUCK_WEB_MAX_BATCH', 50))
+
+def parse_batch(form):
+    """Return box,queries for the batch method, from *form*.  The
+    queries are either repeated q= parameters or one queries=
+    parameter holding a JSON list of strings.
+    """
+    boxs = form.getlist('box')
+    if len(boxs) != 1:
+        raise QueryError('Error: exactly one box= parameter should be specified', code=400)
+    queries = form.getlist('q')
+    encoded = form.getlist('queries')
+    if encoded:
+        if queries or len(encoded) != 1:
+            raise QueryError('Error: give either q= parameters or one queries= parameter',
+                code=400)
+        try:
+            queries = json.loads(encoded[0])
+        except ValueError:
+            queries = None
+        if not isinstance(queries, list) or \
+                not all(isinstance(sql, basestring) for sql in queries):
+            raise QueryError('Error: queries= should be a JSON list of strings', code=400)
+    if not queries:
+        raise QueryError('Error: at least one query should be specified', code=400)
+    if len(queries) > MAX_BATCH:
+        raise QueryError('Error: at most %d queries may be batched' % MAX_BATCH, code=400)
+    return boxs[0], queries
+
+def batch_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the batch method, which runs several queries
+    on one box with one connection, in one read transaction so that
+    they see the same snapshot (see execute_batch).  The body is a list
+    of {"status": ..., "data": ...} objects, one for each query, where
+    data is what the sql method would have given.
+    """
+    if form is None:
+        form = cgi.FieldStorage()
+    timer = timer or Timer()
+    with timer.phase('resolve'):
+        box, queries = parse_batch(form)
+        dbname = get_database_name(boxhome, box)
+        timer.resolved(box, dbname)
+    try:
+        with timer.phase('open'):
+            dt = CONNECTIONS.get(dbname)
+    except NotOK as e:
+        return Response(e.code, json.dumps(e.body) + '\n')
+
+    with timer.phase('query'):
+        results = execute_batch(queries, dt, budget=budget_for(box))
+    timer.rows = sum(len(data) for code, data in results if isinstance(data, list))
+    count('rows', timer.rows)
+    with timer.phase('encode'):
+        body = json.dumps([collections.OrderedDict([('status', code), ('data', data)])
+            for code, data in results])
+    return Response(200, body + '\n')
+
+# Rows read by each query of an export.
+EXPORT_CHUNK = int(os.environ.get('DUMPTRUCK_WEB_EXPORT_CHUNK', 1000))
+
+# The range of rowids SQLite allows.
+MIN_ROWID, MAX_ROWID = -2 ** 63, 2 ** 63 - 1
+
+_ROWID_RANGE = re.compile(r'^\s*rowid\s*=\s*(-?\d+)\s*-\s*(-?\d+)?\s*$')
+
+class TableRows(object):
+    """Like Rows, but the rows of *table* (on the dumptruck object
+    *dt*) with rowids from *first* to *last*, in rowid order, with the
+    rowid as the first column.
+
+    They are read with a separate query for each *chunk* rows, each
+    limited by *budget*, so that only one chunk is held in memory and
+    no read transaction is held open, however big the table is.  The
+    first chunk is read by *start*, whose errors can still be given a
+    status code.
+    """
+    def __init__(self, dt, table, first, last, chunk=EXPORT_CHUNK, budget=None, timer=None):
+        self.connection = dt.connection
+        self.last = last
+        self.chunk = chunk
+        self.budget = budget or DEFAULT_BUDGET
+        self.timer = timer
+        self.count = 0
+        self.meter = None
+        self.columns = None
+        self.sql = ('SELECT rowid AS rowid, * FROM %s WHERE rowid >= ? AND rowid <= ? '
+            'ORDER BY rowid LIMIT %d' % (_quote_identifier(table), chunk))
+        self._first = []
+
+    def start(self, first):
+        """Read the first chunk, starting at rowid *first*."""
+        self._first = self._fetch(first)
+
+    def _fetch(self, first):
+        """The chunk of rows starting at rowid *first*."""
+        self.meter = self.budget.start(self.connection)
+        cursor = self.connection.cursor()
+        try:
+            cursor.execute(self.sql, (first, self.last))
+            self.columns = [d[0].decode('utf-8') for d in cursor.description]
+            return cursor.fetchall()
+        finally:
+            cursor.close()
+            self.connection.set_progress_handler(None, 0)
+
+    def __iter__(self):
+        batch, self._first = self._first, None
+        try:
+            while batch:
+                self.count += len(batch)
+                yield batch
+                if len(batch) < self.chunk or batch[-1][0] >= self.last:
+                    break
+                batch = self._fetch(batch[-1][0] + 1)
+        finally:
+            count('rows', self.count)
+            if self.timer is not None:
+                self.timer.rows = self.count
+
+def parse_rowid_range(form, environ):
+    """Return first,last,partial: the rowids to export given the
+    from_rowid= and to_rowid= parameters in *form*, or a Range header
+    like "rowid=1000-" in *environ*, and whether either was given.
+    """
+    match = _ROWID_RANGE.match(environ.get('HTTP_RANGE', ''))
+    if match:
+        first, last = match.groups()
+    else:
+        # Other Range units, such as bytes, are ignored.
+        first, last = form.getfirst('from_rowid'), form.getfirst('to_rowid')
+    try:
+        bounds = (MIN_ROWID if first is None else int(first),
+                  MAX_ROWID if last is None else int(last))
+    except ValueError:
+        raise QueryError('Error: from_rowid= and to_rowid= should be whole numbers', code=400)
+    return bounds[0], bounds[1], first is not None or last is not None
+
+def export_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the export method, which streams the whole of
+    the table *table*, or the part of it given by parse_rowid_range, in
+    rowid order using TableRows.  *format* is one of the keys of
+    FORMATS, as for the sql method, but defaults to ndjson so that a
+    cut off download can be resumed from the rowid after its last
+    complete line.
+    """
+    if form is None:
+        form = cgi.FieldStorage()
+    if environ is None:
+        environ = os.environ
+    timer = timer or Timer()
+    with timer.phase('resolve'):
+        boxs = form.getlist('box')
+        tables = form.getlist('table')
+        if len(boxs) != 1:
+            raise QueryError('Error: exactly one box= parameter should be specified', code=400)
+        if len(tables) != 1:
+            raise QueryError('Error: exactly one table= parameter should be specified', code=400)
+        format = form.getfirst('format', 'ndjson')
+        if format not in FORMATS:
+            raise QueryError('Error: format should be one of ' +
+                ', '.join(sorted(FORMATS)), code=400)
+        first, last, partial = parse_rowid_range(form, environ)
+        box = boxs[0]
+        dbname = get_database_name(boxhome, box)
+        timer.resolved(box, dbname)
+    try:
+        with timer.phase('open'):
+            dt = CONNECTIONS.get(dbname)
+    except NotOK as e:
+        return Response(e.code, json.dumps(e.body) + '\n')
+
+    table = tables[0]
+    types = dict(dt.tablesAndViews())
+    if table not in types:
+        raise QueryError('Error: no such table: ' + table, code=404)
+    if types[table] != 'table':
+        raise QueryError('Error: only tables, not views, can be exported', code=400)
+    try:
+        # Rows added during the export are left for the next one.
+        newest = dt.execute(u'SELECT max(rowid) AS m FROM %s' % _quote_identifier(table),
+            commit=False)[0]['m']
+    except sqlite3.OperationalError, e:
+        # WITHOUT ROWID tables can't be exported.
+        code, error = error_for_exception(e)
+        return Response(code, json.dumps(error) + '\n')
+    last = min(last, first if newest is None else newest)
+    rows = TableRows(dt, table, first, last, budget=budget_for(box), timer=timer)
+    try:
+        with timer.phase('query'):
+            rows.start(first)
+    except Exception, e:
+        code, error = error_for_exception(e, rows.meter)
+        return Response(code, json.dumps(error) + '\n')
+
+    content_type, encoder = FORMATS[format]
+    headers = [('Content-Type', content_type), ('Accept-Ranges', 'rowid')]
+    if partial and first <= last:
+        headers.append(('Content-Range', 'rowid %d-%d/*' % (first, last)))
+    return Response(206 if partial else 200, encoder(rows), headers)
+
+# Directory of the sidecar full-text indexes, one SQLite file per
+# database; without one the search method is disabled.
+SEARCH_DIR = os.environ.get('DUMPTRUCK_WEB_SEARCH_DIR')
+# Rows read from the database, and added to its index, at a time.
+SEARCH_CHUNK = int(os.environ.get('DUMPTRUCK_WEB_SEARCH_CHUNK', 5000))
+# Longest a search request spends bringing the index up to date.
+SEARCH_SECONDS = float(os.environ.get('DUMPTRUCK_WEB_SEARCH_SECONDS', 10))
+# Each result is bound as a variable, and SQLite before 3.32 allows at
+# most 999 of those in a statement.
+MAX_SEARCH_RESULTS = 999
+
+# Declared types giving a column text affinity, or none at all; see
+# https://www.sqlite.org/datatype3.html#determination_of_column_affinity
+_TEXT_TYPE = re.compile(r'char|clob|text|^$', re.I)
+
+def text_columns(dt, table):
+    """The names of the columns of *table* that hold text."""
+    return [column['name'] for column in
+        dt.execute(u'PRAGMA table_info(%s)' % _quote_identifier(table), commit=False)
+        if _TEXT_TYPE.search(column['type'] or '')]
+
+class SearchIndex(object):
+    """An FTS5 index of the text columns of the tables of the database
+    *dbname*, kept in a file of its own under *directory* since the
+    database itself is read-only to us.
+
+    The index of a table records the last rowid it covers, and *refresh*
+    adds the rows after that.  Any other change seen when the database
+    has changed (another file, different text columns, or fewer rows up
+    to that rowid) makes it start again, but rows updated in place are
+    not noticed.  The index is contentless, so searches give rowids,
+    whose rows are read from the database itself.
+    """
+    def __init__(self, dbname, directory=None):
+        self.dbname = dbname
+        directory = directory or SEARCH_DIR
+        self.path = os.path.join(directory,
+            hashlib.sha1(os.path.abspath(dbname)).hexdigest() + '.sqlite')
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.db = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute("""CREATE TABLE IF NOT EXISTS indexed (
+            id INTEGER PRIMARY KEY, name TEXT UNIQUE, source TEXT, file TEXT,
+            columns TEXT, last_rowid INTEGER, rows INTEGER, identity TEXT)""")
+
+    def close(self):
+        self.db.close()
+
+    def _entry(self, table):
+        return self.db.execute('SELECT id, file, columns, last_rowid, rows, identity '
+            'FROM indexed WHERE name = ?', (table,)).fetchone()
+
+    def _restart(self, table, file, columns):
+        """Replace any index of *table* with an empty one.  Call in a
+        transaction.
+        """
+        entry = self._entry(table)
+        if entry is not None:
+            self.db.execute('DROP TABLE IF EXISTS fts%d' % entry[0])
+            self.db.execute('DELETE FROM indexed WHERE id = ?', (entry[0],))
+        id = self.db.execute('INSERT INTO indexed (name, source, file, columns, last_rowid, rows) '
+            'VALUES (?, ?, ?, ?, NULL, 0)', (table, self.dbname, file, columns)).lastrowid
+        self.db.execute("CREATE VIRTUAL TABLE fts%d USING fts5(%s, content='')" % (
+            id, ', '.join('c%d' % i for i in range(len(json.loads(columns))))))
+
+    def refresh(self, dt, table, deadline=None, budget=None):
+        """Bring the index of *table*, read through the dumptruck *dt*,
+        up to date.  Return whether it is, or False if *deadline* (a
+        time.time()) came first; what was done by then is kept.
+
+        Each chunk of rows is added in its own transaction, which is
+        abandoned and tried again if another process got there first.
+        """
+        identity = make_etag(database_identity(self.dbname))
+        file = json.dumps(list(database_identity(self.dbname)[0][:2]))
+        while True:
+            entry = self._entry(table)
+            if entry is not None and entry[5] == identity:
+                return True
+            columns = json.dumps(text_columns(dt, table))
+            if columns == '[]':
+                raise QueryError('Error: table %s has no text columns' % table, code=400)
+            restart = entry is None or entry[1] != file or entry[2] != columns
+            if not restart and entry[3] is not None:
+                still = dt.execute(u'SELECT count(*) AS n FROM %s WHERE rowid <= ?' %
+                    _quote_identifier(table), [entry[3]], commit=False)[0]['n']
+                restart = still != entry[4]
+            first = MIN_ROWID if restart or entry[3] is None else entry[3] + 1
+            newest = dt.execute(u'SELECT max(rowid) AS m FROM %s' % _quote_identifier(table),
+                commit=False)[0]['m']
+            if newest is not None and first <= newest:
+                rows = TableRows(dt, table, first, newest, chunk=SEARCH_CHUNK, budget=budget)
+                rows.start(first)
+                batch = next(iter(rows), [])
+            else:
+                batch = []
+
+            self.db.execute('BEGIN IMMEDIATE')
+            try:
+                if self._entry(table) != entry:
+                    self.db.execute('ROLLBACK')
+                    continue
+                if restart:
+                    self._restart(table, file, columns)
+                    entry = self._entry(table)
+                if batch:
+                    wanted = json.loads(columns)
+                    positions = [rows.columns.index(name, 1) for name in wanted]
+                    self.db.executemany('INSERT INTO fts%d (rowid, %s) VALUES (?, %s)' % (
+                        entry[0], ', '.join('c%d' % i for i in range(len(wanted))),
+                        ', '.join('?' * len(wanted))),
+                        ([row[0]] + [row[i] for i in positions] for row in batch))
+                    self.db.execute('UPDATE indexed SET last_rowid = ?, rows = rows + ? '
+                        'WHERE id = ?', (batch[-1][0], len(batch), entry[0]))
+                done = not batch or batch[-1][0] >= newest
+                if done:
+                    self.db.execute('UPDATE indexed SET identity = ? WHERE id = ?',
+                        (identity, entry[0]))
+                self.db.execute('COMMIT')
+            except:
+                self.db.execute('ROLLBACK')
+                raise
+            if done:
+                return True
+            if deadline is not None and time.time() > deadline:
+                return False
+
+    def search(self, table, query, limit=100):
+        """The rowids of the rows of *table* matching the FTS5 *query*,
+        best first.
+        """
+        entry = self._entry(table)
+        return [rowid for rowid, in self.db.execute(
+            'SELECT rowid FROM fts%d WHERE fts%d MATCH ? ORDER BY rank LIMIT ?' % (
+                entry[0], entry[0]), (query, limit))]
+
+def search_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the search method: the rows of the table *table*
+    whose text columns match the FTS5 query *q*, best match first, as
+    for the sql method's json format.  At most *limit* rows are given
+    (100 unless given, at most MAX_SEARCH_RESULTS).
+
+    The box's SearchIndex is brought up to date first.  If that takes
+    more than SEARCH_SECONDS the answer is a 503; the rows indexed so
+    far are kept for the next request.
+    """
+    if form is None:
+        form = cgi.FieldStorage()
+    if environ is None:
+        environ = os.environ
+    timer = timer or Timer()
+    with timer.phase('resolve'):
+        if not SEARCH_DIR:
+            raise QueryError('Error: search is not enabled', code=404)
+        for name in ['box', 'table', 'q']:
+            if len(form.getlist(name)) != 1:
+                raise QueryError('Error: exactly one %s= parameter should be specified' % name,
+                    code=400)
+        try:
+            limit = int(form.getfirst('limit', 100))
+        except ValueError:
+            limit = 0
+        if not 0 < limit <= MAX_SEARCH_RESULTS:
+            raise QueryError('Error: limit should be between 1 and %d' % MAX_SEARCH_RESULTS,
+                code=400)
+        box = form.getfirst('box')
+        table = form.getfirst('table')
+        query = form.getfirst('q')
+        dbname = get_database_name(boxhome, box)
+        timer.resolved(box, dbname)
+    try:
+        with timer.phase('open'):
+            dt = CONNECTIONS.get(dbname)
+    except NotOK as e:
+        return Response(e.code, json.dumps(e.body) + '\n')
+
+    types = dict(dt.tablesAndViews())
+    if table not in types:
+        raise QueryError('Error: no such table: ' + table, code=404)
+    if types[table] != 'table':
+        raise QueryError('Error: only tables, not views, can be searched', code=400)
+
+    index = SearchIndex(dbname)
+    try:
+        try:
+            with timer.phase('index'):
+                ready = index.refresh(dt, table, time.time() + SEARCH_SECONDS, budget_for(box))
+            if not ready:
+                return Response(503, json.dumps('Error: the search index is still being built') + '\n',
+                    [('Content-Type', CONTENT_TYPE), ('Retry-After', '1')])
+            with timer.phase('search'):
+                rowids = index.search(table, query, limit)
+        except sqlite3.Error, e:
+            code, error = error_for_exception(e)
+            return Response(code, json.dumps(error) + '\n')
+    finally:
+        index.close()
+
+    etag = make_etag('search', database_identity(dbname), table, query, limit)
+    response = not_modified(etag, environ)
+    if response is not None:
+        return response
+
+    code, rows = stream_query(u'SELECT rowid AS rowid, * FROM %s WHERE rowid IN (%s)' % (
+        _quote_identifier(table), ', '.join('?' * len(rowids))) if rowids else u'SELECT 1 WHERE 0',
+        dbname, budget=budget_for(box), timer=timer, params=rowids)
+    if code != 200:
+        return Response(code, json.dumps(rows) + '\n')
+    try:
+        found = dict((row[0], row) for batch in rows for row in batch)
+    except Exception, e:
+        code, error = error_for_exception(e, rows.meter)
+        return Response(code, json.dumps(error) + '\n')
+    columns = rows.columns[1:]
+    result = [collections.OrderedDict(zip(columns, found[rowid][1:]))
+        for rowid in rowids if rowid in found]
+    return conditional(Response(200, json.dumps(result) + '\n'), etag)
+
+# Longest a wait= request may wait, in seconds.
+MAX_WAIT = float(os.environ.get('DUMPTRUCK_WEB_MAX_WAIT', 300))
+# Most new rows one wait= request returns.
+WAIT_ROWS = 1000
+
+# inotify events on a box's directory that may mean its database changed.
+_IN_MODIFY, _IN_ATTRIB, _IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+_IN_MOVED_FROM, _IN_MOVED_TO, _IN_CREATE, _IN_DELETE = 0x40, 0x80, 0x100, 0x200
+_IN_DIRECTORY_CHANGES = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE |
+    _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+
+def _inotify():
+    """Return (libc, file descriptor) for a new non-blocking inotify
+    instance, or None where there is no inotify.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    return libc, fd
+
+class Watcher(object):
+    """Calls functions back when database files change, for the wait
+    method.  One thread watches every database that is being waited
+    on, woken by inotify on the databases' directories where there is
+    inotify, and checking database_identity every *poll_interval*
+    seconds in any case.
+    """
+    def __init__(self, poll_interval=1.0, use_inotify=True):
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify
+        self._lock = threading.Lock()
+        # dbname -> list of (deadline, identity, callback)
+        self._waits = collections.defaultdict(list)
+        # directory -> inotify watch descriptor
+        self._watches = {}
+        self._thread = None
+        self._inotify = None
+        self._wake_read, self._wake_write = None, None
+
+    def watch(self, dbname, identity, timeout, callback):
+        """Call *callback*, from the watcher's thread, once the
+        database_identity of *dbname* is no longer *identity*, or after
+        *timeout* seconds.
+        """
+        with self._lock:
+            if self._thread is None:
+                self._start()
+            self._waits[dbname].append((time.time() + timeout, identity, callback))
+            if self._inotify is not None:
+                directory = os.path.dirname(os.path.abspath(dbname))
+                if directory not in self._watches:
+                    libc, fd = self._inotify
+                    path = directory.encode('utf-8') if isinstance(directory, unicode) else directory
+                    wd = libc.inotify_add_watch(fd, path, _IN_DIRECTORY_CHANGES)
+                    if wd >= 0:
+                        self._watches[directory] = wd
+        try:
+            os.write(self._wake_write, 'x')
+        except OSError:
+            # The pipe is full, so the thread is due to wake up anyway.
+            pass
+
+    def _start(self):
+        self._wake_read, self._wake_write = os.pipe()
+        for fd in self._wake_read, self._wake_write:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        if self.use_inotify:
+            self._inotify = _inotify()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _drain(self, fd):
+        try:
+            while os.read(fd, 65536):
+                pass
+        except OSError:
+            pass
+
+    def _run(self):
+        fds = [self._wake_read]
+        if self._inotify is not None:
+            fds.append(self._inotify[1])
+        while True:
+            with self._lock:
+                deadlines = [deadline for waits in self._waits.values()
+                    for deadline, identity, callback in waits]
+            if deadlines:
+                timeout = max(0, min(self.poll_interval, min(deadlines) - time.time()))
+            else:
+                # Nothing to do until watch is called.
+                timeout = None
+            readable, _, _ = select.select(fds, [], [], timeout)
+            for fd in readable:
+                self._drain(fd)
+            for callback in self._due():
+                try:
+                    callback()
+                except Exception:
+                    traceback.print_exc()
+
+    def _due(self):
+        """Remove and return the callbacks whose database has changed or
+        whose time is up.
+        """
+        now = time.time()
+        due = []
+        with self._lock:
+            dbnames = self._waits.keys()
+        identities = dict((dbname, database_identity(dbname)) for dbname in dbnames)
+        with self._lock:
+            for dbname, identity_now in identities.items():
+                waits = self._waits.get(dbname, [])
+                keep = []
+                for wait in waits:
+                    deadline, identity, callback = wait
+                    if identity_now != identity or now >= deadline:
+                        due.append(callback)
+                    else:
+                        keep.append(wait)
+                if keep:
+                    self._waits[dbname] = keep
+                else:
+                    self._waits.pop(dbname, None)
+            if self._inotify is not None:
+                directories = set(os.path.dirname(os.path.abspath(dbname))
+                    for dbname in self._waits)
+                libc, fd = self._inotify
+                for directory in set(self._watches) - directories:
+                    libc.inotify_rm_watch(fd, self._watches.pop(directory))
+        return due
+
+WATCHER = Watcher()
+
+def wait_token(identity, rowid=None):
+    """The opaque token standing for the database with *identity*,
+    and the largest *rowid* seen in the table being followed.
+    """
+    token = hashlib.sha1(repr(identity)).hexdigest()[:16]
+    if rowid is not None:
+        token += '.%d' % rowid
+    return token
+
+def parse_wait(boxhome, form):
+    """Return box,dbname,table,version,rowid,timeout from the wait
+    method's parameters in *form*: version and rowid come from the
+    token= parameter, and are None if there is none.
+    """
+    boxs = form.getlist('box')
+    if len(boxs) != 1:
+        raise QueryError('Error: exactly one box= parameter should be specified', code=400)
+    version, rowid = None, None
+    token = form.getfirst('token')
+    if token:
+        version, _, rowid = token.partition('.')
+        try:
+            rowid = int(rowid) if rowid else None
+        except ValueError:
+            raise QueryError('Error: invalid token=', code=400)
+    try:
+        timeout = min(float(form.getfirst('timeout', 30)), MAX_WAIT)
+    except ValueError:
+        raise QueryError('Error: timeout= should be a number of seconds', code=400)
+    dbname = get_database_name(boxhome, boxs[0])
+    return boxs[0], dbname, form.getfirst('table'), version, rowid, timeout
+
+def wait_condition(boxhome, form):
+    """Return (dbname, identity, timeout) if the wait method with the
+    parameters in *form* would wait for the database to change, so
+    that a server can wait without tying up a thread, then run the
+    request with the dumptruck_web.wait environ variable set to False.
+    Otherwise return None.
+    """
+    try:
+        box, dbname, table, version, rowid, timeout = parse_wait(boxhome, form)
+    except QueryError:
+        return None
+    identity = database_identity(dbname)
+    if timeout <= 0 or version != wait_token(identity):
+        return None
+    return dbname, identity, timeout
+
+def wait_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the wait method, a long poll: once the box's
+    database is no longer the one the token= parameter stands for, or
+    after timeout= seconds (default 30), return the new token and
+    whether it has changed.  With no token= it returns at once.
+
+    With table=, the token also says which rows of that table have been
+    seen, and the rows added since then (up to WAIT_ROWS of them, by
+    rowid) are returned as well.
+    """
+    if form is None:
+        form = cgi.FieldStorage()
+    if environ is None:
+        environ = os.environ
+    timer = timer or Timer()
+    with timer.phase('resolve'):
+        box, dbname, table, version, rowid, timeout = parse_wait(boxhome, form)
+        timer.resolved(box, dbname)
+    identity = database_identity(dbname)
+    if environ.get('dumptruck_web.wait', True) and timeout > 0 and \
+            version == wait_token(identity):
+        with timer.phase('wait'):
+            changed = threading.Event()
+            WATCHER.watch(dbname, identity, timeout, changed.set)
+            changed.wait(timeout + 1)
+        identity = database_identity(dbname)
+
+    result = collections.OrderedDict()
+    result['changed'] = version != wait_token(identity)
+    if table is not None:
+        try:
+            with timer.phase('open'):
+                dt = CONNECTIONS.get(dbname)
+        except NotOK as e:
+            return Response(e.code, json.dumps(e.body) + '\n')
+        if dict(dt.tablesAndViews()).get(table) != 'table':
+            raise QueryError('Error: no such table: ' + table, code=404)
+        if rowid is None:
+            # Rows are followed from now on.
+            rowid = dt.execute(u'SELECT max(rowid) AS m FROM %s' % _quote_identifier(table),
+                commit=False)[0]['m'] or 0
+            result['rows'] = []
+        else:
+            rows = TableRows(dt, table, rowid + 1, MAX_ROWID, chunk=WAIT_ROWS,
+                budget=budget_for(box), timer=timer)
+            try:
+                with timer.phase('query'):
+                    rows.start(rowid + 1)
+                    batch = next(iter(rows), [])
+            except Exception, e:
+                code, error = error_for_exception(e, rows.meter)
+                return Response(code, json.dumps(error) + '\n')
+            result['rows'] = [collections.OrderedDict(zip(rows.columns, row)) for row in batch]
+            if batch:
+                rowid = batch[-1][0]
+            result['more'] = len(batch) == WAIT_ROWS
+    result['token'] = wait_token(identity, rowid)
+    return Response(200, json.dumps(result) + '\n')
+
+def slowlog_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the slowlog method: the query fingerprints
+    that took the most time, from SLOWLOG.  The optional parameters are
+    *box*, *since* (seconds, default a day) and *limit* (default 20).
+    """
+    if form is None:
+        form = cgi.FieldStorage()
+    try:
+        since = float(form.getfirst('since', 86400))
+        limit = int(form.getfirst('limit', 20))
+    except ValueError:
+        raise QueryError('Error: since= and limit= should be numbers', code=400)
+    report = SLOWLOG.report(box=form.getfirst('box'), since=since, limit=limit)
+    return Response(200, json.dumps(report) + '\n')
+
+# Boxes to warm up besides those SLOWLOG finds busy, comma separated.
+WARMUP_BOXES = [box for box in os.environ.get('DUMPTRUCK_WEB_WARMUP_BOXES', '').split(',') if box]
+# Most boxes warmed up, and the longest warming up may take.
+WARMUP_MAX_BOXES = int(os.environ.get('DUMPTRUCK_WEB_WARMUP_MAX_BOXES', 20))
+WARMUP_SECONDS = float(os.environ.get('DUMPTRUCK_WEB_WARMUP_SECONDS', 30))
+# Rows read from the start of each table, and bytes from the start of
+# each database file asked of the kernel with posix_fadvise.
+WARMUP_ROWS = int(os.environ.get('DUMPTRUCK_WEB_WARMUP_ROWS', 0))
+WARMUP_READAHEAD = int(os.environ.get('DUMPTRUCK_WEB_WARMUP_READAHEAD', 0))
+
+_POSIX_FADV_WILLNEED = 3
+
+def readahead(path, size):
+    """Ask the kernel to start reading the first *size* bytes of the
+    file *path* into the page cache, without waiting for it.  Return
+    whether it could be asked.
+    """
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        fadvise = libc.posix_fadvise
+    except (OSError, AttributeError):
+        return False
+    fadvise.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return False
+    try:
+        return fadvise(fd, 0, size, _POSIX_FADV_WILLNEED) == 0
+    finally:
+        os.close(fd)
+
+def warm_database(dbname, deadline, rows=0, readahead_bytes=0, pooled=False):
+    """Read the schema and every index of *dbname*, and the first
+    *rows* rows of each table, so that their pages are in the OS's
+    page cache, stopping at *deadline* (a time.time()).  The first
+    *readahead_bytes* of the file are asked for with readahead too.
+
+    The database is opened with open_dumptruck and closed afterwards,
+    so only the OS's cache stays warm.  If *pooled*, it is opened
+    through CONNECTIONS instead, which only helps when this thread then
+    serves requests for it, as CONNECTIONS keeps a thread's handles for
+    that thread.  Returns a dict saying what was read.  Raises NotOK
+    like open_dumptruck.
+    """
+    started = time.time()
+    dt = CONNECTIONS.get(dbname) if pooled else open_dumptruck(dbname)
+    if readahead_bytes:
+        readahead(dbname, readahead_bytes)
+    result = collections.OrderedDict([('indexes', 0), ('tables', 0), ('complete', True)])
+    meter = Budget(seconds=max(deadline - started, 0.001)).start(dt.connection)
+    try:
+        schema = dt.connection.execute(
+            "SELECT type, name, tbl_name FROM sqlite_master WHERE type IN ('table', 'index')").fetchall()
+        for type, name, table in schema:
+            if type == 'index':
+                columns = [column['name'] for column in dt.execute(
+                    u'PRAGMA index_info(%s)' % _quote_identifier(name), commit=False)]
+                if not columns or columns[0] is None:
+                    # On an expression.
+                    continue
+                # Not count(*), which SQLite answers from the smallest
+                # index whatever INDEXED BY says.
+                sql = u'SELECT count(%s) FROM %s INDEXED BY %s' % (_quote_identifier(columns[0]),
+                    _quote_identifier(table), _quote_identifier(name))
+            elif rows:
+                sql = u'SELECT * FROM %s LIMIT %d' % (_quote_identifier(table), rows)
+            else:
+                continue
+            try:
+                dt.connection.execute(sql).fetchall()
+            except sqlite3.DatabaseError:
+                if meter.exceeded:
+                    result['complete'] = False
+                    break
+                # Such as partial indexes, which can't be used for every
+                # row, or virtual tables whose module isn't loaded.
+                continue
+            result['indexes' if type == 'index' else 'tables'] += 1
+    finally:
+        dt.connection.set_progress_handler(None, 0)
+        if not pooled:
+            dt.close()
+    result['ms'] = (time.time() - started) * 1000
+    return result
+
+class Warmup(object):
+    """Warms up the databases of busy boxes after a worker starts; see
+    warm_database.
+
+    The boxes are *boxes* and then those with the most time in SLOWLOG,
+    at most *max_boxes* of them, warmed in that order until *seconds*
+    have passed.  The worker is *ready* once that is done, whether it
+    finished or ran out of time; the ready method says so.
+    """
+    def __init__(self, boxhome=BOXHOME, boxes=None, max_boxes=WARMUP_MAX_BOXES,
+            seconds=WARMUP_SECONDS, rows=WARMUP_ROWS, readahead_bytes=WARMUP_READAHEAD):
+        self.boxhome = boxhome
+        self.boxes = WARMUP_BOXES if boxes is None else boxes
+        self.max_boxes = max_boxes
+        self.seconds = seconds
+        self.rows = rows
+        self.readahead_bytes = readahead_bytes
+        self.state = 'pending'
+        self.elapsed = None
+        self.results = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self):
+        return self.state in ('done', 'timeout')
+
+    def hot_boxes(self):
+        boxes = list(self.boxes)
+        for box in SLOWLOG.hot_boxes(limit=self.max_boxes):
+            if box not in boxes:
+                boxes.append(box)
+        return boxes[:self.max_boxes]
+
+    def run(self, pooled=False):
+        """Warm up every box, in this thread.  Pass *pooled* if this
+        thread then serves requests, to keep the handles in CONNECTIONS
+        (see warm_database).
+        """
+        with self._lock:
+            if self.state != 'pending':
+                return
+            self.state = 'running'
+        started = time.time()
+        deadline = started + self.seconds
+        state = 'done'
+        for box in self.hot_boxes():
+            if time.time() >= deadline:
+                state = 'timeout'
+                break
+            try:
+                result = warm_database(get_database_name(self.boxhome, box), deadline,
+                    self.rows, self.readahead_bytes, pooled)
+                if not result['complete']:
+                    state = 'timeout'
+            except QueryError as e:
+                result = {'error': e.message}
+            except NotOK as e:
+                result = {'error': e.body}
+            with self._lock:
+                self.results[box] = result
+        self.elapsed = time.time() - started
+        self.state = state
+
+    def start(self):
+        """Warm up in a thread of its own, so that requests can still
+        be answered in the meantime.
+        """
+        thread = threading.Thread(target=self.run, name='warmup')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def as_dict(self):
+        with self._lock:
+            boxes = dict(self.results)
+        return {'state': self.state, 'ready': self.ready, 'seconds': self.elapsed,
+            'boxes': boxes}
+
+# Persistent workers should call WARMUP.run or WARMUP.start when they
+# start; until one has, the ready method says a worker is ready.
+WARMUP = None
+
+def ready_response(boxhome=BOXHOME, form=None, environ=None, timer=None):
+    """The Response for the ready method, for health checks: 200 once
+    WARMUP is over (or if there is none), otherwise a 503.
+    """
+    if WARMUP is None:
+        return Response(200, json.dumps({'ready': True}) + '\n')
+    return Response(200 if WARMUP.ready else 503, json.dumps(WARMUP.as_dict()) + '\n',
+        [('Content-Type', CONTENT_TYPE), ('Cache-Control', 'no-store')] +
+        ([] if WARMUP.ready else [('Retry-After', '1')]))
+
+METHODS = {
+    'sql': functools.partial(sql_response, stream=True),
+    'meta': meta_response,
+    'stats': stats_response,
+    'slowlog': slowlog_response,
+    'advise': advise_response,
+    'batch': batch_response,
+    'export': export_response,
+    'search': search_response,
+    'wait': wait_response,
+    'ready': ready_response,
+}
+
+# The CGI script sends each response in one go, so sql results are
+# encoded before the headers are written, and an error part way through
+# still gets its status code.
+CGI_METHODS = dict(METHODS, sql=sql_response)
+
+def handle(method, boxhome, form, environ, methods=METHODS):
+    """Return the finished Response for a call to *method*, one of
+    *methods*.
+    """
+    timer = Timer(method if method in methods else None)
+    if method is None:
+        response = Response(400,
+            json.dumps('Error: exactly one method= parameter should be specified') + '\n')
+    elif method not in methods:
+        response = Response(400, json.dumps('Invalid method') + '\n')
+    else:
+        try:
+            response = methods[method](boxhome, form, environ=environ, timer=timer)
+        except QueryError as e:
+            response = Response(e.code, json.dumps(e.message) + '\n')
+    return finish(response, environ, timer)
+
+def application(environ, start_response):
+    """WSGI entry point, for running under uWSGI, gunicorn and the like.
+
+    Takes the same parameters as the CGI script.  Unlike the CGI
+    script the process lives on between requests, so database
+    connections are reused from CONNECTIONS.  Results of the sql
+    method are streamed as they are read from the database.
+    """
+    form = cgi.FieldStorage(fp=environ.get('wsgi.input'), environ=environ)
+    boxhome = environ.get('dumptruck_web.boxhome', BOXHOME)
+    methods = form.getlist('method')
+    method = methods[0] if len(methods) == 1 else None
+    return handle(method, boxhome, form, environ).wsgi(start_response)
+
 if __name__ == '__main__':
     form = cgi.FieldStorage()
     methods = form.getlist('method')
-    if len(methods) != 1:
-        print '"Error: exactly one method= parameter should be specified"'
-
-    method = methods[0]
+    method = methods[0] if len(methods) == 1 else None
 
-    if method == 'sql':
-        print sql()
-    elif method == 'meta':
-        print meta()
-    else:
-        print 'Invalid method'
+    # The body may be compressed, so it mustn't get an extra newline
+    # from print.
+    sys.stdout.write(handle(method, BOXHOME, form, os.environ, CGI_METHODS).cgi())
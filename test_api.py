@@ -1,12 +1,23 @@
 #!/usr/bin/env python
 
 import os
+import cgi
 import json
+import re
+import socket
+import threading
+import time
+import urllib
+import urllib2
+import zlib
 from nose.tools import *
 import unittest
 
 import dumptruck
-from dumptruck_web import sql, meta
+from dumptruck_web import sql, meta, application, handle, CGI_METHODS
+from dumptruck_server import Server, Executor, Full
+import dumptruck_bench
+import dumptruck_web
 
 # Directory in which boxes are created.
 BOXHOME = os.path.join('/', 'tmp', 'boxtests')
@@ -21,6 +32,11 @@ os.environ['HOME'] = JACK
 DB = os.path.join(JACK, 'dumptruck.db')
 SW_JSON = os.path.join(JACK, 'box.json')
 
+# The Server-Timing header sent with responses.
+TIMING_HEADER = r'\nServer-Timing: [a-z]+;dur=[0-9.]+(, [a-z]+;dur=[0-9.]+)*'
+# The ETag and Cache-Control headers sent with successful responses.
+CACHE_HEADERS = r'\nETag: "[0-9a-f]{40}"\nCache-Control: no-cache' + TIMING_HEADER
+
 def sql_helper(*args, **kwargs):
     if 'boxhome' not in kwargs:
         kwargs['boxhome'] = BOXHOME
@@ -31,6 +47,19 @@ def meta_helper(*args, **kwargs):
         kwargs['boxhome'] = BOXHOME
     return meta(*args, **kwargs)
 
+def wsgi_helper(query_string, **environ):
+    """Call the WSGI application with *query_string* and return
+    (status, headers, body)."""
+    environ.setdefault('dumptruck_web.boxhome', BOXHOME)
+    environ.setdefault('REQUEST_METHOD', 'GET')
+    environ['QUERY_STRING'] = query_string
+    started = []
+    def start_response(status, headers):
+        started.append((status, headers))
+    body = ''.join(application(environ, start_response))
+    status, headers = started[0]
+    return status, headers, body
+
 
 class TestCGI(unittest.TestCase):
     """CGI"""
@@ -45,12 +74,26 @@ class TestCGI(unittest.TestCase):
 
         self.dt = dumptruck.DumpTruck(dbname=DB)
 
+    def test_script_interrupted(self):
+        """The CGI script gives a status code for errors after the first rows."""
+        os.system('cp fixtures/sw.json.dumptruck.db ' + SW_JSON)
+        self.dt.insert([{u'n': i} for i in range(3000)], 'numbers')
+        form = cgi.FieldStorage(environ={'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': 'method=sql&box=jack-in-a&q=SELECT+n+FROM+numbers'})
+        old = dumptruck_web.BUDGETS
+        dumptruck_web.BUDGETS = {'jack-in-a': dumptruck_web.Budget(steps=3000)}
+        try:
+            http = handle('sql', BOXHOME, form, {}, CGI_METHODS).cgi()
+        finally:
+            dumptruck_web.BUDGETS = old
+        self.assertEqual(http.split('\n')[0], 'HTTP/1.1 503 Service Unavailable')
+
     def test_cgi_400_fake(self):
         """Result from execute_query() call appears as HTTP Status."""
         os.environ['QUERY_STRING'] = 'qqqq=SELECT+favorite_color+FROM+person&box=jack-in-a'
         import dumptruck_web
         old_fn = dumptruck_web.execute_query
-        dumptruck_web.execute_query = lambda q, d: (400, 'Blah blah blah')
+        dumptruck_web.execute_query = lambda q, d, **k: (400, 'Blah blah blah')
         try:
             observed = sql_helper().split('\n')[0]
         finally:
@@ -76,7 +119,7 @@ class TestCGI(unittest.TestCase):
         expected = ('HTTP/1.1 200 OK\n' +
             'Status: 200 OK\n' +
             'Content-Type: application/json; charset=utf-8')
-        self.assertEqual(observed[0], expected)
+        self.assertRegexpMatches(observed[0], '^' + re.escape(expected) + CACHE_HEADERS + '$')
         expected = [{"favorite_color": "Green"}]
         self.assertEqual(json.loads(observed[1]), expected)
 
@@ -102,11 +145,65 @@ class TestCGI(unittest.TestCase):
             'HTTP/1.1 200 OK',
             'Status: 200 OK',
             'Content-Type: application/json; charset=utf-8',
+            observed[3],
+            'Cache-Control: no-cache',
+            observed[5],
             '',
             '[]',
             '',
         ]
         self.assertListEqual(observed, expected)
+        self.assertRegexpMatches(observed[3], '^ETag: "[0-9a-f]{40}"$')
+        self.assertRegexpMatches(observed[5], '^Server-Timing: resolve;dur=')
+
+    def test_format_columns(self):
+        """format=columns sends the column names once."""
+        self.dt.insert([{u'name': u'Aidan', u'favorite_color': u'Green'},
+            {u'name': u'Bob', u'favorite_color': None}], 'person')
+        os.environ['QUERY_STRING'] = 'q=SELECT+name,favorite_color+FROM+person&box=jack-in-a&format=columns'
+        header, body = sql_helper().split('\n\n', 1)
+        self.assertIn('Content-Type: application/json; charset=utf-8', header)
+        self.assertEqual(json.loads(body), {
+            "columns": ["name", "favorite_color"],
+            "rows": [["Aidan", "Green"], ["Bob", None]]})
+
+    def test_format_ndjson(self):
+        """format=ndjson gives one object per line."""
+        self.dt.insert([{u'n': 1}, {u'n': 2}], 'numbers')
+        os.environ['QUERY_STRING'] = 'q=SELECT+n+FROM+numbers&box=jack-in-a&format=ndjson'
+        header, body = sql_helper().split('\n\n', 1)
+        self.assertIn('Content-Type: application/x-ndjson; charset=utf-8', header)
+        self.assertEqual([json.loads(line) for line in body.splitlines()],
+            [{"n": 1}, {"n": 2}])
+
+        # A statement without columns has no lines.
+        os.environ['QUERY_STRING'] = 'q=%3B&box=jack-in-a&format=ndjson'
+        header, body = sql_helper().split('\n\n', 1)
+        self.assertEqual(header.split('\n')[0], 'HTTP/1.1 200 OK')
+        self.assertEqual(body, '')
+
+    def test_format_csv(self):
+        """format=csv gives CSV with a header line."""
+        self.dt.insert([{u'name': u'Aidan, "A"', u'n': 1},
+            {u'name': u'\xc9mile', u'n': None}], 'person')
+        os.environ['QUERY_STRING'] = 'q=SELECT+name,n+FROM+person&box=jack-in-a&format=csv'
+        header, body = sql_helper().split('\n\n', 1)
+        self.assertIn('Content-Type: text/csv; charset=utf-8; header=present', header)
+        self.assertEqual(body, 'name,n\r\n"Aidan, ""A""",1\r\n\xc3\x89mile,\r\n')
+
+    def test_format_error(self):
+        """Errors are JSON whatever the format."""
+        os.environ['QUERY_STRING'] = 'q=chainsaw&box=jack-in-a&format=csv'
+        header, body = sql_helper().split('\n\n', 1)
+        self.assertIn('400 Bad Request', header)
+        self.assertIn('Content-Type: application/json; charset=utf-8', header)
+        self.assertIn('syntax error', json.loads(body))
+
+    def test_format_unknown(self):
+        """An unknown format is a Bad Request."""
+        os.environ['QUERY_STRING'] = 'q=SELECT+1&box=jack-in-a&format=xml'
+        observed = sql_helper().split('\n')[0]
+        self.assertEqual(observed, 'HTTP/1.1 400 Bad Request')
 
     def testMetaSimple(self):
         """Test the metadata endpoint."""
@@ -118,7 +215,7 @@ class TestCGI(unittest.TestCase):
         expected = ('HTTP/1.1 200 OK\n' +
             'Status: 200 OK\n' +
             'Content-Type: application/json; charset=utf-8')
-        self.assertEqual(header, expected)
+        self.assertRegexpMatches(header, '^' + re.escape(expected) + CACHE_HEADERS + '$')
         # we expect an empty database.
         expected = {"table": {}, "grid": {}, "databaseType": "sqlite3"}
         self.assertEqual(json.loads(body), expected)
@@ -140,7 +237,7 @@ class TestCGI(unittest.TestCase):
         expected = ('HTTP/1.1 404 Not Found\n' +
             'Status: 404 Not Found\n' +
             'Content-Type: application/json; charset=utf-8')
-        self.assertEqual(header, expected)
+        self.assertRegexpMatches(header, '^' + re.escape(expected) + TIMING_HEADER + '$')
         # The body should be a JSON object with an 'error' key.
         bodyJSON = json.loads(body)
         self.assertIn('error', bodyJSON.keys())
@@ -156,7 +253,7 @@ class TestCGI(unittest.TestCase):
         expected = ('HTTP/1.1 200 OK\n' +
             'Status: 200 OK\n' +
             'Content-Type: application/json; charset=utf-8')
-        self.assertEqual(header, expected)
+        self.assertRegexpMatches(header, '^' + re.escape(expected) + CACHE_HEADERS + '$')
         # we expect an empty database.
         expected = {"table": {}, "grid": {}, "databaseType": "none"}
         # self.assertEqual(json.loads(body), expected)
@@ -231,6 +328,530 @@ class TestCGI(unittest.TestCase):
         self.assertEqual(jbody['grid']['a7950545bec5888726b6b7fc2b054258']['title'], 'My First Grid')
         self.assertEqual(jbody['grid']['a7950545bec5888726b6b7fc2b054258']['number'], 1)
 
+class TestWSGI(unittest.TestCase):
+    """WSGI"""
+    def setUp(self):
+        try:
+            os.remove(DB)
+        except OSError:
+            pass
+
+        if not os.path.isdir(JACK):
+            os.makedirs(JACK)
+
+        os.system('cp fixtures/sw.json.dumptruck.db ' + SW_JSON)
+        self.dt = dumptruck.DumpTruck(dbname=DB)
+
+    def test_sql(self):
+        """The sql method gives the same body as the CGI script."""
+        self.dt.insert({u'name': u'Aidan', u'favorite_color': u'Green'}, 'person')
+        status, headers, body = wsgi_helper(
+            'method=sql&q=SELECT+favorite_color+FROM+person&box=jack-in-a')
+        self.assertEqual(status, '200 OK')
+        self.assertIn(('Content-Type', 'application/json; charset=utf-8'), headers)
+        self.assertEqual(json.loads(body), [{"favorite_color": "Green"}])
+
+    def test_sql_streamed(self):
+        """The body of the sql method is a generator."""
+        self.dt.insert([{u'n': i} for i in range(1200)], 'numbers')
+        environ = {'dumptruck_web.boxhome': BOXHOME, 'REQUEST_METHOD': 'GET',
+            'QUERY_STRING': 'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a'}
+        body = application(environ, lambda status, headers: None)
+        self.assertFalse(isinstance(body, (list, str)))
+        self.assertEqual(json.loads(''.join(body)), [{'n': i} for i in range(1200)])
+
+    def test_sql_paged(self):
+        """With page_size, the sql method sends a cursor for the next page."""
+        self.dt.insert([{u'n': i} for i in range(5)], 'numbers')
+        query = 'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a&page_size=3&order_by=n'
+        status, headers, body = wsgi_helper(query)
+        self.assertEqual(json.loads(body), [{'n': 0}, {'n': 1}, {'n': 2}])
+        status, headers, body = wsgi_helper(query + '&next=' + dict(headers)['Next-Cursor'])
+        self.assertEqual(json.loads(body), [{'n': 3}, {'n': 4}])
+        self.assertNotIn('Next-Cursor', dict(headers))
+        status, headers, body = wsgi_helper(query + '&next=eyJ4Ijog')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_sql_error(self):
+        """Errors from the sql method still set the status."""
+        status, headers, body = wsgi_helper('method=sql&q=chainsaw&box=jack-in-a')
+        self.assertEqual(status, '400 Bad Request')
+        self.assertEqual(json.loads(body), u'SQL error: near "chainsaw": syntax error')
+
+    def test_gzip(self):
+        """Large bodies are gzipped when the client accepts it."""
+        self.dt.insert([{u'n': i} for i in range(1200)], 'numbers')
+        status, headers, body = wsgi_helper(
+            'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a',
+            HTTP_ACCEPT_ENCODING='deflate;q=0.5, gzip')
+        self.assertIn(('Content-Encoding', 'gzip'), headers)
+        self.assertIn(('Vary', 'Accept-Encoding'), headers)
+        data = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.assertEqual(json.loads(data), [{'n': i} for i in range(1200)])
+
+    def test_deflate(self):
+        """deflate is used if gzip isn't accepted."""
+        self.dt.insert([{u'n': i} for i in range(1200)], 'numbers')
+        status, headers, body = wsgi_helper(
+            'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a',
+            HTTP_ACCEPT_ENCODING='gzip;q=0, deflate')
+        self.assertIn(('Content-Encoding', 'deflate'), headers)
+        self.assertEqual(len(json.loads(zlib.decompress(body))), 1200)
+
+    def test_small_body_uncompressed(self):
+        """Small bodies aren't compressed."""
+        status, headers, body = wsgi_helper(
+            'method=sql&q=SELECT+1+AS+one&box=jack-in-a',
+            HTTP_ACCEPT_ENCODING='gzip')
+        self.assertNotIn('Content-Encoding', dict(headers))
+        self.assertEqual(json.loads(body), [{'one': 1}])
+
+    def test_result_cache(self):
+        """Cached results are used until the database changes."""
+        import dumptruck_web
+        old_cache = dumptruck_web.RESULT_CACHE
+        dumptruck_web.RESULT_CACHE = dumptruck_web.ResultCache(max_bytes=10000)
+        old_execute = dumptruck_web.stream_query
+        calls = []
+        def stream_query(*args, **kwargs):
+            calls.append(args)
+            return old_execute(*args, **kwargs)
+        dumptruck_web.stream_query = stream_query
+        try:
+            self.dt.insert({u'n': 1}, 'numbers')
+            query = 'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a&format=columns'
+            first = wsgi_helper(query)
+            self.assertEqual(wsgi_helper(query.replace('+', '++'))[2], first[2])
+            self.assertEqual(len(calls), 1)
+            self.dt.insert({u'n': 2}, 'numbers')
+            self.assertEqual(json.loads(wsgi_helper(query)[2])['rows'], [[1], [2]])
+            self.assertEqual(len(calls), 2)
+        finally:
+            dumptruck_web.RESULT_CACHE = old_cache
+            dumptruck_web.stream_query = old_execute
+
+    def test_not_modified(self):
+        """A matching If-None-Match gives 304 without running the query."""
+        import dumptruck_web
+        self.dt.insert({u'n': 1}, 'numbers')
+        query = 'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a'
+        status, headers, body = wsgi_helper(query)
+        etag = dict(headers)['ETag']
+
+        old_stream_query = dumptruck_web.stream_query
+        dumptruck_web.stream_query = None
+        try:
+            status, headers, body = wsgi_helper(query,
+                HTTP_IF_NONE_MATCH='"other", ' + etag)
+        finally:
+            dumptruck_web.stream_query = old_stream_query
+        self.assertEqual(status, '304 Not Modified')
+        self.assertEqual(dict(headers)['ETag'], etag)
+        self.assertEqual(body, '')
+
+        # A different query or a changed database has a different ETag.
+        status, headers, body = wsgi_helper(query + '&format=csv',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '200 OK')
+        self.dt.insert({u'n': 2}, 'numbers')
+        status, headers, body = wsgi_helper(query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '200 OK')
+        self.assertNotEqual(dict(headers)['ETag'], etag)
+
+    def test_etag_comments(self):
+        """Queries differing only in where a comment ends have different ETags."""
+        status, headers, body = wsgi_helper('method=sql&box=jack-in-a&q=' +
+            urllib.quote('SELECT 1 AS x -- c\n, 2 AS y'))
+        self.assertEqual(json.loads(body), [{'x': 1, 'y': 2}])
+        status, other, body = wsgi_helper('method=sql&box=jack-in-a&q=' +
+            urllib.quote('SELECT 1 AS x -- c , 2 AS y'), HTTP_IF_NONE_MATCH=dict(headers)['ETag'])
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body), [{'x': 1}])
+
+    def test_not_modified_gzip(self):
+        """Compressed responses have their own ETag, which still matches."""
+        self.dt.insert([{u'n': i} for i in range(1200)], 'numbers')
+        query = 'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a'
+        plain = dict(wsgi_helper(query)[1])['ETag']
+        status, headers, body = wsgi_helper(query, HTTP_ACCEPT_ENCODING='gzip')
+        etag = dict(headers)['ETag']
+        self.assertEqual(etag, plain[:-1] + '-gzip"')
+        status, headers, body = wsgi_helper(query, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+
+    def test_meta_not_modified(self):
+        """The meta method supports If-None-Match too."""
+        status, headers, body = wsgi_helper('method=meta&box=jack-in-a')
+        etag = dict(headers)['ETag']
+        status, headers, body = wsgi_helper('method=meta&box=jack-in-a',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+
+    def test_meta_many(self):
+        """The meta method takes many boxes, or a glob."""
+        self.dt.insert({'akey': 'avalue'}, 'newtable')
+        status, headers, body = wsgi_helper('method=meta&box=jack-in-a&box=no-such-box')
+        self.assertEqual(status, '200 OK')
+        result = json.loads(body)
+        self.assertEqual(sorted(result), ['jack-in-a', 'no-such-box'])
+        self.assertTrue(body.index('"jack-in-a"') < body.index('"no-such-box"'))
+        self.assertEqual(result['jack-in-a']['table']['newtable']['columnNames'], ['akey'])
+        self.assertEqual(result['no-such-box']['databaseType'], 'none')
+
+        etag = dict(headers)['ETag']
+        status, headers, body = wsgi_helper('method=meta&box=jack-in-a&box=no-such-box',
+            HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(status, '304 Not Modified')
+
+        status, headers, body = wsgi_helper('method=meta&box_glob=jack-in-*')
+        self.assertEqual(sorted(json.loads(body)), ['jack-in-a'])
+        status, headers, body = wsgi_helper('method=meta&box_glob=jack-in-*&box=jack-in-a')
+        self.assertEqual(status, '400 Bad Request')
+        status, headers, body = wsgi_helper('method=meta&box_glob=../*')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_search(self):
+        """The search method gives the matching rows, best first."""
+        self.dt.insert([{u'title': u'pie', u'text': u'apple ' * (i + 1), u'n': i}
+            for i in range(5)], 'recipes')
+        status, headers, body = wsgi_helper('method=search&box=jack-in-a&table=recipes&q=apple')
+        self.assertEqual(status, '404 Not Found')
+        dumptruck_web.SEARCH_DIR = os.path.join(BOXHOME, 'search')
+        try:
+            status, headers, body = wsgi_helper(
+                'method=search&box=jack-in-a&table=recipes&q=apple&limit=2')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(json.loads(body), [{u'title': u'pie', u'text': u'apple ' * 5, u'n': 4},
+                {u'title': u'pie', u'text': u'apple ' * 4, u'n': 3}])
+            status, headers, body = wsgi_helper('method=search&box=jack-in-a&table=recipes&q=AND')
+            self.assertEqual(status, '400 Bad Request')
+            status, headers, body = wsgi_helper('method=search&box=jack-in-a&table=nope&q=apple')
+            self.assertEqual(status, '404 Not Found')
+        finally:
+            dumptruck_web.SEARCH_DIR = None
+
+    def test_ready(self):
+        """The ready method says whether warming up is over."""
+        self.assertEqual(wsgi_helper('method=ready')[0], '200 OK')
+        dumptruck_web.WARMUP = dumptruck_web.Warmup(BOXHOME, boxes=['jack-in-a'])
+        try:
+            self.assertEqual(wsgi_helper('method=ready')[0], '503 Service Unavailable')
+            dumptruck_web.WARMUP.run()
+            status, headers, body = wsgi_helper('method=ready')
+            self.assertEqual(status, '200 OK')
+            self.assertEqual(json.loads(body)['state'], 'done')
+        finally:
+            dumptruck_web.WARMUP = None
+
+    def test_server_timing(self):
+        """The time taken by each phase is sent as Server-Timing."""
+        self.dt.insert({u'n': 1}, 'numbers')
+        status, headers, body = wsgi_helper('method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a')
+        phases = [part.split(';')[0] for part in dict(headers)['Server-Timing'].split(', ')]
+        self.assertEqual(phases, ['resolve', 'open', 'query'])
+
+    def test_stats(self):
+        """The stats method has histograms and counters."""
+        self.dt.insert({u'n': 1}, 'numbers')
+        wsgi_helper('method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a')
+        wsgi_helper('method=sql&q=chainsaw&box=jack-in-a')
+        status, headers, body = wsgi_helper('method=stats')
+        stats = json.loads(body)
+        self.assertGreaterEqual(stats['latency']['box']['jack-in-a']['count'], 2)
+        self.assertGreaterEqual(stats['latency']['method']['sql']['count'], 2)
+        self.assertIn('sql.query', stats['latency']['phase'])
+        self.assertGreaterEqual(stats['counters']['status.200'], 1)
+        self.assertGreaterEqual(stats['counters']['status.400'], 1)
+        self.assertGreaterEqual(stats['counters']['rows'], 1)
+        self.assertGreater(stats['counters']['bytes'], 0)
+
+    def test_stats_boxes(self):
+        """Only boxes with a database, and only recent ones, get histograms."""
+        wsgi_helper('method=sql&q=SELECT+1&box=nosuch')
+        wsgi_helper('method=meta&box=ghost')
+        status, headers, body = wsgi_helper('method=stats')
+        boxes = json.loads(body)['latency']['box']
+        self.assertNotIn('nosuch', boxes)
+        self.assertNotIn('ghost', boxes)
+
+        stats = dumptruck_web.Stats(max_boxes=2)
+        for box in ['a', 'b', 'a', 'c']:
+            timer = dumptruck_web.Timer('sql')
+            timer.box = box
+            stats.record(timer, 200, 0)
+        self.assertEqual(sorted(stats.as_dict()['latency']['box']), ['a', 'c'])
+
+    def test_slowlog(self):
+        """Slow queries are reported by the slowlog method."""
+        import dumptruck_web
+        old_slowlog = dumptruck_web.SLOWLOG
+        path = os.path.join(BOXHOME, 'slowlog.sqlite')
+        dumptruck_web.SLOWLOG = dumptruck_web.SlowLog(path, threshold=0)
+        try:
+            self.dt.insert({u'n': 1}, 'numbers')
+            for n in [1, 2]:
+                wsgi_helper('method=sql&q=SELECT+n+FROM+numbers+WHERE+n=%d&box=jack-in-a' % n)
+            status, headers, body = wsgi_helper('method=slowlog&box=jack-in-a')
+            report = json.loads(body)
+            self.assertEqual(report[0]['fingerprint'], 'select n from numbers where n=?')
+            self.assertEqual(report[0]['calls'], 2)
+            self.assertEqual(report[0]['rows'], 1)
+        finally:
+            dumptruck_web.SLOWLOG = old_slowlog
+            os.remove(path)
+
+    def test_advise(self):
+        """The advise method suggests indexes for the given queries."""
+        self.dt.insert([{u'a': i % 10, u'b': i} for i in range(100)], 't')
+        status, headers, body = wsgi_helper('method=advise&box=jack-in-a'
+            '&q=SELECT+*+FROM+t+WHERE+a=1&q=DROP+TABLE+t')
+        self.assertEqual(status, '200 OK')
+        advice = json.loads(body)
+        self.assertEqual(advice[0]['scans'][0]['suggestion'], 'CREATE INDEX "idx_t_a" ON "t" ("a")')
+        self.assertEqual(advice[1]['error'], 'Database error: not authorized')
+
+    def test_batch(self):
+        """The batch method gives a status and data for each query."""
+        self.dt.insert({u'n': 1}, 'numbers')
+        status, headers, body = wsgi_helper('method=batch&box=jack-in-a'
+            '&q=SELECT+n+FROM+numbers&q=DROP+TABLE+numbers')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body), [{'status': 200, 'data': [{'n': 1}]},
+            {'status': 403, 'data': 'Database error: not authorized'}])
+
+    def test_batch_post(self):
+        """The batch method's queries can be POSTed as a JSON list."""
+        import cStringIO, urllib
+        self.dt.insert({u'n': 1}, 'numbers')
+        data = urllib.urlencode({'queries': json.dumps(['SELECT n FROM numbers', 'SELECT 2 AS m'])})
+        status, headers, body = wsgi_helper('method=batch&box=jack-in-a',
+            REQUEST_METHOD='POST', CONTENT_TYPE='application/x-www-form-urlencoded',
+            CONTENT_LENGTH=str(len(data)), **{'wsgi.input': cStringIO.StringIO(data)})
+        self.assertEqual([entry['data'] for entry in json.loads(body)], [[{'n': 1}], [{'m': 2}]])
+        status, headers, body = wsgi_helper('method=batch&box=jack-in-a&queries=[1]')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_export(self):
+        """The export method streams a table as ndjson, from any rowid."""
+        self.dt.insert([{u'n': i} for i in range(5)], 'numbers')
+        self.dt.execute('CREATE VIEW odd AS SELECT n FROM numbers WHERE n % 2')
+        status, headers, body = wsgi_helper('method=export&box=jack-in-a&table=numbers')
+        self.assertEqual(status, '200 OK')
+        self.assertIn(('Accept-Ranges', 'rowid'), headers)
+        self.assertEqual([json.loads(line) for line in body.splitlines()],
+            [{'rowid': i + 1, 'n': i} for i in range(5)])
+
+        status, headers, body = wsgi_helper('method=export&box=jack-in-a&table=numbers',
+            HTTP_RANGE='rowid=4-')
+        self.assertEqual(status, '206 Partial Content')
+        self.assertIn(('Content-Range', 'rowid 4-5/*'), headers)
+        self.assertEqual([json.loads(line)['n'] for line in body.splitlines()], [3, 4])
+        status, headers, body = wsgi_helper('method=export&box=jack-in-a&table=numbers'
+            '&from_rowid=2&to_rowid=3&format=csv')
+        self.assertEqual(body, 'rowid,n\r\n2,1\r\n3,2\r\n')
+
+        status, headers, body = wsgi_helper('method=export&box=jack-in-a&table=odd')
+        self.assertEqual(status, '400 Bad Request')
+        status, headers, body = wsgi_helper('method=export&box=jack-in-a&table=x%22;--')
+        self.assertEqual(status, '404 Not Found')
+
+    def test_wait(self):
+        """The wait method returns when the database changes, with the new rows."""
+        self.dt.insert({u'n': 1}, 'numbers')
+        query = 'method=wait&box=jack-in-a&table=numbers&timeout=0.2'
+        status, headers, body = wsgi_helper(query)
+        first = json.loads(body)
+        self.assertEqual(first['changed'], True)
+        self.assertEqual(first['rows'], [])
+
+        second = json.loads(wsgi_helper(query + '&token=' + first['token'])[2])
+        self.assertEqual(second['changed'], False)
+        self.assertEqual(second['token'], first['token'])
+
+        threading.Timer(0.1, lambda: dumptruck.DumpTruck(dbname=DB).insert({u'n': 2}, 'numbers')).start()
+        third = json.loads(wsgi_helper(query.replace('0.2', '10') + '&token=' + first['token'])[2])
+        self.assertEqual(third['changed'], True)
+        self.assertEqual(third['rows'], [{'rowid': 2, 'n': 2}])
+        self.assertNotEqual(third['token'], first['token'])
+
+    def test_meta(self):
+        """The meta method works."""
+        self.dt.insert({'akey': 'avalue'}, "newtable")
+        status, headers, body = wsgi_helper('method=meta&box=jack-in-a')
+        self.assertEqual(status, '200 OK')
+        self.assertEqual(json.loads(body)['table']['newtable']['columnNames'], ['akey'])
+
+    def test_bad_method(self):
+        """Unknown or missing methods are a Bad Request."""
+        status, headers, body = wsgi_helper('method=drop&box=jack-in-a')
+        self.assertEqual(status, '400 Bad Request')
+        status, headers, body = wsgi_helper('box=jack-in-a')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_meta_without_box(self):
+        """QueryError from the meta method becomes a status code."""
+        status, headers, body = wsgi_helper('method=meta')
+        self.assertEqual(status, '400 Bad Request')
+
+    def test_database_replaced(self):
+        """A pooled connection isn't used once the database file is replaced."""
+        self.dt.insert({'p': 1}, 'bacon')
+        query = 'method=sql&q=SELECT+p+FROM+bacon&box=jack-in-a'
+        self.assertEqual(json.loads(wsgi_helper(query)[2]), [{'p': 1}])
+
+        os.remove(DB)
+        dt = dumptruck.DumpTruck(dbname=DB)
+        dt.insert({'p': 2}, 'bacon')
+        self.assertEqual(json.loads(wsgi_helper(query)[2]), [{'p': 2}])
+
+class TestServer(unittest.TestCase):
+    """Standalone server"""
+    def setUp(self):
+        try:
+            os.remove(DB)
+        except OSError:
+            pass
+        if not os.path.isdir(JACK):
+            os.makedirs(JACK)
+        os.system('cp fixtures/sw.json.dumptruck.db ' + SW_JSON)
+        self.dt = dumptruck.DumpTruck(dbname=DB)
+        self.dt.insert([{u'n': i} for i in range(2000)], 'numbers')
+        self.server = Server(('127.0.0.1', 0), boxhome=BOXHOME, executor=Executor(4, 2),
+            send_buffer=1024)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:%d/?' % self.server.address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.thread.join()
+
+    def test_sql(self):
+        """Queries are answered as by the WSGI application."""
+        response = urllib2.urlopen(self.url + 'method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a')
+        self.assertEqual(response.info()['Content-Type'], 'application/json; charset=utf-8')
+        self.assertEqual(json.loads(response.read()), [{'n': i} for i in range(2000)])
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            urllib2.urlopen(self.url + 'method=sql&q=chainsaw&box=jack-in-a')
+        self.assertEqual(cm.exception.code, 400)
+
+    def test_slow_clients(self):
+        """Clients that don't read their responses don't hold up others."""
+        idle = []
+        for i in range(10):
+            sock = socket.create_connection(self.server.address)
+            sock.sendall('GET /?method=sql&q=SELECT+n+FROM+numbers&box=jack-in-a HTTP/1.0\r\n\r\n')
+            idle.append(sock)
+        try:
+            response = urllib2.urlopen(self.url + 'method=meta&box=jack-in-a')
+            self.assertIn('numbers', json.loads(response.read())['table'])
+        finally:
+            for sock in idle:
+                sock.close()
+
+    def test_wait(self):
+        """Waiting requests don't take a thread while they wait."""
+        token = json.loads(urllib2.urlopen(self.url + 'method=wait&box=jack-in-a').read())['token']
+        waiting = []
+        def wait():
+            waiting.append(urllib2.urlopen(self.url + 'method=wait&box=jack-in-a&timeout=10&token='
+                + token).read())
+        threads = [threading.Thread(target=wait) for i in range(6)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.2)
+        # The executor only has four threads.
+        response = urllib2.urlopen(self.url + 'method=sql&q=SELECT+count(*)+AS+c+FROM+numbers'
+            '&box=jack-in-a')
+        self.assertEqual(json.loads(response.read()), [{'c': 2000}])
+        self.assertEqual(waiting, [])
+        self.dt.insert({u'n': 1}, 'numbers')
+        for thread in threads:
+            thread.join()
+        self.assertEqual([json.loads(body)['changed'] for body in waiting], [True] * 6)
+
+    def test_per_box(self):
+        """A box can only use per_box threads at once."""
+        executor = Executor(threads=3, per_box=1)
+        release = threading.Event()
+        ran = []
+        try:
+            executor.submit('busy', release.wait)
+            executor.submit('busy', lambda: ran.append('busy'))
+            done = threading.Event()
+            executor.submit('other', done.set)
+            self.assertTrue(done.wait(5))
+            self.assertEqual(ran, [])
+        finally:
+            release.set()
+            executor.shutdown()
+        self.assertEqual(ran, ['busy'])
+
+    def test_round_robin(self):
+        """Boxes with jobs waiting take turns."""
+        executor = Executor(threads=1, per_box=1, max_queue=2)
+        release = threading.Event()
+        ran = []
+        try:
+            executor.submit('x', release.wait)
+            for job in ['a1', 'a2']:
+                executor.submit('a', lambda job=job: ran.append(job))
+            self.assertRaises(Full, executor.submit, 'a', None)
+            executor.submit('b', lambda: ran.append('b1'))
+            release.set()
+        finally:
+            executor.shutdown()
+        self.assertEqual(ran, ['a1', 'b1', 'a2'])
+        metrics = executor.metrics()
+        self.assertEqual(metrics['a']['rejected'], 1)
+        self.assertEqual(metrics['a']['admitted'], 2)
+        self.assertEqual(metrics['a']['wait']['count'], 2)
+
+    def test_idle_boxes(self):
+        """Idle boxes' queues are dropped, and only recent boxes' metrics kept."""
+        executor = Executor(threads=2, per_box=1, max_metrics=2)
+        try:
+            for box in ['a', 'b', 'c']:
+                executor.submit(box, lambda: None)
+            executor.max_queue = 0
+            self.assertRaises(Full, executor.submit, 'd', None)
+        finally:
+            executor.shutdown()
+        self.assertEqual(executor._queues, {})
+        metrics = executor.metrics()
+        self.assertEqual(sorted(metrics), ['c', 'd'])
+        self.assertEqual(metrics['c']['admitted'], 1)
+        self.assertEqual(metrics['d']['rejected'], 1)
+
+    def test_full(self):
+        """Requests for a box whose queue is full get a 503 at once."""
+        self.server.executor.max_queue = 0
+        with self.assertRaises(urllib2.HTTPError) as cm:
+            urllib2.urlopen(self.url + 'method=sql&q=SELECT+1&box=jack-in-a')
+        self.assertEqual(cm.exception.code, 503)
+        self.assertGreaterEqual(int(cm.exception.info()['Retry-After']), 1)
+        self.server.executor.max_queue = 10
+        stats = json.loads(urllib2.urlopen(self.url + 'method=stats').read())
+        self.assertEqual(stats['queues']['jack-in-a']['rejected'], 1)
+
+class TestBench(unittest.TestCase):
+    """Benchmarks"""
+    def test_targets(self):
+        """Every entry point sends the same bytes for the same requests."""
+        reports = [dumptruck_bench.benchmark(target, boxes=3, rows=200, requests=30, concurrency=3)
+            for target in dumptruck_bench.TARGETS]
+        for report in reports:
+            self.assertEqual(report['config']['requests'], 30)
+            for method in ['sql', 'meta']:
+                result = report['results'][method]
+                self.assertEqual(result['status'], {'200': 30})
+                self.assertTrue(result['latency_ms']['p50'] <= result['latency_ms']['p99'])
+                self.assertTrue(result['peak_rss_kb'] > 0)
+        self.assertEqual(reports[0]['results']['sql']['peak_rss_of'], 'largest CGI process')
+        self.assertEqual(len(set(report['results']['sql']['bytes_out'] for report in reports)), 1)
+        self.assertEqual(dumptruck_bench.compare(reports[0], reports[1])[0][:15], 'sql: throughput')
+
+
 class TestAPI(unittest.TestCase):
     """API"""
     def _q(self, dbname, p, output_check=None, code_check=None):
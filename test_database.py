@@ -1,11 +1,28 @@
 #!/usr/bin/env python
 
+import cStringIO
+import json
 import os
+import shutil
+import sqlite3
+import sys
+import threading
+import time
 import unittest
+import zlib
 
 import dumptruck
 # local
-from dumptruck_web import execute_query
+from dumptruck_web import execute_query, stream_query, json_chunks, ndjson_chunks, Rows, ConnectionPool, NotOK
+from dumptruck_web import row_encoder
+from dumptruck_web import negotiate_encoding, compress_response, Response
+from dumptruck_web import MetaCache, BoxCache, QueryError, ResultCache, normalize_sql
+from dumptruck_web import Budget, budget_for, open_dumptruck, database_uri, frozen
+from dumptruck_web import SlowLog, Timer, fingerprint
+from dumptruck_web import advise_query, CONNECTIONS, execute_batch, Page, TableRows
+from dumptruck_web import Watcher, database_identity, imap_bounded, ThreadPool, SearchIndex
+from dumptruck_web import Warmup, warm_database
+import dumptruck_web
 
 # DB = os.path.expanduser('~/dumptruck.db')
 DB = 'dumptruck.db'
@@ -18,6 +35,13 @@ class Database(unittest.TestCase):
 
         self.dt = dumptruck.DumpTruck(dbname=DB, adapt_and_convert = False)
 
+    def tearDown(self):
+        self.dt.close()
+        try:
+            os.remove(DB)
+        except OSError:
+            pass
+
 class TestQueries(Database):
     def test_valid_query(self):
         """Valid query works."""
@@ -58,6 +82,852 @@ class TestQueries(Database):
         self.assertEqual(observedData, None)
         self.assertEqual(observedCode, 200)
 
+# A billion rows to count, unless interrupted.
+ENDLESS = 'SELECT count(*) FROM numbers a, numbers b, numbers c'
+
+class TestBudget(Database):
+    def setUp(self):
+        super(TestBudget, self).setUp()
+        self.dt.execute('CREATE TABLE numbers (n integer)')
+        self.dt.execute('INSERT INTO numbers VALUES (0)')
+        for i in range(10):
+            self.dt.execute('INSERT INTO numbers SELECT n + (SELECT count(*) FROM numbers) FROM numbers')
+
+    def test_steps(self):
+        """Queries that take too many steps are interrupted."""
+        interrupted = dumptruck_web.COUNTERS['interrupted']
+        code, data = execute_query(ENDLESS, DB, budget=Budget(steps=100000))
+        self.assertEqual(code, 503)
+        self.assertEqual(data, u'Query interrupted: more than 100000 steps')
+        self.assertEqual(dumptruck_web.COUNTERS['interrupted'], interrupted + 1)
+
+    def test_seconds(self):
+        """Queries that take too long are interrupted."""
+        code, data = stream_query(ENDLESS, DB, budget=Budget(seconds=0.05))
+        self.assertEqual(code, 503)
+        self.assertEqual(data, u'Query interrupted: more than 0.05 seconds')
+
+    def test_within_budget(self):
+        """The budget doesn't affect queries within it, or later queries."""
+        budget = Budget(steps=100000)
+        self.assertEqual(execute_query(ENDLESS, DB, budget=budget)[0], 503)
+        code, rows = stream_query('SELECT n FROM numbers LIMIT 5', DB, budget=budget)
+        self.assertEqual(code, 200)
+        self.assertEqual(len(json.loads(''.join(json_chunks(rows)))), 5)
+        self.assertEqual(execute_query('SELECT count(*) FROM numbers', DB, budget=Budget())[0], 200)
+
+    def test_slow_reader(self):
+        """Time spent waiting for the client to read rows isn't counted."""
+        code, rows = stream_query('SELECT n FROM numbers', DB, budget=Budget(seconds=0.2),
+            batch_size=200)
+        self.assertEqual(code, 200)
+        batches = 0
+        for batch in rows:
+            batches += 1
+            time.sleep(0.05)
+        self.assertEqual(batches, 6)
+        self.assertTrue(rows.meter.seconds() < 0.2)
+
+    def test_per_box(self):
+        """Boxes can have their own budgets."""
+        old = dumptruck_web.BUDGETS
+        dumptruck_web.BUDGETS = {'big': Budget(seconds=600)}
+        try:
+            self.assertEqual(budget_for('big').seconds, 600)
+            self.assertIs(budget_for('other'), dumptruck_web.DEFAULT_BUDGET)
+        finally:
+            dumptruck_web.BUDGETS = old
+
+class TestStreaming(Database):
+    def _stream(self, sql, batch_size=2):
+        code, data = stream_query(sql, DB, batch_size=batch_size)
+        if isinstance(data, Rows):
+            data = json.loads(''.join(json_chunks(data)))
+        return code, data
+
+    def test_same_as_execute_query(self):
+        """Streamed JSON matches execute_query, across several batches."""
+        self.dt.insert([{u'n': i, u'name': u'row %d' % i} for i in range(5)], 'numbers')
+        for sql in ['SELECT * FROM numbers', 'SELECT * FROM numbers LIMIT 0', '']:
+            self.assertEqual(self._stream(sql), execute_query(sql, DB))
+
+    def test_same_bytes_as_dumptruck(self):
+        """Rows encoded from tuples give exactly the JSON that dumptruck's dicts do."""
+        self.dt.execute(u"""CREATE TABLE mixed ("a%s" text, b real, c integer, "caf\xe9" text)""")
+        self.dt.execute(u"""INSERT INTO mixed VALUES ('x "y"\n', 1.5, 12345678901234567890, 'caf\xe9')""")
+        self.dt.execute(u"""INSERT INTO mixed VALUES (NULL, 1e300 * 1e300, -1, '')""")
+        for sql in ['SELECT * FROM mixed', 'SELECT "a%s", b, c AS "a%s", c, 2.0 AS c FROM mixed']:
+            expected = self.dt.execute(sql)
+            code, rows = stream_query(sql, DB, batch_size=1)
+            self.assertEqual(''.join(json_chunks(rows)), json.dumps(expected) + '\n')
+            code, rows = stream_query(sql, DB)
+            self.assertEqual(''.join(ndjson_chunks(rows)),
+                ''.join(json.dumps(row) + '\n' for row in expected))
+
+    def test_long(self):
+        """Longs are encoded as JSON numbers, without an L."""
+        self.assertEqual(row_encoder([u'a'])((5L,)), json.dumps({u'a': 5L}))
+
+    def test_errors(self):
+        """Errors before the first row keep their status codes."""
+        self.dt.execute('CREATE TABLE important(foo);')
+        self.assertEqual(self._stream('chainsaw'),
+            (400, u'SQL error: near "chainsaw": syntax error'))
+        self.assertEqual(self._stream('DROP TABLE important;'),
+            (403, u'Database error: not authorized'))
+
+    def test_batches(self):
+        """Rows are fetched in batches."""
+        self.dt.insert([{u'n': i} for i in range(5)], 'numbers')
+        code, rows = stream_query('SELECT n FROM numbers', DB, batch_size=2)
+        self.assertEqual([len(batch) for batch in rows], [2, 2, 1])
+
+class TestCompression(unittest.TestCase):
+    def test_negotiate(self):
+        """Accept-Encoding is parsed with q values."""
+        self.assertEqual(negotiate_encoding(None), None)
+        self.assertEqual(negotiate_encoding('identity'), None)
+        self.assertEqual(negotiate_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(negotiate_encoding('gzip;q=0.1, deflate'), 'deflate')
+        self.assertEqual(negotiate_encoding('*'), 'gzip')
+        self.assertEqual(negotiate_encoding('*, gzip;q=0'), 'deflate')
+
+    def test_incremental(self):
+        """Compression doesn't read the whole body up front."""
+        read = []
+        def body():
+            for i in range(10):
+                read.append(i)
+                yield 'x' * 100
+        response = compress_response(Response(200, body()), 'gzip', threshold=250)
+        self.assertEqual(len(read), 3)
+        self.assertEqual(zlib.decompress(''.join(response.body), 16 + zlib.MAX_WBITS),
+            'x' * 1000)
+
+class TestMetaCache(Database):
+    def setUp(self):
+        super(TestMetaCache, self).setUp()
+        self.dt.insert({u'a': 1}, 'first')
+        self.built = 0
+        self.old_build_meta = dumptruck_web.build_meta
+        def build_meta(*args):
+            self.built += 1
+            return self.old_build_meta(*args)
+        dumptruck_web.build_meta = build_meta
+
+    def tearDown(self):
+        dumptruck_web.build_meta = self.old_build_meta
+        super(TestMetaCache, self).tearDown()
+
+    def test_hit(self):
+        """An unchanged database isn't read again."""
+        cache = MetaCache()
+        first = cache.get(DB)
+        self.old_schema_version = dumptruck_web.schema_version
+        dumptruck_web.schema_version = None
+        try:
+            self.assertEqual(cache.get(DB), first)
+        finally:
+            dumptruck_web.schema_version = self.old_schema_version
+        self.assertEqual(self.built, 1)
+
+    def test_data_change(self):
+        """New rows don't make the schema be read again."""
+        cache = MetaCache()
+        first = cache.get(DB)
+        self.dt.insert({u'a': 2}, 'first')
+        self.assertEqual(cache.get(DB), first)
+        self.assertEqual(self.built, 1)
+
+    def test_schema_change(self):
+        """New tables and grids are noticed."""
+        cache = MetaCache()
+        cache.get(DB)
+        self.dt.insert({u'b': 1}, 'second')
+        self.assertIn('second', json.loads(cache.get(DB))['table'])
+        self.dt.insert({u'checksum': u'abc', u'title': u'Grid'}, '_grids')
+        self.assertIn('abc', json.loads(cache.get(DB))['grid'])
+        self.dt.execute(u"UPDATE _grids SET title = 'New'")
+        self.assertEqual(json.loads(cache.get(DB))['grid']['abc']['title'], 'New')
+        self.assertEqual(self.built, 4)
+
+    def test_replaced(self):
+        """A new file with the same schema_version is read again."""
+        cache = MetaCache()
+        cache.get(DB)
+        dumptruck.DumpTruck(dbname='replacement.db').insert({u'b': 1}, 'other')
+        os.rename('replacement.db', DB)
+        self.assertIn('other', json.loads(cache.get(DB))['table'])
+
+    def test_unpooled(self):
+        """Without pooling the connection is not kept."""
+        CONNECTIONS.clear()
+        cache = MetaCache()
+        self.assertIn('first', json.loads(cache.get(DB, pooled=False))['table'])
+        self.assertEqual(len(CONNECTIONS), 0)
+
+class TestImapBounded(unittest.TestCase):
+    def test_order(self):
+        """Results come in order, from no more than the given threads at once."""
+        lock = threading.Lock()
+        running = [0, 0]
+        def square(n):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+            time.sleep(0.01 * (n % 3))
+            with lock:
+                running[0] -= 1
+            return n * n
+        pool = ThreadPool(4)
+        self.assertEqual(list(imap_bounded(square, range(20), pool)), [n * n for n in range(20)])
+        self.assertTrue(1 < running[1] <= 4)
+        self.assertEqual(list(imap_bounded(square, [], pool)), [])
+
+    def test_shared_pool(self):
+        """Calls sharing a pool share its threads."""
+        lock = threading.Lock()
+        running = [0, 0]   # now, most at once
+        threads = set()
+        def work(n):
+            with lock:
+                running[0] += 1
+                running[1] = max(running)
+                threads.add(threading.current_thread())
+            time.sleep(0.01)
+            with lock:
+                running[0] -= 1
+            return n
+        pool = ThreadPool(3)
+        results = []
+        def caller():
+            results.append(list(imap_bounded(work, range(10), pool)))
+        callers = [threading.Thread(target=caller) for _ in range(4)]
+        for caller in callers:
+            caller.start()
+        for caller in callers:
+            caller.join()
+        self.assertEqual(results, [range(10)] * 4)
+        self.assertTrue(running[1] <= 3)
+        self.assertTrue(len(threads) <= 3)
+
+    def test_exception(self):
+        """An exception is raised when its result is reached."""
+        iterator = imap_bounded(lambda n: 1 / n, [1, 0], ThreadPool(2))
+        self.assertEqual(next(iterator), 1)
+        self.assertRaises(ZeroDivisionError, next, iterator)
+
+class TestBoxCache(unittest.TestCase):
+    def setUp(self):
+        self.boxhome = os.path.abspath('boxcache-test')
+        self.boxdir = os.path.join(self.boxhome, 'box')
+        if not os.path.isdir(self.boxdir):
+            os.makedirs(self.boxdir)
+        self.reads = 0
+        self.old_read = dumptruck_web.read_database_name
+        def read_database_name(*args):
+            self.reads += 1
+            return self.old_read(*args)
+        dumptruck_web.read_database_name = read_database_name
+        self.cache = BoxCache()
+
+    def tearDown(self):
+        dumptruck_web.read_database_name = self.old_read
+        shutil.rmtree(self.boxhome)
+
+    def _get(self):
+        return self.cache.get(self.boxhome, 'box', 'scraperwiki.sqlite')
+
+    def _write(self, name, content):
+        with open(os.path.join(self.boxdir, name), 'w') as f:
+            f.write(content)
+
+    def test_box_json(self):
+        """box.json is only read again when it changes."""
+        self._write('box.json', '{"database": "a.db"}')
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'a.db'))
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'a.db'))
+        self.assertEqual(self.reads, 1)
+        self._write('box.json', '{"database": "bb.db"}')
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'bb.db'))
+        self.assertEqual(self.reads, 2)
+
+    def test_default(self):
+        """The default is remembered until a config file appears."""
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'scraperwiki.sqlite'))
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'scraperwiki.sqlite'))
+        self.assertEqual(self.reads, 1)
+        self._write('scraperwiki.json', '{"database": "sw.db"}')
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'sw.db'))
+        self._write('box.json', '{"database": "box.db"}')
+        self.assertEqual(self._get(), os.path.join(self.boxdir, 'box.db'))
+        self.assertEqual(self.reads, 3)
+
+    def test_errors_not_cached(self):
+        """A malformed box.json is read again each time."""
+        self._write('box.json', '{{{')
+        self.assertRaises(QueryError, self._get)
+        self.assertRaises(QueryError, self._get)
+        self.assertEqual(self.reads, 2)
+
+    def test_maxsize(self):
+        """The cache is bounded."""
+        cache = BoxCache(maxsize=2)
+        for box in ['a', 'b', 'c']:
+            cache.get(self.boxhome, box, 'scraperwiki.sqlite')
+        self.assertEqual(len(cache._entries), 2)
+
+class TestResultCache(unittest.TestCase):
+    def test_normalize_sql(self):
+        """Whitespace is only collapsed outside quotes and comments."""
+        self.assertEqual(normalize_sql(" SELECT  a,\n b FROM t "), "SELECT a, b FROM t")
+        self.assertEqual(normalize_sql("SELECT 'a  b'  FROM [t  t]"), "SELECT 'a  b' FROM [t  t]")
+        self.assertEqual(normalize_sql("SELECT 1 AS x -- c\n, 2 AS y"), "SELECT 1 AS x -- c\n, 2 AS y")
+        self.assertNotEqual(normalize_sql("SELECT 1 AS x -- c\n, 2 AS y"),
+            normalize_sql("SELECT 1 AS x -- c , 2 AS y"))
+        self.assertEqual(normalize_sql("SELECT 1 /* a\n  b */  - 2"), "SELECT 1 /* a\n  b */ - 2")
+
+    def test_identity(self):
+        """Entries are only used while the identity is the same."""
+        cache = ResultCache(max_bytes=100)
+        cache.put('k', 1, [], 'body')
+        self.assertEqual(''.join(cache.get('k', 1).body), 'body')
+        self.assertEqual(cache.get('k', 2), None)
+        self.assertEqual(cache.size, 0)
+
+    def test_eviction(self):
+        """Least recently used entries are evicted to stay under max_bytes."""
+        cache = ResultCache(max_bytes=10)
+        cache.put('a', 1, [], 'xxxx')
+        cache.put('b', 1, [], 'xxxx')
+        cache.get('a', 1)
+        cache.put('c', 1, [], 'xxxx')
+        self.assertEqual(cache.get('b', 1), None)
+        self.assertNotEqual(cache.get('a', 1), None)
+        self.assertEqual(cache.size, 8)
+
+    def test_entry_cap(self):
+        """Big bodies are sent but not cached."""
+        cache = ResultCache(max_bytes=100, max_entry_bytes=5)
+        response = Response(200, iter(['abc', 'def']))
+        self.assertEqual(''.join(cache.collect('k', 1, response.headers, response.body)), 'abcdef')
+        self.assertEqual(cache.get('k', 1), None)
+        response = Response(200, iter(['ab', 'c']))
+        self.assertEqual(''.join(cache.collect('k', 1, response.headers, response.body)), 'abc')
+        self.assertEqual(''.join(cache.get('k', 1).body), 'abc')
+
+class TestSlowLog(unittest.TestCase):
+    def setUp(self):
+        self.path = 'slowlog-test.sqlite'
+        self.slowlog = SlowLog(self.path, threshold=0)
+
+    def tearDown(self):
+        try:
+            os.remove(self.path)
+        except OSError:
+            pass
+
+    def _record(self, box, sql, seconds):
+        timer = Timer('sql')
+        timer.box = box
+        timer.sql = sql
+        timer.rows = 1
+        timer.started -= seconds
+        self.slowlog.record(timer, 200, 100)
+
+    def test_fingerprint(self):
+        """Literals are removed from fingerprints."""
+        self.assertEqual(fingerprint("SELECT *  FROM t1 WHERE a = 'x''y' AND b IN (1, 2.5,3) LIMIT 10"),
+            "select * from t1 where a = ? and b in (?) limit ?")
+        self.assertEqual(fingerprint('SELECT "Name 2" FROM [Table 3]'),
+            'select "Name 2" from [Table 3]')
+
+    def test_report(self):
+        """Fingerprints are reported with the most total time first."""
+        for i in range(10):
+            self._record('a', 'SELECT * FROM t WHERE id = %d' % i, 0.1 * (i + 1))
+        self._record('b', 'SELECT * FROM t WHERE id = 99', 0.1)
+        self._record('b', 'SELECT count(*) FROM t', 5)
+
+        report = self.slowlog.report()
+        self.assertEqual([entry['fingerprint'] for entry in report],
+            ['select * from t where id = ?', 'select count(*) from t'])
+        self.assertEqual(report[0]['calls'], 11)
+        self.assertEqual(report[0]['boxes'], ['a', 'b'])
+        self.assertAlmostEqual(report[0]['p95_ms'], 1000, delta=50)
+        self.assertEqual(report[0]['rows'], 11)
+
+        report = self.slowlog.report(box='b', limit=1)
+        self.assertEqual([entry['fingerprint'] for entry in report], ['select count(*) from t'])
+
+    def test_threshold(self):
+        """Fast queries aren't recorded."""
+        self.slowlog.threshold = 1
+        self._record('a', 'SELECT 1', 0)
+        self.assertEqual(self.slowlog.report(), [])
+
+    def test_unwritable(self):
+        """A log that can't be written to doesn't raise."""
+        self.slowlog.path = os.path.join('no-such-directory', self.path)
+        failed = dumptruck_web.COUNTERS['slow.failed']
+        stderr, sys.stderr = sys.stderr, cStringIO.StringIO()
+        try:
+            self._record('a', 'SELECT 1', 0)
+        finally:
+            stderr, sys.stderr = sys.stderr, stderr
+        self.assertEqual(dumptruck_web.COUNTERS['slow.failed'], failed + 1)
+        self.assertIn('OperationalError', stderr.getvalue())
+
+class TestAdvisor(Database):
+    def setUp(self):
+        super(TestAdvisor, self).setUp()
+        self.dt.insert([{u'a': i % 50, u'b': i} for i in range(2000)], 't')
+        self.dt.insert([{u'x': i, u'y': i} for i in range(100)], 'u')
+        self.dt.create_index(['x'], 'u')
+        self.read_only = CONNECTIONS.get(DB)
+        self.tables = {'t': 't', 'u': 'u'}
+
+    def _scans(self, sql):
+        return advise_query(self.read_only, sql, self.tables)['scans']
+
+    def test_scan(self):
+        """Full scans get an index suggestion, equality columns first."""
+        scans = self._scans('SELECT * FROM t WHERE b > 10 AND a = 3')
+        self.assertEqual(len(scans), 1)
+        self.assertEqual(scans[0]['table'], 't')
+        self.assertEqual(scans[0]['rows'], 2000)
+        self.assertEqual(scans[0]['suggestion'], u'CREATE INDEX "idx_t_a_b" ON "t" ("a", "b")')
+        self.assertEqual(scans[0]['estimated_rows'], 40)
+
+    def test_indexed(self):
+        """Queries using an index aren't flagged."""
+        self.assertEqual(self._scans('SELECT * FROM u WHERE x = 3'), [])
+
+    def test_alias_and_join(self):
+        """Aliased tables are recognised, and automatic indexes flagged."""
+        scans = self._scans('SELECT * FROM u AS q, t WHERE t.b = q.y AND q.y < 5')
+        self.assertEqual([scan['table'] for scan in scans], ['u', 't'])
+        self.assertEqual(scans[0]['columns'], ['y'])
+        self.assertEqual(scans[1]['columns'], ['b'])
+
+    def test_authorizer(self):
+        """The advisor can't be used to change the database."""
+        self.assertRaises(sqlite3.DatabaseError, advise_query,
+            self.read_only, 'DROP TABLE t', self.tables)
+
+class TestBatch(Database):
+    def setUp(self):
+        super(TestBatch, self).setUp()
+        self.dt.execute('PRAGMA journal_mode=WAL')
+        self.dt.insert([{u'n': i} for i in range(3)], 'numbers')
+        self.read_only = CONNECTIONS.get(DB)
+
+    def tearDown(self):
+        # Closing the last connection removes the -wal and -shm files.
+        CONNECTIONS.clear()
+        super(TestBatch, self).tearDown()
+
+    def test_results(self):
+        """Each query gets the status and data execute_query would give."""
+        results = execute_batch(['SELECT n FROM numbers WHERE n = 1',
+            'DELETE FROM numbers', 'chainsaw', 'COMMIT',
+            'WITH m AS (SELECT max(n) AS n FROM numbers) SELECT n FROM m'], self.read_only)
+        self.assertEqual(results[0], (200, [{u'n': 1}]))
+        self.assertEqual(results[1], (403, u'Database error: not authorized'))
+        self.assertEqual(results[2][0], 400)
+        self.assertEqual(results[3], (403, u'Database error: not authorized'))
+        self.assertEqual(results[4], (200, [{u'n': 2}]))
+
+    def test_snapshot(self):
+        """Rows written while the batch runs aren't seen by it."""
+        writer = sqlite3.connect(DB)
+        def sneak():
+            writer.execute('INSERT INTO numbers VALUES (3)')
+            writer.commit()
+            return 0
+        self.read_only.connection.create_function('sneak', 0, sneak)
+        try:
+            results = execute_batch(['SELECT count(*) AS c, sneak() FROM numbers',
+                'SELECT count(*) AS c FROM numbers'], self.read_only)
+        finally:
+            writer.close()
+        self.assertEqual([data[0]['c'] for code, data in results], [3, 3])
+        self.assertEqual(execute_query('SELECT count(*) AS c FROM numbers', DB), (200, [{u'c': 4}]))
+
+    def test_budget(self):
+        """Queries after the budget is used up aren't run."""
+        self.dt.execute('CREATE TABLE big AS SELECT a.n FROM numbers a, numbers b, numbers c')
+        self.dt.execute('INSERT INTO big SELECT a.n FROM big a, big b')
+        results = execute_batch(['SELECT count(*) FROM big a, big b, big c',
+            'SELECT n FROM numbers'], self.read_only, budget=Budget(steps=10000))
+        self.assertEqual([code for code, data in results], [503, 503])
+
+class TestStatementCache(Database):
+    def setUp(self):
+        super(TestStatementCache, self).setUp()
+        self.dt.insert([{u'n': i} for i in range(3)], 'numbers')
+        CONNECTIONS.clear()
+        self.read_only = CONNECTIONS.get(DB)
+        self.authorized = 0
+        self.old_authorizer = dumptruck_web._authorizer_readonly
+        def authorizer(*args):
+            self.authorized += 1
+            return self.old_authorizer(*args)
+        dumptruck_web._authorizer_readonly = authorizer
+
+    def tearDown(self):
+        dumptruck_web._authorizer_readonly = self.old_authorizer
+        CONNECTIONS.clear()
+        super(TestStatementCache, self).tearDown()
+
+    def test_hits(self):
+        """Queries run again aren't prepared again, even after a batch."""
+        sql = 'SELECT n FROM numbers WHERE n > 0'
+        self.assertEqual(execute_query(sql, DB), (200, [{u'n': 1}, {u'n': 2}]))
+        execute_batch(['SELECT 1'], self.read_only)
+        self.authorized = 0
+        self.assertEqual(execute_query(sql, DB), (200, [{u'n': 1}, {u'n': 2}]))
+        self.assertEqual(self.authorized, 0)
+        statements = self.read_only.statements.as_dict()
+        self.assertEqual((statements['hits'], statements['misses']), (1, 2))
+        entry, = dumptruck_web.STATS.as_dict()['statements']
+        self.assertEqual((entry['database'], entry['hits'], entry['misses']), (DB, 1, 2))
+
+    def test_denied(self):
+        """Queries that weren't authorized aren't prepared again."""
+        self.assertEqual(execute_query('DELETE FROM numbers', DB)[0], 403)
+        self.authorized = 0
+        self.assertEqual(execute_query('DELETE FROM numbers', DB)[0], 403)
+        self.assertEqual(self.authorized, 0)
+        self.assertEqual(self.read_only.statements.refused, 1)
+
+    def test_transaction_control(self):
+        """The BEGIN run for a batch can't be reused by a query."""
+        execute_batch(['SELECT 1'], self.read_only)
+        self.assertEqual(execute_query('BEGIN', DB), (403, u'Database error: not authorized'))
+        self.assertEqual(execute_query('ROLLBACK', DB), (403, u'Database error: not authorized'))
+        self.assertEqual(execute_query('begin', DB), (403, u'Database error: not authorized'))
+
+class TestPage(Database):
+    def setUp(self):
+        super(TestPage, self).setUp()
+        self.dt.insert([{u'n': i, u'parity': [None, i % 2][i % 3 != 0]} for i in range(10)],
+            'numbers')
+
+    def _pages(self, page):
+        """Return the list of the pages of *page*'s query."""
+        pages = []
+        while True:
+            sql, params = page.query()
+            code, rows = stream_query(sql, DB, batch_size=page.size + 1, params=params)
+            self.assertEqual(code, 200)
+            token = page.next_cursor(rows)
+            pages.append(json.loads(''.join(json_chunks(rows))))
+            if token is None:
+                return pages
+            page.after = page.decode(token)
+
+    def test_rowid(self):
+        """Pages follow the rowid by default."""
+        pages = self._pages(Page('SELECT rowid, n FROM numbers;', 4))
+        self.assertEqual([[row['n'] for row in page] for page in pages],
+            [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]])
+
+    def test_keys(self):
+        """Pages can be ordered by several keys, descending, with NULLs."""
+        for keys, expected in [
+                (['parity', 'n'], [None, None, None, None, 0, 0, 0, 1, 1, 1]),
+                (['-parity', 'n'], [1, 1, 1, 0, 0, 0, None, None, None, None])]:
+            pages = self._pages(Page('SELECT * FROM numbers -- comment', 3, keys))
+            self.assertEqual([row['parity'] for page in pages for row in page], expected)
+            self.assertEqual(sorted(row['n'] for page in pages for row in page), range(10))
+
+    def test_seek(self):
+        """Later pages are found with the index, not by skipping rows."""
+        page = Page('SELECT rowid, n FROM numbers', 2, after=[5])
+        sql, params = page.query()
+        plan = self.dt.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        self.assertIn('USING INTEGER PRIMARY KEY', plan[0]['detail'])
+
+    def test_bad_cursor(self):
+        """Cursors are only accepted for the query they came from."""
+        token = Page('SELECT rowid FROM numbers', 2).encode([5])
+        self.assertEqual(Page('SELECT rowid FROM numbers', 5).decode(token), [5])
+        for bad in [Page('SELECT rowid, n FROM numbers', 2).encode([5]),
+                Page('SELECT rowid FROM numbers', 2, ['n']).encode([5]), 'chainsaw']:
+            self.assertRaises(QueryError, Page('SELECT rowid FROM numbers', 2).decode, bad)
+
+class TestTableRows(Database):
+    def setUp(self):
+        super(TestTableRows, self).setUp()
+        self.dt.insert([{u'n': i} for i in range(25)], 'numbers')
+        self.read_only = CONNECTIONS.get(DB)
+
+    def test_chunks(self):
+        """Rows are read a chunk at a time, in rowid order."""
+        rows = TableRows(self.read_only, 'numbers', 3, 20, chunk=10)
+        rows.start(3)
+        self.assertEqual(rows.columns, [u'rowid', u'n'])
+        batches = list(rows)
+        self.assertEqual([len(batch) for batch in batches], [10, 8])
+        self.assertEqual(batches[0][0], (3, 2))
+        self.assertEqual(batches[-1][-1], (20, 19))
+
+    def test_writes_between_chunks(self):
+        """No read transaction is held open between chunks."""
+        rows = TableRows(self.read_only, 'numbers', 1, 25, chunk=10)
+        rows.start(1)
+        batches = iter(rows)
+        next(batches)
+        writer = sqlite3.connect(DB, timeout=0)
+        writer.execute('DELETE FROM numbers WHERE n >= 20')
+        writer.commit()
+        writer.close()
+        self.assertEqual(sum(len(batch) for batch in batches), 10)
+
+class TestSearchIndex(Database):
+    def setUp(self):
+        super(TestSearchIndex, self).setUp()
+        self.dt.insert([{u'word': u'apple' if i % 2 else u'pear', u'n': i} for i in range(30)],
+            'fruit')
+        self.directory = 'search-index'
+        self.index = SearchIndex(DB, self.directory)
+
+    def tearDown(self):
+        self.index.close()
+        shutil.rmtree(self.directory)
+        super(TestSearchIndex, self).tearDown()
+
+    def _refresh(self, **kwargs):
+        return self.index.refresh(CONNECTIONS.get(DB), 'fruit', **kwargs)
+
+    def test_search(self):
+        """Only the text columns are indexed."""
+        self.assertTrue(self._refresh())
+        self.assertEqual(len(self.index.search('fruit', 'pear')), 15)
+        self.assertEqual(self.index.search('fruit', '3'), [])
+
+    def test_incremental(self):
+        """New rows are added to the index, not read again."""
+        self._refresh()
+        self.dt.insert({u'word': u'plum', u'n': 30}, 'fruit')
+        self.assertTrue(self._refresh())
+        self.assertEqual(self.index.search('fruit', 'plum'), [31])
+        self.assertEqual(self.index._entry('fruit')[3:5], (31, 31))
+
+    def test_rowid_zero(self):
+        """Rows with a rowid of zero or less are indexed, and stay indexed."""
+        self.dt.execute(u"INSERT INTO fruit (rowid, word, n) VALUES (0, 'zero apple', 0)")
+        self.dt.execute(u"INSERT INTO fruit (rowid, word, n) VALUES (-5, 'minus apple', 0)")
+        self.assertTrue(self._refresh())
+        self.assertEqual(self.index.search('fruit', 'zero'), [0])
+        self.assertEqual(self.index.search('fruit', 'minus'), [-5])
+        id = self.index._entry('fruit')[0]
+        self.dt.insert({u'word': u'plum', u'n': 30}, 'fruit')
+        self.assertTrue(self._refresh())
+        self.assertEqual(self.index._entry('fruit')[0], id)
+        self.assertEqual(self.index._entry('fruit')[3:5], (31, 33))
+
+    def test_deleted(self):
+        """Deleting rows makes the index start again."""
+        self._refresh()
+        self.dt.execute(u"DELETE FROM fruit WHERE word = 'pear'")
+        self.assertTrue(self._refresh())
+        self.assertEqual(self.index.search('fruit', 'pear'), [])
+        self.assertEqual(len(self.index.search('fruit', 'apple')), 15)
+
+    def test_deadline(self):
+        """Work done before the deadline is kept for the next refresh."""
+        dumptruck_web.SEARCH_CHUNK, chunk = 10, dumptruck_web.SEARCH_CHUNK
+        try:
+            self.assertFalse(self._refresh(deadline=0))
+            self.assertEqual(self.index._entry('fruit')[3], 10)
+            self.assertTrue(self._refresh())
+        finally:
+            dumptruck_web.SEARCH_CHUNK = chunk
+        self.assertEqual(len(self.index.search('fruit', 'apple')), 15)
+
+class TestWarmup(Database):
+    def setUp(self):
+        super(TestWarmup, self).setUp()
+        self.dt.insert([{u'a': i, u'b': unicode(i)} for i in range(100)], 'letters')
+        self.dt.execute(u'CREATE INDEX letters_a ON letters (a)')
+        self.dt.execute(u'CREATE INDEX letters_b ON letters (b) WHERE a > 5')
+        self.boxhome = 'warmup-boxes'
+        os.makedirs(os.path.join(self.boxhome, 'box'))
+        shutil.copy(DB, os.path.join(self.boxhome, 'box', 'scraperwiki.sqlite'))
+
+    def tearDown(self):
+        CONNECTIONS.clear()
+        shutil.rmtree(self.boxhome)
+        super(TestWarmup, self).tearDown()
+
+    def test_warm_database(self):
+        """Every index that can be scanned is read, and tables if asked."""
+        result = warm_database(DB, time.time() + 10, rows=10)
+        self.assertEqual((result['indexes'], result['complete']), (1, True))
+        self.assertTrue(result['tables'] >= 1)
+        self.assertEqual(warm_database(DB, time.time() + 10)['tables'], 0)
+
+    def test_pooled(self):
+        """Handles are only kept in CONNECTIONS if asked."""
+        warm_database(DB, time.time() + 10)
+        self.assertEqual(len(CONNECTIONS), 0)
+        warm_database(DB, time.time() + 10, pooled=True)
+        self.assertEqual(len(CONNECTIONS), 1)
+
+    def test_ready(self):
+        """A worker is ready once warming up is over, whatever happened."""
+        warmup = Warmup(self.boxhome, boxes=['box', 'no-such-box'])
+        self.assertFalse(warmup.ready)
+        warmup.run()
+        self.assertTrue(warmup.ready)
+        result = warmup.as_dict()
+        self.assertEqual(result['state'], 'done')
+        self.assertEqual(result['boxes']['box']['indexes'], 1)
+        self.assertIn('error', result['boxes']['no-such-box'])
+
+    def test_timeout(self):
+        """Boxes left when the time is up aren't warmed up."""
+        warmup = Warmup(self.boxhome, boxes=['box'], seconds=0)
+        warmup.run()
+        self.assertEqual(warmup.as_dict(), {'state': 'timeout', 'ready': True,
+            'seconds': warmup.elapsed, 'boxes': {}})
+
+class TestOpen(Database):
+    def setUp(self):
+        super(TestOpen, self).setUp()
+        self.dt.insert({u'n': 1}, 'numbers')
+
+    def _unchecked(self, dbname):
+        """Open *dbname* as the pool would, then remove the authorizer."""
+        dt = open_dumptruck(dbname)
+        dt.connection.set_authorizer(lambda *args: sqlite3.SQLITE_OK)
+        return dt
+
+    def test_read_only(self):
+        """Connections are read-only even without the authorizer."""
+        dt = self._unchecked(DB)
+        self.assertRaises(sqlite3.OperationalError, dt.execute, 'DELETE FROM numbers')
+        self.assertEqual(dt.execute('SELECT n FROM numbers'), [{u'n': 1}])
+
+    def test_pragmas(self):
+        """The pager is tuned before the authorizer is installed."""
+        dt = self._unchecked(DB)
+        self.assertEqual(dt.execute('PRAGMA cache_size')[0]['cache_size'],
+            dumptruck_web.PRAGMAS['cache_size'])
+        self.assertEqual(dt.execute('PRAGMA mmap_size')[0]['mmap_size'],
+            dumptruck_web.PRAGMAS['mmap_size'])
+
+    def test_uri_quoting(self):
+        """Paths that mean something in a URI are opened correctly."""
+        dbname = 'odd?name#%20.db'
+        shutil.copy(DB, dbname)
+        try:
+            self.assertEqual(open_dumptruck(dbname).execute('SELECT n FROM numbers'), [{u'n': 1}])
+        finally:
+            os.remove(dbname)
+
+    def test_frozen(self):
+        """Databases marked as frozen are opened as immutable."""
+        self.assertFalse(frozen(DB))
+        os.chmod(DB, 0444)
+        try:
+            # Only being read-only isn't enough.
+            self.assertFalse(frozen(DB))
+            open(DB + '-frozen', 'w').close()
+            self.assertTrue(frozen(DB))
+            self.assertEqual(open_dumptruck(DB).execute('SELECT n FROM numbers'), [{u'n': 1}])
+            # Not with a journal that may need rolling back.
+            open(DB + '-journal', 'w').close()
+            self.assertFalse(frozen(DB))
+        finally:
+            os.chmod(DB, 0644)
+            for suffix in ['-frozen', '-journal']:
+                os.remove(DB + suffix)
+        if dumptruck_web.URI_FILENAMES:
+            self.assertTrue(database_uri(DB, immutable=True).endswith('?mode=ro&immutable=1'))
+
+class TestWatcher(Database):
+    def _wait(self, watcher, timeout, change=None):
+        """Wait for the database to change, making *change* from another
+        thread, and return how long it took.
+        """
+        done = threading.Event()
+        started = time.time()
+        watcher.watch(DB, database_identity(DB), timeout, done.set)
+        if change is not None:
+            threading.Timer(0.1, change).start()
+        self.assertTrue(done.wait(timeout + 5))
+        return time.time() - started
+
+    def _insert(self):
+        # Possibly from another thread, so with its own connection.
+        dumptruck.DumpTruck(dbname=DB).insert({u'n': 1}, 'numbers')
+
+    def test_inotify(self):
+        """Changes are noticed straight away with inotify."""
+        self._insert()
+        self.assertLess(self._wait(Watcher(poll_interval=30), 10, self._insert), 5)
+
+    def test_polling(self):
+        """Without inotify, changes are noticed by polling."""
+        self._insert()
+        self.assertLess(self._wait(Watcher(poll_interval=0.1, use_inotify=False), 10,
+            self._insert), 5)
+
+    def test_timeout(self):
+        """The callback is called when the time is up."""
+        self._insert()
+        self.assertGreaterEqual(self._wait(Watcher(poll_interval=30), 0.2), 0.2)
+
+class TestConnectionPool(Database):
+    def test_reuse(self):
+        """The same handle is returned while the file is unchanged."""
+        pool = ConnectionPool()
+        self.assertIs(pool.get(DB), pool.get(DB))
+        self.assertEqual(len(pool), 1)
+
+    def test_changed_file(self):
+        """A new handle is opened when the file changes."""
+        pool = ConnectionPool()
+        first = pool.get(DB)
+        self.dt.insert({u'name': u'Aidan'}, 'person')
+        self.assertIsNot(pool.get(DB), first)
+
+    def test_maxsize(self):
+        """Least recently used handles are evicted."""
+        other = 'other.db'
+        dumptruck.DumpTruck(dbname=other).insert({'a': 1}, 'a')
+        try:
+            pool = ConnectionPool(maxsize=1)
+            first = pool.get(DB)
+            pool.get(other)
+            self.assertEqual(len(pool), 1)
+            self.assertIsNot(pool.get(DB), first)
+        finally:
+            os.remove(other)
+
+    def test_maxsize_per_thread(self):
+        """Each thread has its own handles, up to maxsize."""
+        pool = ConnectionPool(maxsize=1)
+        first = pool.get(DB)
+        thread = threading.Thread(target=pool.get, args=(DB,))
+        thread.start()
+        thread.join()
+        self.assertEqual(len(pool), 2)
+        self.assertIs(pool.get(DB), first)
+
+    def test_idle_timeout(self):
+        """Idle handles are not reused."""
+        pool = ConnectionPool(idle_timeout=-1)
+        self.assertIsNot(pool.get(DB), pool.get(DB))
+
+    def test_missing_file(self):
+        """Missing databases raise NotOK, as open_dumptruck does."""
+        pool = ConnectionPool()
+        self.assertRaises(NotOK, pool.get, 'nonexistent.db')
+
 class TestThatFilesAreNotCreated(unittest.TestCase):
     """Removing Files."""
     def setUp(self):